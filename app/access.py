@@ -0,0 +1,150 @@
+"""
+Access control for books, their sketches and the sketches' media files.
+
+A user may access a book they created or collaborate on. can_access answers
+that with a single EXISTS query on the book's primary key and the
+collaborators table's (book, user) index, given only the book id, so
+callers don't load the book or its collaborators.
+
+Answers are memoized on the request, when one is given, and in a
+per-process cache of up to ACCESS_CACHE_SIZE entries for ACCESS_CACHE_TTL
+seconds. Changes to a book's collaborators (m2m_changed), and saving or
+deleting a book, drop the affected entries right away in the process that
+made the change; other processes see the change once their entries expire.
+
+A media file may be read by whoever can access a book with a sketch using
+it: as its image, its thumbnails, or one of its audio summaries. Files no
+sketch uses are served to no one.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Book, Sketch
+
+_cache = OrderedDict()  # (user_id, book_id) -> (allowed, expires at)
+_lock = threading.Lock()
+_generation = 0  # bumped by every invalidation, so racing lookups don't store stale answers
+
+
+def cache_ttl():
+    return getattr(settings, "ACCESS_CACHE_TTL", 60)
+
+
+def cache_size():
+    return getattr(settings, "ACCESS_CACHE_SIZE", 10000)
+
+
+def _query(user_id, book_id):
+    collaborator = Book.collaborators.through.objects.filter(book_id=OuterRef("pk"), user_id=user_id)
+    return Book.objects.filter(Q(created_by_id=user_id) | Exists(collaborator), pk=book_id).exists()
+
+
+def _lookup(key):
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None, _generation
+        if entry[1] < time.monotonic():
+            del _cache[key]
+            return None, _generation
+        _cache.move_to_end(key)
+        return entry[0], _generation
+
+
+def _store(key, allowed, generation):
+    with _lock:
+        if generation != _generation:
+            return
+        _cache[key] = (allowed, time.monotonic() + cache_ttl())
+        _cache.move_to_end(key)
+        while len(_cache) > cache_size():
+            _cache.popitem(last=False)
+
+
+def can_access(user, book_id, request=None):
+    """True when ``user`` created or collaborates on the book ``book_id``."""
+    if user is None or not user.is_authenticated or book_id is None:
+        return False
+    key = (user.pk, int(book_id))
+    memo = None
+    if request is not None:
+        memo = request.__dict__.setdefault("_book_access", {})
+        if key in memo:
+            return memo[key]
+
+    allowed, generation = _lookup(key)
+    if allowed is None:
+        allowed = _query(*key)
+        _store(key, allowed, generation)
+    if memo is not None:
+        memo[key] = allowed
+    return allowed
+
+
+def sketch_book_id(sketch_id):
+    """The book id of a sketch, or None when there is no such sketch."""
+    return Sketch.objects.filter(pk=sketch_id).values_list("book_id", flat=True).first()
+
+
+def can_access_sketch(user, sketch_id, request=None):
+    """True when the sketch exists and ``user`` may access its book."""
+    return can_access(user, sketch_book_id(sketch_id), request)
+
+
+def media_book_ids(name):
+    """Ids of the books with a sketch using the media file ``name``."""
+    folder, _, filename = name.partition("/")
+    if folder == "sketches":
+        sketches = Sketch.objects.filter(image=name)
+    elif folder == "thumbnails":
+        # thumbnails/<image key>-<size>.<ext>, see thumbnails
+        key = filename.rpartition("-")[0]
+        if not key:
+            return []
+        sketches = Sketch.objects.filter(thumbnail_key=key)
+    elif folder == "audio_summaries":
+        sketches = Sketch.objects.filter(Q(audio_summary=name) | Q(audios__blob__file=name))
+    else:
+        return []
+    return list(sketches.values_list("book_id", flat=True).distinct())
+
+
+def can_access_media(user, name, request=None):
+    """True when ``user`` may access a book with a sketch using the media file ``name``."""
+    if user is None or not user.is_authenticated:
+        return False
+    return any(can_access(user, book_id, request) for book_id in media_book_ids(name))
+
+
+def forget(book_id=None, user_id=None):
+    """Drop the cached answers for a book, a user, or (with neither) everything."""
+    global _generation
+    with _lock:
+        _generation += 1
+        if book_id is None and user_id is None:
+            _cache.clear()
+            return
+        for key in [k for k in _cache if k[1] == book_id or k[0] == user_id]:
+            del _cache[key]
+
+
+@receiver(m2m_changed, sender=Book.collaborators.through)
+def _collaborators_changed(sender, instance, action, reverse, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if reverse:
+        forget(user_id=instance.pk)  # user.collaborating_books changed
+    else:
+        forget(book_id=instance.pk)
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def _book_changed(sender, instance, **kwargs):
+    forget(book_id=instance.pk)
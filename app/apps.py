@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "app"
+
+    def ready(self):
+        # register the background job handlers and signal receivers
+        from . import access, audio_cache, tasks  # noqa: F401
@@ -0,0 +1,324 @@
+"""
+Content-addressed cache of generated audio.
+
+Audio is stored once per hash of (explanation, language, pipeline version)
+as an AudioBlob under ``audio_summaries/<key>.mp3``. Asking again for the same
+explanation in the same language, from any sketch, returns the existing file
+without running translation, refinement or TTS.
+
+A sketch holds one SketchAudio row per language, and each blob counts the
+rows pointing at it (``ref_count``). A sketch getting new audio in a
+language, or being deleted, releases its reference; blobs with no references
+for longer than AUDIO_BLOB_GRACE seconds are deleted together with their file
+by collect_garbage (see the collect_audio command).
+
+Blobs are assembled from per-sentence segments (see speech_cache), so a
+slightly edited explanation only re-renders the sentences that changed.
+
+get_audios synthesizes one explanation in several languages at once: the
+MathToSpeech conversion runs once and the missing sentences of all languages
+are rendered concurrently on up to AUDIO_FANOUT_WORKERS x AUDIO_TTS_WORKERS
+threads.
+
+stream_audio generates a missing entry while handing out the audio as it is
+produced, for a streaming response.
+
+Audio with sentences whose translation or refinement failed (spoken in
+English instead, see speech_cache) is never stored: get_audio and get_audios
+raise AudioDegraded, which jobs retry, and stream_audio streams it without
+keeping it.
+"""
+import hashlib
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.deletion import ProtectedError
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import speech_cache
+from .audio_generator import PIPELINE_VERSION, math_to_speech
+from .models import AudioBlob, SketchAudio
+
+logger = logging.getLogger(__name__)
+
+
+class AudioDegraded(RuntimeError):
+    """Translation or refinement failed for part of the text; nothing was cached."""
+
+    def __init__(self, language, sentences):
+        super().__init__(f"{sentences} sentence(s) could not be translated or refined to '{language}'")
+
+
+def cache_key(text, language):
+    digest = hashlib.sha256()
+    digest.update(str(PIPELINE_VERSION).encode())
+    digest.update(b"\0")
+    digest.update(language.encode())
+    digest.update(b"\0")
+    digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def blob_name(key):
+    return f"audio_summaries/{key}.mp3"
+
+
+def _blob_path(key):
+    return os.path.join(settings.MEDIA_ROOT, blob_name(key))
+
+
+def _write_blob(key, chunks, degraded=()):
+    """
+    Write ``chunks`` to the blob file for ``key``, yielding each one as it is
+    written. Nothing is kept if ``degraded`` is not empty once they're done.
+    """
+    path = _blob_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write next to the final name and rename, so a concurrent reader never
+    # sees a partial file
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            for data in chunks:
+                f.write(data)
+                yield data
+        if not degraded:
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _synthesize(speech_text, language, key):
+    """
+    Run the audio pipeline into the blob file for ``key``; returns its size.
+    Raises AudioDegraded.
+    """
+    degraded = set()
+    segments = speech_cache.stream_segments(speech_text, language, degraded=degraded)
+    for _ in _write_blob(key, segments, degraded):
+        pass
+    if degraded:
+        raise AudioDegraded(language, len(degraded))
+    return os.path.getsize(_blob_path(key))
+
+
+def _store(key, language, size):
+    try:
+        blob, created = AudioBlob.objects.get_or_create(
+            key=key,
+            defaults={"language": language, "file": blob_name(key), "size": size, "miss_count": 1},
+        )
+    except IntegrityError:
+        # Created concurrently by another worker
+        blob, created = AudioBlob.objects.get(key=key), False
+    if not created:
+        AudioBlob.objects.filter(pk=blob.pk).update(size=size, miss_count=F("miss_count") + 1)
+    return blob
+
+
+def lookup_audio(text, language):
+    """The cached AudioBlob for ``text`` in ``language`` (counted as a hit), or None."""
+    blob = AudioBlob.objects.filter(key=cache_key(text, language)).first()
+    if blob is None or not blob.file.storage.exists(blob.file.name):
+        return None
+    AudioBlob.objects.filter(pk=blob.pk).update(hit_count=F("hit_count") + 1)
+    return blob
+
+
+def get_audio(text, language):
+    """
+    The AudioBlob for ``text`` in ``language``, generating it on a miss.
+
+    Returns (blob, cached). The blob is not referenced by anything yet; see
+    assign_audio. Raises AudioDegraded.
+    """
+    blob = lookup_audio(text, language)
+    if blob is not None:
+        return blob, True
+
+    key = cache_key(text, language)
+    size = _synthesize(math_to_speech.convert(text), language, key)
+    return _store(key, language, size), False
+
+
+def stream_audio(text, language, on_stored=None):
+    """
+    Generate audio for ``text`` in ``language``, yielding the MP3 data as each
+    sentence is ready (see speech_cache.stream_segments).
+
+    The data is also written to the blob file; once the last chunk has been
+    yielded the AudioBlob is stored and passed to ``on_stored``. A consumer
+    that stops early, or degraded audio, leaves nothing behind.
+    """
+    key = cache_key(text, language)
+    degraded = set()
+    segments = speech_cache.stream_segments(math_to_speech.convert(text), language, degraded=degraded)
+    yield from _write_blob(key, segments, degraded)
+    if degraded:
+        logger.warning("Streamed audio not cached: %s", AudioDegraded(language, len(degraded)))
+        return
+    blob = _store(key, language, os.path.getsize(_blob_path(key)))
+    if on_stored is not None:
+        on_stored(blob)
+
+
+def fanout_workers():
+    return getattr(settings, "AUDIO_FANOUT_WORKERS", 3)
+
+
+def get_audios(text, languages, max_workers=None):
+    """
+    get_audio for several languages, generating the misses concurrently.
+
+    Returns {language: (blob, cached)} in the order of ``languages``; a
+    language whose generation failed maps to the exception instead.
+    """
+    results = {}
+    missing = []
+    for language in languages:
+        blob = lookup_audio(text, language)
+        if blob is not None:
+            results[language] = (blob, True)
+        else:
+            missing.append(language)
+
+    if missing:
+        speech_text = math_to_speech.convert(text)
+        plans = {}
+        for language in missing:
+            try:
+                plans[language] = speech_cache.plan(speech_text, language)
+            except Exception as e:
+                results[language] = e
+        # Plus one thread per language for its Gemini call
+        workers = max(1, min(
+            sum(1 for parts in plans.values() for _, _, audio in parts if audio is None),
+            (max_workers or fanout_workers()) * speech_cache.tts_workers(),
+        )) + len(plans)
+        # The threads only call Gemini/gTTS; segments, blob files and rows are
+        # written here, on the caller's database connection
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="audio") as pool:
+            futures = {}
+            for language, parts in plans.items():
+                speech_cache.submit(pool, parts, language, futures)
+        for language, parts in plans.items():
+            key = cache_key(text, language)
+            degraded = set()
+            try:
+                for _ in _write_blob(key, speech_cache.assemble(parts, language, futures, degraded), degraded):
+                    pass
+                if degraded:
+                    raise AudioDegraded(language, len(degraded))
+                size = os.path.getsize(_blob_path(key))
+                results[language] = (_store(key, language, size), False)
+            except Exception as e:
+                results[language] = e
+
+    return {language: results[language] for language in languages}
+
+
+def assign_audio(sketch, blob, latest=True):
+    """
+    Make ``blob`` the sketch's audio in the blob's language, moving the
+    reference. With ``latest`` it also becomes the sketch's audio_summary.
+    """
+    with transaction.atomic():
+        entry = SketchAudio.objects.select_for_update().filter(sketch=sketch, language=blob.language).first()
+        if entry is None or entry.blob_id != blob.pk:
+            updated = AudioBlob.objects.filter(pk=blob.pk).update(ref_count=F("ref_count") + 1, released_at=None)
+            if not updated:
+                raise AudioBlob.DoesNotExist("Audio blob was collected, generate it again")
+            if entry is None:
+                SketchAudio.objects.create(sketch=sketch, language=blob.language, blob=blob)
+            else:
+                release(entry.blob_id)
+                entry.blob = blob
+                entry.save(update_fields=["blob", "updated_at"])
+        if latest:
+            sketch.audio_blob = blob
+            sketch.audio_summary = blob.file.name
+            sketch.audio_generated_at = blob.created_at
+            sketch.save(update_fields=["audio_blob", "audio_summary", "audio_generated_at"])
+
+
+def release(blob_id):
+    """Drop one reference to a blob."""
+    AudioBlob.objects.filter(pk=blob_id).update(ref_count=F("ref_count") - 1)
+    AudioBlob.objects.filter(pk=blob_id, ref_count__lte=0, released_at__isnull=True).update(
+        released_at=timezone.now()
+    )
+
+
+@receiver(post_delete, sender=SketchAudio)
+def _release_deleted_audio(sender, instance, **kwargs):
+    release(instance.blob_id)
+
+
+def recount():
+    """Recompute every ref_count from the SketchAudio rows (repairs drifted counters)."""
+    counts = dict(SketchAudio.objects.values_list("blob").annotate(n=Count("id")))
+    fixed = 0
+    for blob in AudioBlob.objects.all():
+        count = counts.get(blob.pk, 0)
+        if blob.ref_count != count:
+            blob.ref_count = count
+            if count == 0 and blob.released_at is None:
+                blob.released_at = timezone.now()
+            elif count:
+                blob.released_at = None
+            blob.save(update_fields=["ref_count", "released_at"])
+            fixed += 1
+    return fixed
+
+
+def collect_garbage(grace=None, dry_run=False):
+    """
+    Delete blobs unreferenced for longer than ``grace`` seconds (default
+    AUDIO_BLOB_GRACE) and their files. Returns (blobs, bytes) freed.
+    """
+    if grace is None:
+        grace = getattr(settings, "AUDIO_BLOB_GRACE", 24 * 3600)
+    cutoff = timezone.now() - timedelta(seconds=grace)
+    freed = freed_bytes = 0
+    for blob in AudioBlob.objects.filter(ref_count__lte=0, released_at__lt=cutoff):
+        if dry_run:
+            deleted = 1
+        else:
+            # Conditional delete: a blob referenced again in the meantime stays
+            try:
+                deleted, _ = AudioBlob.objects.filter(pk=blob.pk, ref_count__lte=0).delete()
+            except ProtectedError:
+                # ref_count drifted below the real number of uses; see recount
+                deleted = 0
+            if deleted:
+                blob.file.storage.delete(blob.file.name)
+        if deleted:
+            freed += 1
+            freed_bytes += blob.size
+    return freed, freed_bytes
+
+
+def cache_stats():
+    """Hit/miss totals and size of the audio cache."""
+    totals = AudioBlob.objects.aggregate(
+        entries=Count("id"), hits=Sum("hit_count"), misses=Sum("miss_count"), size=Sum("size"),
+    )
+    hits = totals["hits"] or 0
+    misses = totals["misses"] or 0
+    return {
+        "entries": totals["entries"],
+        "bytes": totals["size"] or 0,
+        "unreferenced": AudioBlob.objects.filter(ref_count__lte=0).count(),
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+    }
@@ -1,130 +1,299 @@
+import io
+import json
+import logging
 import re
-import google.generativeai as genai
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import gemini
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the text conversion, translation/refinement prompts or TTS
+# settings change the generated audio; cached audio (see audio_cache) is
+# keyed by it.
+PIPELINE_VERSION = 4
+
+GREEK_LETTERS = {
+    'α': 'alpha', 'β': 'beta', 'γ': 'gamma', 'δ': 'delta',
+    'ε': 'epsilon', 'ζ': 'zeta', 'η': 'eta', 'θ': 'theta',
+    'ι': 'iota', 'κ': 'kappa', 'λ': 'lambda', 'μ': 'mu',
+    'ν': 'nu', 'ξ': 'xi', 'π': 'pi', 'ρ': 'rho',
+    'σ': 'sigma', 'τ': 'tau', 'φ': 'phi', 'χ': 'chi',
+    'ψ': 'psi', 'ω': 'omega', 'Δ': 'Delta', 'Σ': 'Sigma',
+    'Ω': 'Omega', 'Φ': 'Phi', 'Π': 'Pi', 'Θ': 'Theta'
+}
+
+OPERATORS = {
+    '∫': ' integral of ',
+    '∑': ' sum of ',
+    '∏': ' product of ',
+    '∂': ' partial derivative of ',
+    '∇': ' gradient of ',
+    '√': ' square root of ',
+    '∞': ' infinity ',
+    '≈': ' approximately equals ',
+    '≠': ' not equal to ',
+    '≤': ' less than or equal to ',
+    '≥': ' greater than or equal to ',
+    '±': ' plus or minus ',
+    '×': ' times ',
+    '÷': ' divided by ',
+    '→': ' approaches ',
+    '∈': ' is an element of ',
+    '⊂': ' is a subset of ',
+    '⊆': ' is a subset of or equal to ',
+    '∪': ' union ',
+    '∩': ' intersection '
+}
+
+SUPERSCRIPTS = {
+    '²': ' squared', '³': ' cubed',
+    '⁴': ' to the power of 4', '⁵': ' to the power of 5',
+    '⁶': ' to the power of 6', '⁷': ' to the power of 7',
+    '⁸': ' to the power of 8', '⁹': ' to the power of 9',
+    '⁰': ' to the power of 0', '¹': '',
+    'ⁿ': ' to the power of n'
+}
+
+SUBSCRIPTS = {
+    '₀': ' sub 0', '₁': ' sub 1', '₂': ' sub 2',
+    '₃': ' sub 3', '₄': ' sub 4', '₅': ' sub 5',
+    '₆': ' sub 6', '₇': ' sub 7', '₈': ' sub 8',
+    '₉': ' sub 9'
+}
+
+def _code_point_table(mapping):
+    """
+    A str.translate table for ``mapping``. A list indexed by code point
+    translates about 3x faster than a dict; code points past its end raise
+    IndexError, which translate treats as unmapped.
+    """
+    table = str.maketrans(mapping)
+    return [table.get(i, i) for i in range(max(table) + 1)]
+
+
+# The single-character substitutions, one table per point of the original
+# sequence of steps where they happen: the pattern steps in between depend on
+# what is still there (d²y/dx² needs the "²", x₁ is no longer a word for x_n).
+_MARKDOWN_TABLE = str.maketrans({'*': '', '`': ''})
+_SYMBOL_TABLE = _code_point_table({
+    **{symbol: f' {word} ' for symbol, word in GREEK_LETTERS.items()}, **OPERATORS,
+})
+_SUPERSCRIPT_TABLE = _code_point_table(SUPERSCRIPTS)
+_SUBSCRIPT_TABLE = _code_point_table(SUBSCRIPTS)
+
+# The pattern steps. All of them start with a literal character, which the
+# regex engine searches for directly; the original patterns quoted in the
+# comments start with (\w+) instead, tried at every position of the text, so
+# the word before the "^", "_" or "/" is checked by hand. A possessive \w++
+# is only used where backtracking could never find a match.
+_HEADING = re.compile(r'#{1,6}\s+')
+_DERIVATIVES = [
+    (re.compile(r'd/d(\w+)'), r'derivative with respect to \1'),
+    (re.compile(r'd(\w++)/d(\w+)'), r'derivative of \1 with respect to \2'),
+    (re.compile(r'd²(\w++)/d(\w+)²'), r'second derivative of \1 with respect to \2'),
+]
+# (\w+)\^(\d+), (\w+)\^(\w+) and (\w+)\^\{(.+?)\} in one alternation: a caret
+# followed by a word (group 1) or by "{".
+_POWER = re.compile(r'\^(?:(\w+)|\{)')
+# (\w+)_(\w+) and (\w+)_\{(.+?)\} in one alternation: since "_" is a word
+# character, the first replaces the last underscore of a word that has word
+# characters on both sides; group 1 is the "{" of the second.
+_INDEX = re.compile(r'_(?:(?<=\w_)(?=(?:[^\W_]++_?|_)(?!\w))|(\{))')
+# (\d+(?:\.\d+)?)\s*/\s*(\d+(?:\.\d+)?), from the slash
+_FRACTION = re.compile(r'/\s*+(?=\d)')
+_NUMBER = re.compile(r'\d+(?:\.\d+)?')
+_DIGITS = re.compile(r'\d*')
+
+
+def _is_word(char):
+    """Whether ``char`` matches \\w."""
+    return char.isalnum() or char == '_'
+
+
+class _Braces:
+    """
+    Finds where \\{(.+?)\\} ends for the "{"s of a text, asked in text order.
+    The next "}" and line break are remembered, so the whole text is scanned
+    once instead of to the end of the line for every "{".
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.brace = self.newline = -2
+
+    def closing(self, opening):
+        """Index of the "}" closing the "{" at ``opening``, or None."""
+        first = opening + 1
+        if first >= len(self.text) or self.text[first] == '\n':
+            return None
+        if self.brace != -1 and self.brace <= first:
+            self.brace = self.text.find('}', first + 1)
+        if self.newline != -1 and self.newline <= first:
+            self.newline = self.text.find('\n', first + 1)
+        if self.brace == -1 or self.newline != -1 and self.newline < self.brace:
+            return None
+        return self.brace
+
 
 class MathToSpeech:
-    """Converts mathematical notation to speech-friendly text"""
-    
-    def __init__(self):
-        self.greek_letters = {
-            'α': 'alpha', 'β': 'beta', 'γ': 'gamma', 'δ': 'delta',
-            'ε': 'epsilon', 'ζ': 'zeta', 'η': 'eta', 'θ': 'theta',
-            'ι': 'iota', 'κ': 'kappa', 'λ': 'lambda', 'μ': 'mu',
-            'ν': 'nu', 'ξ': 'xi', 'π': 'pi', 'ρ': 'rho',
-            'σ': 'sigma', 'τ': 'tau', 'φ': 'phi', 'χ': 'chi',
-            'ψ': 'psi', 'ω': 'omega', 'Δ': 'Delta', 'Σ': 'Sigma',
-            'Ω': 'Omega', 'Φ': 'Phi', 'Π': 'Pi', 'Θ': 'Theta'
-        }
-        
-        self.operators = {
-            '∫': ' integral of ',
-            '∑': ' sum of ',
-            '∏': ' product of ',
-            '∂': ' partial derivative of ',
-            '∇': ' gradient of ',
-            '√': ' square root of ',
-            '∞': ' infinity ',
-            '≈': ' approximately equals ',
-            '≠': ' not equal to ',
-            '≤': ' less than or equal to ',
-            '≥': ' greater than or equal to ',
-            '±': ' plus or minus ',
-            '×': ' times ',
-            '÷': ' divided by ',
-            '→': ' approaches ',
-            '∈': ' is an element of ',
-            '⊂': ' is a subset of ',
-            '⊆': ' is a subset of or equal to ',
-            '∪': ' union ',
-            '∩': ' intersection '
-        }
-    
-    def convert_greek_letters(self, text):
-        """Convert Greek letters to their names"""
-        for symbol, word in self.greek_letters.items():
-            text = text.replace(symbol, f' {word} ')
-        return text
+    """
+    Converts mathematical notation to speech-friendly text.
+
+    Gives exactly the output of the original converter, a sequence of
+    str.replace and re.sub calls over the whole text (kept with the tests,
+    in tests/math_speech_reference.py), in a handful of scans: one translate
+    table per group of single-character substitutions and one combined
+    pattern each for powers and indices, replayed with the state every
+    original pattern would have had (where its previous match ended).
+    """
+    greek_letters = GREEK_LETTERS
+    operators = OPERATORS
     
-    def convert_operators(self, text):
-        """Convert mathematical operators to words"""
-        for symbol, word in self.operators.items():
-            text = text.replace(symbol, word)
-        return text
+    def convert_symbols(self, text):
+        """Convert Greek letters to their names and operators to words"""
+        return text.translate(_SYMBOL_TABLE)
     
     def convert_superscripts(self, text):
         """Convert superscripts to spoken form"""
-        superscripts = {
-            '²': ' squared', '³': ' cubed',
-            '⁴': ' to the power of 4', '⁵': ' to the power of 5',
-            '⁶': ' to the power of 6', '⁷': ' to the power of 7',
-            '⁸': ' to the power of 8', '⁹': ' to the power of 9',
-            '⁰': ' to the power of 0', '¹': '',
-            'ⁿ': ' to the power of n'
-        }
-        for sup, word in superscripts.items():
-            text = text.replace(sup, word)
+        text = text.translate(_SUPERSCRIPT_TABLE)
+        if '^' not in text:
+            return text
         
-        # Handle x^n pattern
-        text = re.sub(r'(\w+)\^(\d+)', r'\1 to the power of \2', text)
-        text = re.sub(r'(\w+)\^(\w+)', r'\1 to the power of \2', text)
-        text = re.sub(r'(\w+)\^\{(.+?)\}', r'\1 to the power of \2', text)
-        return text
+        # Handle x^n pattern. Every original pattern kept the word and the
+        # exponent and only replaced what is between them, so the caret
+        # (and "{", "}") are all that change here.
+        out = []
+        written = 0
+        # Where the last match of each original pattern ended
+        digits_end = word_end = braced_end = 0
+        closing = None
+        braces = _Braces(text)
+        for match in _POWER.finditer(text):
+            start = match.start()
+            if closing is not None and closing < start:
+                out.append(text[written:closing])
+                written = closing + 1
+                closing = None
+            if not start or not _is_word(text[start - 1]):
+                continue
+            word = match.group(1)
+            if word is not None:
+                digits = _DIGITS.match(word).end()
+                if digits and start > digits_end:
+                    digits_end = start + 1 + digits
+                elif start > word_end:
+                    word_end = match.end()
+                else:
+                    continue
+            elif start > braced_end and braces.closing(start + 1) is not None:
+                closing = braces.closing(start + 1)
+                braced_end = closing + 1
+            else:
+                continue
+            out.append(text[written:start])
+            out.append(' to the power of ')
+            written = match.end(0) if word is None else start + 1
+        if closing is not None:
+            out.append(text[written:closing])
+            written = closing + 1
+        out.append(text[written:])
+        return ''.join(out)
     
     def convert_subscripts(self, text):
         """Convert subscripts to spoken form"""
-        subscripts = {
-            '₀': ' sub 0', '₁': ' sub 1', '₂': ' sub 2',
-            '₃': ' sub 3', '₄': ' sub 4', '₅': ' sub 5',
-            '₆': ' sub 6', '₇': ' sub 7', '₈': ' sub 8',
-            '₉': ' sub 9'
-        }
-        for sub, word in subscripts.items():
-            text = text.replace(sub, word)
+        text = text.translate(_SUBSCRIPT_TABLE)
+        if '_' not in text:
+            return text
         
-        # Handle x_n pattern
-        text = re.sub(r'(\w+)_(\w+)', r'\1 sub \2', text)
-        text = re.sub(r'(\w+)_\{(.+?)\}', r'\1 sub \2', text)
-        return text
+        # Handle x_n pattern, replaying both patterns as for powers
+        out = []
+        written = 0
+        braced_end = 0
+        replaced = -1
+        closing = None
+        braces = _Braces(text)
+        for match in _INDEX.finditer(text):
+            start = match.start()
+            if closing is not None and closing < start:
+                out.append(text[written:closing])
+                written = closing + 1
+                closing = None
+            if match.group(1) is None:
+                replaced = start
+            # The braced pattern runs on the output of the other one, where a
+            # replaced underscore before it is no longer a word character
+            elif (start > braced_end and _is_word(text[start - 1]) and replaced != start - 1
+                  and braces.closing(start + 1) is not None):
+                closing = braces.closing(start + 1)
+                braced_end = closing + 1
+            else:
+                continue
+            out.append(text[written:start])
+            out.append(' sub ')
+            written = match.end()
+        if closing is not None:
+            out.append(text[written:closing])
+            written = closing + 1
+        out.append(text[written:])
+        return ''.join(out)
     
     def convert_fractions(self, text):
         """Convert fractions to spoken form"""
         # Handle simple fractions: a/b
-        text = re.sub(r'(\d+(?:\.\d+)?)\s*/\s*(\d+(?:\.\d+)?)', 
-                     r'\1 over \2', text)
-        return text
+        if '/' not in text:
+            return text
+        out = []
+        written = 0
+        for match in _FRACTION.finditer(text):
+            start = match.start()
+            if start < written:
+                continue
+            # Back over the spaces before the slash to the numerator
+            while start > written and text[start - 1].isspace():
+                start -= 1
+            if start > written and text[start - 1].isdecimal():
+                out.append(text[written:start])
+                out.append(' over ')
+                written = _NUMBER.match(text, match.end()).end()
+                out.append(text[match.end():written])
+        out.append(text[written:])
+        return ''.join(out)
     
     def handle_derivatives(self, text):
         """Convert derivative notation to spoken form"""
-        # d/dx → "derivative with respect to x"
-        text = re.sub(r'd/d(\w+)', r'derivative with respect to \1', text)
-        # dy/dx → "derivative of y with respect to x"
-        text = re.sub(r'd(\w+)/d(\w+)', 
-                     r'derivative of \1 with respect to \2', text)
-        # d²y/dx² → "second derivative of y with respect to x"
-        text = re.sub(r'd²(\w+)/d(\w+)²', 
-                     r'second derivative of \1 with respect to \2', text)
+        # d/dx → "derivative with respect to x", dy/dx → "derivative of y
+        # with respect to x", d²y/dx² → "second derivative of y ..."
+        if '/d' not in text:
+            return text
+        for pattern, replacement in _DERIVATIVES:
+            text = pattern.sub(replacement, text)
         return text
     
     def remove_markdown(self, text):
         """Remove markdown formatting"""
-        text = text.replace('**', '')
-        text = text.replace('*', '')
-        text = text.replace('`', '')
-        text = re.sub(r'#{1,6}\s+', '', text)
-        return text
+        text = text.translate(_MARKDOWN_TABLE)
+        if '#' not in text:
+            return text
+        return _HEADING.sub('', text)
     
     def convert(self, text):
         """Main conversion method"""
         text = self.remove_markdown(text)
-        text = self.convert_greek_letters(text)
-        text = self.convert_operators(text)
+        text = self.convert_symbols(text)
         text = self.handle_derivatives(text)
         text = self.convert_superscripts(text)
         text = self.convert_subscripts(text)
         text = self.convert_fractions(text)
         
         # Clean up extra spaces
-        text = re.sub(r'\s+', ' ', text)
-        return text.strip()
+        return ' '.join(text.split())
+
+
+math_to_speech = MathToSpeech()
 
 
 # Supported languages configuration
@@ -168,14 +337,11 @@ SUPPORTED_LANGUAGES = {
 }
 
 
-def translate_with_gemini(text, target_language, gemini_api_key):
+def translate_with_gemini(text, target_language):
     """
     Translate English text to target Indian language using Gemini
     Keeps mathematical terms in English for clarity
     """
-    genai.configure(api_key=gemini_api_key)
-    model = genai.GenerativeModel(model_name="gemini-2.5-flash")
-    
     language_name = SUPPORTED_LANGUAGES.get(target_language, {}).get('name', target_language)
     
     prompt = f"""Translate the following mathematical explanation from English to {language_name}.
@@ -198,22 +364,13 @@ Text to translate:
 
 Provide only the translated version:"""
 
-    try:
-        response = model.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        print(f"Translation error: {e}")
-        # Fallback: return original text if translation fails
-        return text
+    return gemini.generate_text(prompt)
 
 
-def refine_with_gemini(text, gemini_api_key, target_language='en'):
+def refine_with_gemini(text, target_language='en'):
     """
     Use Gemini to refine the speech text for natural delivery
     """
-    genai.configure(api_key=gemini_api_key)
-    model = genai.GenerativeModel(model_name="gemini-2.5-flash")
-    
     if target_language == 'en':
         prompt = f"""Convert this mathematical explanation to a format perfect for text-to-speech audio narration.
 
@@ -246,67 +403,212 @@ Text to refine:
 
 Provide only the refined version:"""
 
-    response = model.generate_content(prompt)
-    return response.text
+    return gemini.generate_text(prompt)
 
 
-def generate_audio_summary(text, output_path, gemini_api_key, language='en'):
+def generate_audio_summary(text, output_path, language='en'):
     """
     Generate audio from text using gTTS in specified language
     
     Args:
         text: The explanation text to convert to audio
         output_path: Path where the audio file will be saved
-        gemini_api_key: Gemini API key for refinement and translation
         language: Language code (en, hi, kn, te, ta, ml)
     
     Returns:
         str: Path to the generated audio file
     """
-    try:
-        from gtts import gTTS
-    except ImportError:
-        raise ImportError(
-            "gTTS not installed. Install it with: pip install gTTS"
-        )
+    # Step 1: Convert math notation to speech-friendly text
+    speech_text = math_to_speech.convert(text)
     
+    return synthesize_speech(speech_text, output_path, language)
+
+
+def prepare_speech(speech_text, language='en'):
+    """
+    Translate and refine text already converted by MathToSpeech.
+
+    Returns (language, refined_text); language falls back to 'en' when it is
+    unsupported or translation fails.
+    """
     # Validate language
     if language not in SUPPORTED_LANGUAGES:
         print(f"Warning: Unsupported language '{language}', falling back to English")
         language = 'en'
     
-    # Step 1: Convert math notation to speech-friendly text
-    converter = MathToSpeech()
-    speech_text = converter.convert(text)
-    
     # Step 2: Translate if not English
     if language != 'en':
         try:
             print(f"Translating to {SUPPORTED_LANGUAGES[language]['name']}...")
-            speech_text = translate_with_gemini(speech_text, language, gemini_api_key)
+            speech_text = translate_with_gemini(speech_text, language)
         except Exception as e:
             print(f"Warning: Translation failed ({e}), using English")
             language = 'en'
     
     # Step 3: Refine with Gemini for natural delivery
     try:
-        refined_text = refine_with_gemini(speech_text, gemini_api_key, language)
+        refined_text = refine_with_gemini(speech_text, language)
     except Exception as e:
         print(f"Warning: Gemini refinement failed ({e}), using basic conversion")
         refined_text = speech_text
-    
-    # Step 4: Generate audio using gTTS
+
+    return language, refined_text
+
+
+# One sentence ready to speak: its language ('en' when it fell back), its
+# text, and whether translation or refinement failed (see prepare_sentences)
+PreparedSentence = namedtuple("PreparedSentence", ["language", "text", "degraded"])
+
+_CODE_FENCE = re.compile(r'^```(?:json)?\s*|\s*```$')
+
+
+def prepare_batch():
+    return getattr(settings, "AUDIO_PREPARE_BATCH", 40)
+
+
+def _sentences_prompt(sentences, language):
+    if language == 'en':
+        task = (
+            "Refine each of these sentences of a mathematical explanation for text-to-speech audio "
+            "narration. Make it sound natural and conversational when read aloud, express all "
+            "mathematical terms clearly and keep the educational value and accuracy."
+        )
+    else:
+        language_name = SUPPORTED_LANGUAGES[language]['name']
+        task = (
+            f"Translate each of these sentences of a mathematical explanation from English to "
+            f"{language_name} for text-to-speech audio narration. Keep all mathematical terms, "
+            f"numbers and variable names in English and only translate the connecting words and "
+            f"explanatory phrases. Make it sound natural and clear when read aloud in {language_name}."
+        )
+    return (
+        f"{task} Don't use markdown or special formatting.\n\n"
+        f"The sentences, as a JSON array of strings:\n{json.dumps(sentences, ensure_ascii=False)}\n\n"
+        f"Answer with only a JSON array of exactly {len(sentences)} strings, "
+        "one for each sentence, in the same order."
+    )
+
+
+def _prepare_batch(sentences, language):
+    reply = gemini.generate_text(_sentences_prompt(sentences, language))
+    texts = json.loads(_CODE_FENCE.sub('', reply.strip()))
+    if (not isinstance(texts, list) or len(texts) != len(sentences)
+            or not all(isinstance(text, str) for text in texts)):
+        raise ValueError(f"Expected a JSON array of {len(sentences)} strings")
+    return [
+        PreparedSentence(language, text.strip() or sentence, False)
+        for sentence, text in zip(sentences, texts)
+    ]
+
+
+def prepare_sentences(sentences, language='en'):
+    """
+    Translate and refine sentences already converted by MathToSpeech.
+
+    Sentences go to Gemini in batches of up to AUDIO_PREPARE_BATCH, one call
+    per batch. Returns a PreparedSentence per sentence. When a call fails or
+    its answer doesn't match the batch, that batch keeps its English text
+    unrefined and is marked degraded; degraded sentences must not be cached.
+    """
+    if language not in SUPPORTED_LANGUAGES:
+        logger.warning("Unsupported language '%s', falling back to English", language)
+        language = 'en'
+
+    prepared = []
+    batch_size = max(1, prepare_batch())
+    for start in range(0, len(sentences), batch_size):
+        batch = sentences[start:start + batch_size]
+        try:
+            prepared += _prepare_batch(batch, language)
+        except Exception as e:
+            logger.warning("Preparing %s sentence(s) in '%s' failed, using English: %s", len(batch), language, e)
+            prepared += [PreparedSentence('en', sentence, True) for sentence in batch]
+    return prepared
+
+
+# Sentence ends, including the Devanagari danda used in Hindi output
+_SENTENCE_END = re.compile(r'(?<=[.!?\u0964\u0965])\s+')
+
+
+def split_sentences(text, max_chars=None):
+    """
+    Split text into chunks of whole sentences for chunked TTS.
+
+    The first chunk is a single sentence so playback can start early; later
+    sentences are packed together up to ``max_chars`` (AUDIO_CHUNK_CHARS).
+    A sentence longer than that is a chunk of its own.
+    """
+    if max_chars is None:
+        max_chars = getattr(settings, "AUDIO_CHUNK_CHARS", 300)
+    chunks = []
+    for sentence in _SENTENCE_END.split(text.strip()):
+        if not sentence:
+            continue
+        if len(chunks) > 1 and len(chunks[-1]) + 1 + len(sentence) <= max_chars:
+            chunks[-1] += ' ' + sentence
+        else:
+            chunks.append(sentence)
+    return chunks
+
+
+def synthesize_chunk(text, tts_lang):
+    """MP3 bytes for one chunk of text."""
+    from gtts import gTTS
+
+    buffer = io.BytesIO()
+    gTTS(text=text, lang=tts_lang, slow=False).write_to_fp(buffer)
+    return buffer.getvalue()
+
+
+def stream_speech(speech_text, language='en', max_workers=None):
+    """
+    Translate, refine and speak text already converted by MathToSpeech,
+    yielding MP3 data chunk by chunk.
+
+    The refined text is split into sentence chunks (split_sentences) that are
+    synthesized concurrently on up to AUDIO_TTS_WORKERS threads and yielded
+    in order as soon as each one is ready. MP3 frames concatenate, so the
+    chunks joined together are a playable file.
+    """
     try:
-        # Get the correct gTTS language code
-        tts_lang = SUPPORTED_LANGUAGES[language]['tts_lang']
-        
-        # Create gTTS object
-        tts = gTTS(text=refined_text, lang=tts_lang, slow=False)
-        
-        # Save the audio file
-        tts.save(output_path)
+        from gtts import gTTS  # noqa: F401
+    except ImportError:
+        raise ImportError(
+            "gTTS not installed. Install it with: pip install gTTS"
+        )
+
+    language, refined_text = prepare_speech(speech_text, language)
+    chunks = split_sentences(refined_text)
+    if not chunks:
+        raise ValueError("Nothing to speak")
+
+    # Step 4: Generate audio using gTTS, one request per chunk
+    tts_lang = SUPPORTED_LANGUAGES[language]['tts_lang']
+    workers = max(1, min(len(chunks), max_workers or getattr(settings, "AUDIO_TTS_WORKERS", 4)))
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts")
+    try:
+        futures = [pool.submit(synthesize_chunk, chunk, tts_lang) for chunk in chunks]
+        for future in futures:
+            yield future.result()
+    finally:
+        # A consumer that stops early (client gone) doesn't wait for the rest
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def synthesize_speech(speech_text, output_path, language='en'):
+    """
+    Translate, refine and speak text already converted by MathToSpeech.
+
+    Split out of generate_audio_summary so the conversion can be done once
+    when one explanation is synthesized in several languages. The file is
+    written chunk by chunk as stream_speech produces them.
+    """
+    try:
+        with open(output_path, 'wb') as f:
+            for data in stream_speech(speech_text, language):
+                f.write(data)
         
-        print(f"✅ Audio generated successfully in {SUPPORTED_LANGUAGES[language]['name']}: {output_path}")
+        print(f"✅ Audio generated successfully in {SUPPORTED_LANGUAGES.get(language, SUPPORTED_LANGUAGES['en'])['name']}: {output_path}")
         return output_path
         
     except Exception as e:
@@ -314,11 +616,11 @@ def generate_audio_summary(text, output_path, gemini_api_key, language='en'):
         raise
 
 
-def generate_audio_with_ssml(text, output_path, gemini_api_key, language='en'):
+def generate_audio_with_ssml(text, output_path, language='en'):
     """
     Alias for generate_audio_summary for compatibility
     """
-    return generate_audio_summary(text, output_path, gemini_api_key, language)
+    return generate_audio_summary(text, output_path, language)
 
 
 def get_supported_languages():
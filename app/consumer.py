@@ -1,5 +1,33 @@
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from urllib.parse import parse_qs
 import json
+import logging
+
+from . import access, stroke_broadcast, stroke_buffer, stroke_index, stroke_store, stroke_wire, thumbnails
+from .stroke_simplify import simplify_strokes
+
+logger = logging.getLogger(__name__)
+
+
+def extract_strokes(data):
+    """
+    Return the stroke segments carried by an incoming message, or None.
+
+    Accepts a single segment dict (legacy clients), a list of segments, or a
+    batched frame ``{"type": "strokes", "strokes": [...]}``.
+    """
+    if isinstance(data, dict):
+        if data.get('type') == 'strokes':
+            data = data.get('strokes')
+        elif 'x1' in data:
+            return [data]
+        else:
+            return None
+    if isinstance(data, list):
+        return [s for s in data if isinstance(s, dict) and 'x1' in s]
+    return None
+
 
 class SketchConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -7,22 +35,75 @@ class SketchConsumer(AsyncWebsocketConsumer):
         self.sketch_id = self.scope['url_route']['kwargs']['sketch_id']
         # use a unique group name per sketch
         self.room_group_name = f"sketch_{self.sketch_id}"
+        # only the book's owner and collaborators may join (closing before
+        # accepting rejects the handshake)
+        allowed = await database_sync_to_async(access.can_access_sketch)(self.scope.get('user'), self.sketch_id)
+        if not allowed:
+            await self.close()
+            return
+        # clients connecting with ?batch=1 understand batched frames
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.batched = query.get('batch', ['0'])[0] == '1'
+        # and ?enc=bin clients exchange strokes as binary frames (see stroke_wire)
+        self.binary = query.get('enc', ['json'])[0] == 'bin'
 
         # join that group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
+        # strokes are persisted in batches (write-behind)
+        self.stroke_buffer = stroke_buffer.acquire(self.sketch_id)
+        # and broadcast in batches, one frame per tick
+        self.room = stroke_broadcast.acquire(self.channel_layer, self.room_group_name)
         await self.accept()
 
     async def disconnect(self, close_code):
+        if getattr(self, 'room', None) is not None:
+            self.room = None
+            await stroke_broadcast.release(self.room_group_name)
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        if getattr(self, 'stroke_buffer', None) is not None:
+            self.stroke_buffer = None
+            await stroke_buffer.release(self.sketch_id)
 
-    async def receive(self, text_data):
-        # broadcast incoming draw data to everyone in the same sketch group
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            try:
+                strokes = stroke_wire.decode_frame(bytes_data)
+            except stroke_wire.WireFormatError:
+                return
+        else:
+            try:
+                data = json.loads(text_data)
+            except ValueError:
+                return
+            strokes = extract_strokes(data)
+
+        if strokes is not None:
+            if strokes:
+                # Strokes are drawn by whoever is connected, whatever they say
+                user_id = self.user_id()
+                for stroke in strokes:
+                    stroke['user'] = user_id
+                strokes = simplify_strokes(strokes)
+                self.stroke_buffer.add(strokes)
+                await self.room.add(strokes)
+            return
+
+        if isinstance(data, dict) and data.get('type') == 'erase':
+            await self.erase(data.get('rect'))
+            return
+
+        if isinstance(data, dict) and data.get('type') == 'undo':
+            await self.undo()
+            return
+
+        # anything else is relayed as-is, after the strokes drawn before it
+        await self.room.flush()
         await self.channel_layer.group_send(
             self.room_group_name,
             {
@@ -31,9 +112,79 @@ class SketchConsumer(AsyncWebsocketConsumer):
             }
         )
 
+    async def erase(self, rect):
+        # persist the erase after the strokes buffered before it, then relay it
+        # (only if it erased something)
+        try:
+            rect = list(stroke_index.parse_rect(rect))
+        except (TypeError, ValueError):
+            return
+        await self.stroke_buffer.flush()
+        try:
+            erased, _ = await database_sync_to_async(stroke_store.erase_region)(self.sketch_id, rect, self.user_id())
+            if erased:
+                await database_sync_to_async(thumbnails.schedule)(self.sketch_id)
+        except Exception:
+            logger.exception("Failed to erase strokes of sketch %s", self.sketch_id)
+            return
+        if not erased:
+            return
+        await self.room.flush()
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'broadcast_draw',
+                'text': json.dumps({'type': 'erase', 'rect': rect})
+            }
+        )
+
+    async def undo(self):
+        # undo the user's last path or erase once their buffered strokes are
+        # stored, then have everyone reload the strokes
+        user_id = self.user_id()
+        if user_id is None:
+            return
+        await self.stroke_buffer.flush()
+        try:
+            undone, revision = await database_sync_to_async(stroke_store.undo)(self.sketch_id, user_id)
+            if undone:
+                await database_sync_to_async(thumbnails.schedule)(self.sketch_id)
+        except Exception:
+            logger.exception("Failed to undo strokes of sketch %s", self.sketch_id)
+            return
+        if not undone:
+            return
+        await self.room.flush()
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'broadcast_draw',
+                'text': json.dumps({'type': 'resync', 'revision': revision})
+            }
+        )
+
+    def user_id(self):
+        user = self.scope.get('user')
+        return user.id if user is not None and user.is_authenticated else None
+
     async def broadcast_draw(self, event):
         # send the draw data back to the WebSocket
-        await self.send(text_data=event['text'])
+        if 'text' in event:
+            await self.send(text_data=event['text'])
+            return
+        if self.binary and stroke_wire.can_encode(event['strokes']):
+            try:
+                frame = stroke_wire.encode_frame(event['strokes'])
+            except stroke_wire.WireFormatError:
+                logger.warning("Sending strokes of sketch %s as JSON: not encodable as a binary frame", self.sketch_id)
+            else:
+                await self.send(bytes_data=frame)
+                return
+        if self.batched or self.binary:
+            await self.send(text_data=json.dumps({'type': 'strokes', 'strokes': event['strokes']}))
+        else:
+            for stroke in event['strokes']:
+                await self.send(text_data=json.dumps(stroke))
 
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
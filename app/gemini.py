@@ -1,20 +1,139 @@
+"""
+Process-wide Gemini client.
+
+The library is configured once, from settings.GEMINI_API_KEY, and model
+objects are reused across calls. Every request goes through ``call``, which
+holds one of GEMINI_MAX_CONCURRENCY slots and takes a token from a bucket
+refilled at GEMINI_RPM requests per minute (bursts of up to GEMINI_BURST),
+so bursts queue here instead of failing with 429s. A 429 that still gets
+through is retried up to GEMINI_RETRIES times with exponential backoff.
+"""
+import io
+import logging
+import threading
+import time
+
 import google.generativeai as genai
-import os
-import base64
-from dotenv import load_dotenv
-
-load_dotenv()
-
-api_key = os.getenv("API_KEY")
-genai.configure(api_key=api_key)
-def prep_image(image_path):
-    """Uploads the image file to Gemini and returns the uploaded file object."""
-    sample_file = genai.upload_file(path=image_path, display_name="SketchOCR")
-    print(f"Uploaded file '{sample_file.display_name}' as: {sample_file.uri}")
+from django.conf import settings
+from google.api_core.exceptions import ResourceExhausted
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "gemini-2.5-flash"
+
+_lock = threading.Lock()
+_configured = False
+_models = {}
+_slots = None
+_bucket = None
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class TokenBucket:
+    """Blocking token bucket: ``rate`` tokens per second, up to ``capacity``."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available. Returns the time waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def _limiters():
+    global _configured, _slots, _bucket
+    if _configured:
+        return _slots, _bucket
+    with _lock:
+        if not _configured:
+            genai.configure(api_key=_setting("GEMINI_API_KEY", None))
+            _slots = threading.BoundedSemaphore(_setting("GEMINI_MAX_CONCURRENCY", 4))
+            _bucket = TokenBucket(_setting("GEMINI_RPM", 60) / 60.0, _setting("GEMINI_BURST", 10))
+            _configured = True
+    return _slots, _bucket
+
+
+def get_model(model_name=MODEL_NAME):
+    """The shared GenerativeModel for ``model_name``."""
+    _limiters()
+    model = _models.get(model_name)
+    if model is None:
+        with _lock:
+            model = _models.setdefault(model_name, genai.GenerativeModel(model_name=model_name))
+    return model
+
+
+def call(func, *args, **kwargs):
+    """Run a Gemini API call within the concurrency cap and rate limit."""
+    slots, bucket = _limiters()
+    retries = _setting("GEMINI_RETRIES", 2)
+    attempt = 0
+    while True:
+        with slots:
+            bucket.acquire()
+            try:
+                return func(*args, **kwargs)
+            except ResourceExhausted:
+                if attempt >= retries:
+                    raise
+        attempt += 1
+        time.sleep(2 ** attempt)
+
+
+def generate_content(contents, model_name=MODEL_NAME):
+    """``generate_content`` on the shared model; returns the response."""
+    return call(get_model(model_name).generate_content, contents)
+
+
+def generate_text(contents, model_name=MODEL_NAME):
+    """Text of the response to ``contents``."""
+    return generate_content(contents, model_name).text
+
+
+def prep_image(image, mime_type=None):
+    """
+    Uploads the image to Gemini and returns the uploaded file object.
+
+    ``image`` is a file path, or encoded image bytes together with their
+    ``mime_type``.
+    """
+    _limiters()
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    sample_file = call(genai.upload_file, path=image, mime_type=mime_type, display_name="SketchOCR")
+    logger.debug("Uploaded file '%s' as: %s", sample_file.display_name, sample_file.uri)
     return sample_file
 
+def delete_file(name):
+    """Delete an uploaded file by name ("files/...")."""
+    _limiters()
+    call(genai.delete_file, name)
+
+
 def extract_text_from_image(sample_file, prompt):
-    """Extracts text from image using Gemini with the given prompt."""
-    model = genai.GenerativeModel(model_name="gemini-2.5-flash")
-    response = model.generate_content([sample_file, prompt])
-    return response.text
\ No newline at end of file
+    """
+    Extracts text from image using Gemini with the given prompt.
+
+    ``sample_file`` is an uploaded file or a content part (see gemini_files),
+    or a list of them.
+    """
+    images = sample_file if isinstance(sample_file, list) else [sample_file]
+    return generate_text([*images, prompt])
@@ -0,0 +1,165 @@
+"""
+Image parts for Gemini requests: inline bytes or reused uploads.
+
+An image goes to Gemini either inline, base64-encoded inside the
+generate_content request, or uploaded through the Files API first and
+referred to by URI. The upload is a separate round trip before generation
+can start, so image_part picks:
+
+- the URI of an earlier upload of the same bytes (GeminiFile), while the
+  remote copy has more than GEMINI_FILE_EXPIRY_MARGIN seconds left;
+- inline bytes for images up to GEMINI_INLINE_MAX_BYTES, where the base64
+  overhead costs less than the extra round trip;
+- otherwise a new upload, whose handle is cached for the next request.
+
+The API deletes uploads after about 48 hours. A handle close to expiry is
+replaced by the next upload of the same bytes, and the upload it pointed at
+is recorded as a RetiredGeminiFile. collect_files deletes those uploads and
+the ones of expired handles, if still there, and the handles (see the
+collect_gemini_files command). Other files of the API key are left alone.
+"""
+import hashlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+from google.api_core.exceptions import NotFound
+
+from . import gemini
+from .models import GeminiFile, RetiredGeminiFile
+
+
+def inline_max_bytes():
+    return getattr(settings, "GEMINI_INLINE_MAX_BYTES", 1024 * 1024)
+
+
+def expiry_margin():
+    return timedelta(seconds=getattr(settings, "GEMINI_FILE_EXPIRY_MARGIN", 3600))
+
+
+def file_key(data, mime_type):
+    digest = hashlib.sha256()
+    digest.update(mime_type.encode())
+    digest.update(b"\0")
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def file_part(uri, mime_type):
+    return {"file_data": {"mime_type": mime_type, "file_uri": uri}}
+
+
+def inline_part(data, mime_type):
+    return {"mime_type": mime_type, "data": bytes(data)}
+
+
+def lookup_file(data, mime_type):
+    """The cached upload of ``data`` that stays valid for the expiry margin (counted as a hit), or None."""
+    handle = GeminiFile.objects.filter(
+        key=file_key(data, mime_type), expires_at__gt=timezone.now() + expiry_margin(),
+    ).first()
+    if handle is not None:
+        GeminiFile.objects.filter(pk=handle.pk).update(hit_count=F("hit_count") + 1)
+    return handle
+
+
+def _expiration(uploaded):
+    expires = getattr(uploaded, "expiration_time", None)
+    if not expires or expires.year < 2000:  # unset in the response
+        return timezone.now() + timedelta(hours=47)
+    return datetime.fromtimestamp(expires.timestamp(), tz=dt_timezone.utc)
+
+
+def upload_file(data, mime_type):
+    """
+    Upload ``data`` and cache its handle; returns the GeminiFile. The upload
+    of a handle this replaces is retired.
+    """
+    uploaded = gemini.prep_image(data, mime_type=mime_type)
+    key = file_key(data, mime_type)
+    fields = {
+        "name": uploaded.name,
+        "uri": uploaded.uri,
+        "mime_type": mime_type,
+        "size": len(data),
+        "expires_at": _expiration(uploaded),
+    }
+    with transaction.atomic():
+        handle = GeminiFile.objects.select_for_update().filter(key=key).first()
+        if handle is None:
+            try:
+                with transaction.atomic():
+                    return GeminiFile.objects.create(key=key, **fields)
+            except IntegrityError:
+                # Uploaded concurrently by another worker
+                handle = GeminiFile.objects.select_for_update().get(key=key)
+        if handle.name != uploaded.name:
+            RetiredGeminiFile.objects.create(name=handle.name)
+        for field, value in fields.items():
+            setattr(handle, field, value)
+        handle.save(update_fields=list(fields))
+    return handle
+
+
+def image_part(data, mime_type):
+    """
+    The content part to send ``data`` with, and how it is sent: "file"
+    (earlier upload), "inline" or "upload" (uploaded now).
+    """
+    handle = lookup_file(data, mime_type)
+    if handle is not None:
+        return file_part(handle.uri, handle.mime_type), "file"
+    if len(data) <= inline_max_bytes():
+        return inline_part(data, mime_type), "inline"
+    handle = upload_file(data, mime_type)
+    return file_part(handle.uri, handle.mime_type), "upload"
+
+
+def _delete_remote(name):
+    """Delete an upload; False when the API already had."""
+    try:
+        gemini.delete_file(name)
+    except NotFound:
+        return False
+    return True
+
+
+def collect_files(dry_run=False):
+    """
+    Delete the remote uploads of replaced handles and of expired handles,
+    then the expired handles.
+
+    Returns (handles dropped, remote files deleted). A dry run counts every
+    one of those uploads as deleted.
+    """
+    dropped = deleted = 0
+    for retired in RetiredGeminiFile.objects.all():
+        if dry_run:
+            deleted += 1
+            continue
+        deleted += _delete_remote(retired.name)
+        retired.delete()
+
+    for handle in GeminiFile.objects.filter(expires_at__lte=timezone.now()):
+        if dry_run:
+            dropped += 1
+            deleted += 1
+            continue
+        deleted += _delete_remote(handle.name)
+        # Conditional delete: a handle refreshed by a new upload meanwhile
+        # stays (and the upload deleted here was retired by it)
+        dropped += GeminiFile.objects.filter(pk=handle.pk, name=handle.name).delete()[0]
+    return dropped, deleted
+
+
+def cache_stats():
+    """Size and hit count of the upload handle cache."""
+    totals = GeminiFile.objects.aggregate(entries=Count("id"), hits=Sum("hit_count"), size=Sum("size"))
+    return {
+        "entries": totals["entries"],
+        "live": GeminiFile.objects.filter(expires_at__gt=timezone.now() + expiry_margin()).count(),
+        "bytes": totals["size"] or 0,
+        "hits": totals["hits"] or 0,
+    }
@@ -0,0 +1,241 @@
+"""
+Database-backed background jobs with a local worker pool.
+
+Slow work (Gemini calls, gTTS) is recorded as a Job row and run by worker
+threads in the same process, so HTTP workers return immediately and clients
+poll the job's status. No external broker is needed: workers claim jobs with
+a conditional UPDATE, which is safe across processes sharing the database.
+
+Failed jobs are retried with exponential backoff up to ``max_attempts``.
+While a job runs, its worker refreshes ``locked_at`` every
+JOB_HEARTBEAT_INTERVAL seconds, so jobs whose ``locked_at`` is older than
+JOB_STALE_AFTER seconds were left "running" by a dead worker; they are
+re-queued, and finished jobs older than JOB_RETENTION seconds are deleted
+(see cleanup, also run periodically by the workers).
+
+Web processes start their JOB_WORKERS worker threads when they serve their
+first request (or enqueue a job); the run_jobs command runs workers in a
+process of their own.
+
+Handlers are registered with the ``handler`` decorator (see tasks.py) and
+receive the job payload; whatever they return is stored as the job result.
+"""
+import logging
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import close_old_connections, connection
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+_wakeup = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+class PermanentJobError(Exception):
+    """Raise from a handler to fail the job without retrying."""
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def handler(kind):
+    """Register the decorated function as the handler for jobs of ``kind``."""
+    def register(func):
+        _handlers[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind, payload, user=None, sketch=None, max_attempts=None, delay=0):
+    """Create a queued job, runnable in ``delay`` seconds, and wake up the local workers."""
+    if kind not in _handlers:
+        raise ValueError(f"No handler registered for job kind '{kind}'")
+    job = Job.objects.create(
+        kind=kind,
+        payload=payload,
+        created_by=user,
+        sketch=sketch,
+        max_attempts=max_attempts or _setting("JOB_MAX_ATTEMPTS", 3),
+        run_after=timezone.now() + timedelta(seconds=delay),
+    )
+    ensure_workers()
+    wake()
+    return job
+
+
+def enqueue_once(kind, payload, user=None, sketch=None, delay=0):
+    """
+    Like enqueue, but returns the queued job of ``kind`` with the same
+    payload instead when there is one. A job that already started may have
+    read older data, so it doesn't count.
+
+    With a ``delay``, every request made within ``delay`` seconds of the
+    first one is answered by that one job (a debounce).
+    """
+    queued = Job.objects.filter(kind=kind, payload=payload, status=Job.QUEUED).first()
+    return queued or enqueue(kind, payload, user=user, sketch=sketch, delay=delay)
+
+
+def wake():
+    """Make idle workers of this process poll the queue now."""
+    _wakeup.set()
+
+
+def claim_next(worker_id):
+    """Atomically mark the oldest runnable job as running and return it, or None."""
+    now = timezone.now()
+    candidates = (
+        Job.objects.filter(status=Job.QUEUED, run_after__lte=now)
+        .order_by("run_after", "id")
+        .values_list("id", flat=True)[:5]
+    )
+    for job_id in candidates:
+        claimed = Job.objects.filter(id=job_id, status=Job.QUEUED).update(
+            status=Job.RUNNING,
+            locked_at=now,
+            locked_by=worker_id,
+            attempts=F("attempts") + 1,
+        )
+        if claimed:
+            return Job.objects.get(id=job_id)
+    return None
+
+
+def heartbeat(job):
+    """Mark a running job as still locked by its worker; False once it lost the lock."""
+    return bool(Job.objects.filter(id=job.id, status=Job.RUNNING, locked_by=job.locked_by).update(
+        locked_at=timezone.now(),
+    ))
+
+
+def _beat(job, done):
+    interval = _setting("JOB_HEARTBEAT_INTERVAL", 60)
+    try:
+        while not done.wait(interval):
+            try:
+                if not heartbeat(job):
+                    return
+            except Exception:
+                logger.exception("Heartbeat of job %s failed", job.id)
+    finally:
+        connection.close()
+
+
+def run_job(job):
+    """Run a claimed job and record its result, retry or failure."""
+    func = _handlers.get(job.kind)
+    done = threading.Event()
+    beat = threading.Thread(target=_beat, args=(job, done), name=f"job-heartbeat-{job.id}", daemon=True)
+    beat.start()
+    try:
+        if func is None:
+            raise PermanentJobError(f"No handler registered for job kind '{job.kind}'")
+        result = func(**job.payload)
+    except Exception as e:
+        retry = not isinstance(e, PermanentJobError) and job.attempts < job.max_attempts
+        if retry:
+            delay = _setting("JOB_RETRY_DELAY", 5) * (2 ** (job.attempts - 1))
+            logger.warning("Job %s (%s) failed, retrying in %ss: %s", job.id, job.kind, delay, e)
+            Job.objects.filter(id=job.id).update(
+                status=Job.QUEUED,
+                run_after=timezone.now() + timedelta(seconds=delay),
+                error=str(e),
+                locked_at=None,
+                locked_by="",
+            )
+        else:
+            logger.exception("Job %s (%s) failed", job.id, job.kind)
+            Job.objects.filter(id=job.id).update(
+                status=Job.FAILED,
+                error=str(e),
+                finished_at=timezone.now(),
+            )
+        return
+    finally:
+        done.set()
+        beat.join()
+
+    Job.objects.filter(id=job.id).update(
+        status=Job.DONE,
+        result=result,
+        error="",
+        finished_at=timezone.now(),
+    )
+
+
+def cleanup():
+    """Re-queue jobs abandoned by dead workers and delete old finished jobs."""
+    now = timezone.now()
+    stale = now - timedelta(seconds=_setting("JOB_STALE_AFTER", 600))
+    requeued = Job.objects.filter(status=Job.RUNNING, locked_at__lt=stale, attempts__lt=F("max_attempts")).update(
+        status=Job.QUEUED, locked_at=None, locked_by="", run_after=now,
+    )
+    abandoned = Job.objects.filter(status=Job.RUNNING, locked_at__lt=stale).update(
+        status=Job.FAILED, error="Worker stopped while running the job", finished_at=now,
+    )
+    expired = now - timedelta(seconds=_setting("JOB_RETENTION", 7 * 24 * 3600))
+    deleted, _ = Job.objects.filter(status__in=[Job.DONE, Job.FAILED], finished_at__lt=expired).delete()
+    return {"requeued": requeued, "failed": abandoned, "deleted": deleted}
+
+
+def work(worker_id, stop=None, idle_exit=False):
+    """
+    Worker loop: claim and run jobs until ``stop`` is set.
+
+    With ``idle_exit`` the loop returns as soon as the queue is empty.
+    """
+    poll = _setting("JOB_POLL_INTERVAL", 2.0)
+    cleanup_every = _setting("JOB_CLEANUP_INTERVAL", 300)
+    last_cleanup = 0.0
+    while stop is None or not stop.is_set():
+        close_old_connections()
+        try:
+            if time.monotonic() - last_cleanup > cleanup_every:
+                last_cleanup = time.monotonic()
+                cleanup()
+            job = claim_next(worker_id)
+            if job is not None:
+                run_job(job)
+                continue
+        except Exception:
+            logger.exception("Job worker %s crashed, continuing", worker_id)
+        finally:
+            close_old_connections()
+        if idle_exit:
+            return
+        _wakeup.wait(poll)
+        _wakeup.clear()
+
+
+def ensure_workers():
+    """Start the local worker threads (JOB_WORKERS of them) once per process."""
+    count = _setting("JOB_WORKERS", 2)
+    with _workers_lock:
+        if _workers or count <= 0:
+            return
+        prefix = uuid.uuid4().hex[:8]
+        for i in range(count):
+            thread = threading.Thread(
+                target=work, args=(f"{prefix}-{i}",), name=f"job-worker-{i}", daemon=True,
+            )
+            thread.start()
+            _workers.append(thread)
+
+
+@receiver(request_started)
+def _start_workers(sender, **kwargs):
+    if not _workers:
+        ensure_workers()
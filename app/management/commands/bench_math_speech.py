@@ -0,0 +1,82 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.audio_generator import MathToSpeech
+from app.tests.math_speech_reference import MathToSpeech as ReferenceMathToSpeech
+from app.models import Sketch
+
+PROSE = [
+    "We start from the expression written in the sketch and simplify it step by step.",
+    "This means the two sides must be equal, which gives us the value of the unknown.",
+    "The collaborator in red corrected the sign in the second line, which is right.",
+    "Remember to check the units at the end; the answer is given in square centimetres.",
+]
+MATH = [
+    "$\\frac{d}{dx}(x^n) = nx^{n-1}$", "dy/dx = 2x", "d/dx (x^3) = 3x^2", "x^{2}/2 + C",
+    "x₁ + x₂ = 5", "x_1 × x_2 = 6", "a_{n+1} ≥ a_n", "∫ x² dx = x³/3", "3/4 + 1.5 / 0.5",
+    "α + β + γ = 180°", "Δx ≈ 0.5", "θ → 0", "√16 = 4 ± 0", "∑ k = n(n+1)/2", "10² = 100 cm²",
+    "**Step 2:**", "`E = mc^2`", "### Answer",
+]
+
+
+def explanation(rng, size):
+    """A generated explanation of about ``size`` characters mixing prose and math."""
+    lines = []
+    length = 0
+    while length < size:
+        words = rng.choice(PROSE).split()
+        for _ in range(rng.randint(1, 3)):
+            words.insert(rng.randrange(len(words) + 1), rng.choice(MATH))
+        line = " ".join(words)
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+class Command(BaseCommand):
+    help = "Time MathToSpeech.convert against the original converter on long and math-dense explanations."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="2000,20000,200000",
+                            help="Comma-separated explanation lengths in characters")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        converter = MathToSpeech()
+        reference = ReferenceMathToSpeech()
+        rng = random.Random(options["seed"])
+        texts = [
+            (f"generated {size}", explanation(rng, size))
+            for size in (int(s) for s in options["sizes"].split(","))
+        ]
+        texts.append(("math only", " ".join(rng.choice(MATH) for _ in range(20000))))
+        # Unclosed groups, which make the original patterns backtrack
+        texts.append(('"x^{" x 5000', "x^{" * 5000))
+        stored = "\n\n".join(
+            Sketch.objects.exclude(ocr_explanation__isnull=True).exclude(ocr_explanation="")
+            .values_list("ocr_explanation", flat=True)
+        )
+        if stored:
+            texts.append(("stored explanations", stored))
+
+        self.stdout.write(f"{'text':<22} {'chars':>8} {'original ms':>12} {'convert ms':>11} {'speedup':>8}")
+        for name, text in texts:
+            if reference.convert(text) != converter.convert(text):
+                self.stderr.write(f"{name}: output differs from the original converter")
+            original_ms = self._time(reference.convert, text)
+            fast_ms = self._time(converter.convert, text)
+            self.stdout.write(
+                f"{name:<22} {len(text):>8} {original_ms:>12.3f} {fast_ms:>11.3f} {original_ms / fast_ms:>7.1f}x"
+            )
+
+    def _time(self, func, text, min_time=0.3):
+        """Best milliseconds per call over batches run for at least min_time."""
+        best = float("inf")
+        start = time.perf_counter()
+        while time.perf_counter() - start < min_time:
+            t0 = time.perf_counter()
+            func(text)
+            best = min(best, time.perf_counter() - t0)
+        return best * 1000
@@ -0,0 +1,144 @@
+import io
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from PIL import Image
+
+from app import gemini, gemini_files, ocr_image
+from app.models import GeminiFile, Sketch
+
+TILE = 768          # Gemini splits larger images into 768 px tiles
+TILE_TOKENS = 258   # input tokens per tile (or per image up to 384 px)
+
+
+def image_tokens(width, height):
+    if width <= 384 and height <= 384:
+        return TILE_TOKENS
+    return -(-width // TILE) * -(-height // TILE) * TILE_TOKENS
+
+
+class StandIn:
+    """
+    Local stand-in for google.generativeai: every request costs RTT plus its
+    bytes at ``bandwidth`` Mbit/s (inline images base64-encoded), generation
+    adds a fixed decode time and ``token_ms`` per input image token.
+    """
+
+    def __init__(self, bandwidth, rtt, decode, token_ms):
+        self.bandwidth = bandwidth
+        self.rtt = rtt
+        self.decode = decode
+        self.token_ms = token_ms
+        self.uploads = {}  # uri -> image tokens
+
+    def _send(self, size):
+        time.sleep(self.rtt + size * 8 / (self.bandwidth * 1e6))
+
+    def configure(self, **kwargs):
+        pass
+
+    def upload_file(self, path, mime_type=None, display_name=None):
+        data = path.read() if hasattr(path, "read") else open(path, "rb").read()
+        self._send(len(data))
+        uri = f"local://standin/{len(self.uploads)}"
+        self.uploads[uri] = image_tokens(*Image.open(io.BytesIO(data)).size)
+        return SimpleNamespace(name=f"files/{len(self.uploads)}", display_name=display_name, uri=uri,
+                               expiration_time=datetime.now(timezone.utc) + timedelta(hours=48))
+
+    def GenerativeModel(self, model_name):
+        def generate_content(contents):
+            tokens = size = 0
+            for part in contents:
+                if isinstance(part, dict) and "data" in part:
+                    size += len(part["data"]) * 4 // 3
+                    tokens += image_tokens(*Image.open(io.BytesIO(part["data"])).size)
+                elif isinstance(part, dict) and "file_data" in part:
+                    tokens += self.uploads[part["file_data"]["file_uri"]]
+                elif hasattr(part, "uri"):
+                    tokens += self.uploads[part.uri]
+            self._send(size)
+            time.sleep(self.decode + tokens * self.token_ms / 1000)
+            return SimpleNamespace(text="ok")
+        return SimpleNamespace(generate_content=generate_content)
+
+
+class Command(BaseCommand):
+    help = "Compare sending sketch images as stored and after ocr_image preprocessing (uploaded, inline, reused upload) to a local Gemini stand-in."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bandwidth", type=float, default=10.0, help="Upload Mbit/s")
+        parser.add_argument("--rtt", type=float, default=0.05, help="Seconds per request round trip")
+        parser.add_argument("--decode", type=float, default=0.5, help="Seconds of output generation")
+        parser.add_argument("--token-ms", type=float, default=0.5, help="Milliseconds per input image token")
+
+    def handle(self, *args, **options):
+        sketches = []
+        for sketch in Sketch.objects.exclude(image="").order_by("id"):
+            if sketch.image.storage.exists(sketch.image.name):
+                with sketch.image.open("rb") as f:
+                    sketches.append((sketch, f.read()))
+        if not sketches:
+            self.stdout.write("No sketch images in the database.")
+            return
+
+        stand_in = StandIn(options["bandwidth"], options["rtt"], options["decode"], options["token_ms"])
+        real_genai = gemini.genai
+        gemini.genai = stand_in
+        gemini._configured = False
+        gemini._models.clear()
+        try:
+            with override_settings(GEMINI_RPM=1e9, GEMINI_BURST=10 ** 9):
+                self._run(sketches)
+        finally:
+            GeminiFile.objects.filter(uri__startswith="local://").delete()
+            gemini.genai = real_genai
+            gemini._configured = False
+            gemini._models.clear()
+
+    def _ocr(self, sketch, original):
+        """Seconds to prepare and send one image via gemini_files."""
+        start = time.perf_counter()
+        prepared = ocr_image.prepare(sketch, original)
+        part, sent_as = gemini_files.image_part(prepared.data, prepared.mime_type)
+        gemini.extract_text_from_image(part, "prompt")
+        return time.perf_counter() - start, prepared, sent_as
+
+    def _run(self, sketches):
+        self.stdout.write(
+            f"{'sketch':>6} {'stored':>10} {'B':>7} {'prepared':>10} {'B':>6} {'prep ms':>8} "
+            f"{'stored+upload':>14} {'upload':>7} {'inline':>7} {'reuse':>7}"
+        )
+        totals = [0, 0, 0.0, 0.0, 0.0, 0.0]
+        for sketch, original in sketches:
+            before_size = Image.open(io.BytesIO(original)).size
+
+            # As before: the stored image, uploaded first
+            start = time.perf_counter()
+            gemini.extract_text_from_image(gemini.prep_image(original, mime_type="image/png"), "prompt")
+            before = time.perf_counter() - start
+
+            start = time.perf_counter()
+            ocr_image.prepare(sketch, original)
+            prep = time.perf_counter() - start
+
+            inline, prepared, _ = self._ocr(sketch, original)
+            with override_settings(GEMINI_INLINE_MAX_BYTES=-1):
+                upload, _, _ = self._ocr(sketch, original)
+                reuse, _, sent_as = self._ocr(sketch, original)
+            assert sent_as == "file"
+
+            for i, value in enumerate((len(original), len(prepared.data), before, upload, inline, reuse)):
+                totals[i] += value
+            self.stdout.write(
+                f"{sketch.id:>6} {'%dx%d' % before_size:>10} {len(original):>7} "
+                f"{'%dx%d' % (prepared.width, prepared.height):>10} {len(prepared.data):>6} "
+                f"{prep * 1000:>8.1f} {before:>13.3f}s {upload:>6.3f}s {inline:>6.3f}s {reuse:>6.3f}s"
+            )
+        self.stdout.write(
+            f"total: {totals[0]} -> {totals[1]} bytes ({totals[1] / totals[0]:.1%}); end-to-end "
+            f"stored+upload {totals[2]:.2f}s, prepared+upload {totals[3]:.2f}s, "
+            f"inline {totals[4]:.2f}s, reused upload {totals[5]:.2f}s"
+        )
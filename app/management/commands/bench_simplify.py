@@ -0,0 +1,60 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from app import stroke_codec
+from app.models import Sketch
+from app.sketch_render import render_polylines
+from app.stroke_simplify import simplify_polylines, simplify_tolerance
+
+
+class Command(BaseCommand):
+    help = "Measure RDP stroke simplification: point reduction, time per stroke and pixel difference."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tolerance", type=float, default=None,
+                            help="Tolerance in px (default: STROKE_SIMPLIFY_TOLERANCE)")
+
+    def handle(self, *args, **options):
+        tolerance = options["tolerance"]
+        if tolerance is None:
+            tolerance = simplify_tolerance()
+
+        self.stdout.write(f"tolerance {tolerance}px")
+        self.stdout.write(
+            f"{'sketch':>6} {'strokes':>8} {'points':>8} {'kept':>8} {'ratio':>6} "
+            f"{'us/stroke':>10} {'px diff':>8}"
+        )
+        total_before = total_after = total_strokes = 0
+        total_time = 0.0
+        for sketch in Sketch.objects.all().order_by("id"):
+            polylines = stroke_codec.decode_polylines(sketch.strokes_packed)
+            if not polylines:
+                continue
+            start = time.perf_counter()
+            simplified = simplify_polylines(polylines, tolerance)
+            elapsed = time.perf_counter() - start
+
+            before = sum(len(p.points) for p in polylines)
+            after = sum(len(p.points) for p in simplified)
+
+            # Share of pixels that differ once both versions are rendered
+            original = np.asarray(render_polylines(polylines))
+            reduced = np.asarray(render_polylines(simplified, size=original.shape[1::-1]))
+            diff = np.any(original != reduced, axis=2).mean()
+
+            total_before += before
+            total_after += after
+            total_strokes += len(polylines)
+            total_time += elapsed
+            self.stdout.write(
+                f"{sketch.id:>6} {len(polylines):>8} {before:>8} {after:>8} "
+                f"{before / after:>6.2f} {elapsed / len(polylines) * 1e6:>10.1f} {diff:>8.2%}"
+            )
+
+        if total_after:
+            self.stdout.write(
+                f"total: {total_before} -> {total_after} points ({total_before / total_after:.2f}x), "
+                f"{total_time / total_strokes * 1e6:.1f}us per stroke"
+            )
@@ -0,0 +1,62 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from app import stroke_codec
+from app.models import Sketch
+
+
+def _best_of(repeat, func, *args):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+class Command(BaseCommand):
+    help = "Compare JSON and packed stroke storage: size and encode/decode time."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--sketch", type=int, action="append",
+                            help="Only benchmark these sketch ids")
+
+    def handle(self, *args, **options):
+        repeat = options["repeat"]
+        sketches = Sketch.objects.all().order_by("id")
+        if options["sketch"]:
+            sketches = sketches.filter(id__in=options["sketch"])
+
+        self.stdout.write(
+            f"{'sketch':>6} {'segs':>7} {'json B':>9} {'packed B':>9} {'ratio':>6} "
+            f"{'json enc':>9} {'pack enc':>9} {'json dec':>9} {'pack dec':>9}"
+        )
+        totals = [0, 0]
+        for sketch in sketches:
+            strokes = sketch.strokes
+            if not strokes:
+                continue
+            json_enc, json_blob = _best_of(repeat, json.dumps, strokes)
+            json_dec, _ = _best_of(repeat, json.loads, json_blob)
+            pack_enc, packed = _best_of(repeat, stroke_codec.encode_strokes, strokes)
+            pack_dec, _ = _best_of(repeat, stroke_codec.decode_strokes, packed)
+
+            json_size = len(json_blob.encode("utf-8"))
+            totals[0] += json_size
+            totals[1] += len(packed)
+            self.stdout.write(
+                f"{sketch.id:>6} {len(strokes):>7} {json_size:>9} {len(packed):>9} "
+                f"{json_size / len(packed):>6.1f} "
+                f"{json_enc * 1e3:>7.2f}ms {pack_enc * 1e3:>7.2f}ms "
+                f"{json_dec * 1e3:>7.2f}ms {pack_dec * 1e3:>7.2f}ms"
+            )
+
+        if totals[1]:
+            self.stdout.write(
+                f"total: json {totals[0]} B, packed {totals[1]} B "
+                f"({totals[0] / totals[1]:.1f}x smaller)"
+            )
@@ -0,0 +1,62 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from app import stroke_wire
+from app.models import Sketch
+
+
+def _rate(func, items, min_time=0.2):
+    """Calls per second of func over items, repeated for at least min_time."""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for item in items:
+            func(item)
+        count += len(items)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+
+class Command(BaseCommand):
+    help = "Compare JSON and binary WebSocket stroke frames: bytes per stroke and messages/s."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=64,
+                            help="Segments per batched frame")
+
+    def handle(self, *args, **options):
+        batch = options["batch"]
+        strokes = []
+        for sketch in Sketch.objects.all().order_by("id"):
+            strokes.extend(sketch.strokes)
+        if not strokes:
+            self.stdout.write("No strokes in the database.")
+            return
+        frames = [strokes[i:i + batch] for i in range(0, len(strokes), batch)]
+
+        single = [json.dumps(s) for s in strokes]
+        batched = [json.dumps({"type": "strokes", "strokes": f}) for f in frames]
+        binary = [stroke_wire.encode_frame(f) for f in frames]
+
+        rows = [
+            ("json (1 per msg)", single, strokes, json.dumps, json.loads),
+            (f"json (batch {batch})", batched, frames,
+             lambda f: json.dumps({"type": "strokes", "strokes": f}), json.loads),
+            (f"binary (batch {batch})", binary, frames,
+             stroke_wire.encode_frame, stroke_wire.decode_frame),
+        ]
+
+        self.stdout.write(f"{len(strokes)} segments from the database\n")
+        self.stdout.write(f"{'encoding':<22} {'B/segment':>10} {'enc msg/s':>12} {'dec msg/s':>12} {'dec seg/s':>12}")
+        for name, encoded, messages, encode, decode in rows:
+            size = sum(len(m) for m in encoded)
+            enc_rate = _rate(encode, messages)
+            dec_rate = _rate(decode, encoded)
+            per_msg = len(strokes) / len(messages)
+            self.stdout.write(
+                f"{name:<22} {size / len(strokes):>10.1f} {enc_rate:>12.0f} "
+                f"{dec_rate:>12.0f} {dec_rate * per_msg:>12.0f}"
+            )
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from app import audio_cache, speech_cache
+
+
+class Command(BaseCommand):
+    help = "Delete cached audio blobs no sketch refers to any more, and stale sentence segments."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace", type=int, default=None,
+                            help="Seconds a blob must have been unreferenced (default: AUDIO_BLOB_GRACE)")
+        parser.add_argument("--segment-ttl", type=int, default=None,
+                            help="Seconds a sentence segment may go unused (default: AUDIO_SEGMENT_TTL)")
+        parser.add_argument("--recount", action="store_true",
+                            help="Recompute reference counts from the sketches first")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Report what would be deleted without deleting it")
+
+    def handle(self, *args, **options):
+        if options["recount"]:
+            fixed = audio_cache.recount()
+            self.stdout.write(f"fixed {fixed} reference count(s)")
+
+        blobs, size = audio_cache.collect_garbage(grace=options["grace"], dry_run=options["dry_run"])
+        verb = "would delete" if options["dry_run"] else "deleted"
+        self.stdout.write(f"{verb} {blobs} blob(s), {size / 1024:.1f} KiB")
+
+        segments, size = speech_cache.collect(ttl=options["segment_ttl"], dry_run=options["dry_run"])
+        self.stdout.write(f"{verb} {segments} sentence segment(s), {size / 1024:.1f} KiB")
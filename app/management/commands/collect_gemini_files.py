@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from app import gemini_files
+
+
+class Command(BaseCommand):
+    help = "Delete the Gemini uploads of replaced and expired handles, and the expired handles."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Report what would be deleted without deleting it")
+
+    def handle(self, *args, **options):
+        dropped, deleted = gemini_files.collect_files(dry_run=options["dry_run"])
+        verb = "would delete" if options["dry_run"] else "deleted"
+        self.stdout.write(f"{verb} {dropped} expired handle(s) and {deleted} remote file(s)")
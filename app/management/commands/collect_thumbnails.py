@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from app import thumbnails
+
+
+class Command(BaseCommand):
+    help = "Delete thumbnails of sketch images no sketch shows any more."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace", type=int, default=3600,
+                            help="Seconds a thumbnail must exist before it can be deleted")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Report what would be deleted without deleting it")
+
+    def handle(self, *args, **options):
+        count, size = thumbnails.collect(grace=options["grace"], dry_run=options["dry_run"])
+        verb = "would delete" if options["dry_run"] else "deleted"
+        self.stdout.write(f"{verb} {count} thumbnail(s), {size / 1024:.1f} KiB")
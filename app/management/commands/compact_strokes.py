@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app import stroke_codec, stroke_log, stroke_store
+from app.models import Sketch
+
+
+class Command(BaseCommand):
+    help = ("Snapshot sketch strokes, drop the stroke log history older than the kept snapshots "
+            "and expire idle append clients.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("sketch_ids", nargs="*", type=int, help="Sketches to compact (default: all)")
+        parser.add_argument("--keep", type=int, help="Snapshots to keep per sketch (default STROKE_SNAPSHOTS_KEPT)")
+        parser.add_argument("--verify", action="store_true",
+                            help="Check that replaying the log gives each sketch's current strokes first")
+
+    def handle(self, *args, **options):
+        sketches = Sketch.objects.order_by("id")
+        if options["sketch_ids"]:
+            sketches = sketches.filter(id__in=options["sketch_ids"])
+
+        total_ops = total_snapshots = 0
+        for sketch in sketches.only("id", "strokes_packed", "stroke_revision"):
+            if options["verify"]:
+                try:
+                    replayed = stroke_log.load(sketch.id, sketch.stroke_revision)
+                except stroke_log.HistoryUnavailable as e:
+                    raise CommandError(str(e))
+                if stroke_codec.decode_strokes(replayed) != stroke_codec.decode_strokes(sketch.strokes_packed):
+                    raise CommandError(f"Stroke log of sketch {sketch.id} does not match its strokes")
+            revision, ops, snapshots = stroke_log.compact(sketch.id, keep=options["keep"])
+            total_ops += ops
+            total_snapshots += snapshots
+            self.stdout.write(f"sketch {sketch.id}: snapshot at revision {revision}, "
+                              f"deleted {ops} op(s) and {snapshots} snapshot(s)")
+        self.stdout.write(f"deleted {total_ops} op(s) and {total_snapshots} snapshot(s)")
+        clients = stroke_store.expire_clients() if not options["sketch_ids"] else sum(
+            stroke_store.expire_clients(sketch_id) for sketch_id in options["sketch_ids"]
+        )
+        self.stdout.write(f"expired {clients} idle append client(s)")
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from app import thumbnails
+from app.models import Sketch
+
+
+class Command(BaseCommand):
+    help = "Make the missing thumbnails of sketches (all by default), e.g. for sketches saved before thumbnails existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("sketch_ids", nargs="*", type=int, help="Sketches to update (default: all)")
+
+    def handle(self, *args, **options):
+        sketches = Sketch.objects.select_related("book").order_by("id")
+        if options["sketch_ids"]:
+            sketches = sketches.filter(id__in=options["sketch_ids"])
+        for sketch in sketches.iterator():
+            try:
+                key = thumbnails.update_sketch(sketch)
+            except Exception as e:
+                self.stderr.write(f"sketch {sketch.id}: {e}")
+                continue
+            self.stdout.write(f"sketch {sketch.id}: {key[:12] or 'no image'}")
@@ -0,0 +1,50 @@
+import threading
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from app import jobs
+
+
+class Command(BaseCommand):
+    help = "Run background jobs (OCR, audio) in a dedicated worker process."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of worker threads (default: 1)")
+        parser.add_argument("--once", action="store_true",
+                            help="Run the queued jobs and exit when the queue is empty")
+        parser.add_argument("--cleanup", action="store_true",
+                            help="Only re-queue stale jobs and delete expired ones")
+
+    def handle(self, *args, **options):
+        if options["cleanup"]:
+            counts = jobs.cleanup()
+            self.stdout.write(
+                f"requeued {counts['requeued']}, failed {counts['failed']}, deleted {counts['deleted']}"
+            )
+            return
+
+        prefix = uuid.uuid4().hex[:8]
+        stop = threading.Event()
+        threads = [
+            threading.Thread(
+                target=jobs.work,
+                args=(f"{prefix}-{i}",),
+                kwargs={"stop": stop, "idle_exit": options["once"]},
+                name=f"job-worker-{i}",
+            )
+            for i in range(max(1, options["workers"]))
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f"{len(threads)} job worker(s) started")
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            stop.set()
+            jobs.wake()
+            for thread in threads:
+                thread.join()
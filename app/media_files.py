@@ -0,0 +1,200 @@
+"""
+Serving of uploaded and generated media (sketch images, audio).
+
+Every response carries an ETag (inode, mtime and size of the file) and
+Last-Modified, and If-None-Match / If-Modified-Since get a 304. Files whose
+name contains a content hash, such as the audio blobs
+(``audio_summaries/<sha256>.mp3``), never change under that name and are sent
+with a year-long immutable Cache-Control; everything else is revalidated.
+Both are private: the serve_media view only hands files to the users with
+access to a sketch using them (see access.can_access_media).
+
+The bytes themselves are handed off when the front server can send them:
+
+- MEDIA_ACCEL_REDIRECT (e.g. "/protected-media/", an nginx ``internal``
+  location aliased to MEDIA_ROOT) answers with an X-Accel-Redirect to the
+  file, and nginx serves it, Range requests included;
+- MEDIA_X_SENDFILE answers with X-Sendfile and the file's absolute path
+  (Apache mod_xsendfile, lighttpd).
+
+Otherwise the file is sent by Django with a single "bytes=" Range answered
+as 206 (multi-range requests get the whole file) so audio players can seek.
+The response wraps the open file, so WSGI servers with a sendfile-capable
+``wsgi.file_wrapper`` (gunicorn) copy it in the kernel instead of a worker
+reading it block by block.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+
+BLOCK_SIZE = 64 * 1024
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+_HASHED = re.compile(r"[0-9a-f]{32,}")
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def accel_redirect_prefix():
+    return getattr(settings, "MEDIA_ACCEL_REDIRECT", "")
+
+
+def use_sendfile():
+    return getattr(settings, "MEDIA_X_SENDFILE", False)
+
+
+def immutable_max_age():
+    return getattr(settings, "MEDIA_IMMUTABLE_MAX_AGE", 365 * 24 * 3600)
+
+
+def is_content_hashed(name):
+    """True when the file name contains a hex digest of at least 128 bits."""
+    stem = os.path.splitext(os.path.basename(name))[0]
+    return bool(_HASHED.search(stem))
+
+
+def file_etag(stat):
+    return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_range(header, size):
+    """
+    The (start, end) byte positions, end inclusive, of a single-range
+    ``Range`` header; None when the whole file should be sent.
+    Raises RangeNotSatisfiable.
+    """
+    match = _RANGE.match((header or "").strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start > end:
+            if start >= size:
+                raise RangeNotSatisfiable(header)
+            return None  # last < first: syntactically invalid, ignore it
+    else:
+        length = int(last)
+        if not length:
+            raise RangeNotSatisfiable(header)
+        start, end = max(0, size - length), size - 1
+    if size == 0:
+        raise RangeNotSatisfiable(header)
+    return start, end
+
+
+class _FileRange:
+    """``length`` bytes of an open file from its current position."""
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        # Lets a sendfile-capable file_wrapper send Content-Length bytes from here
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def _matches(header, etag):
+    return header.strip() == "*" or etag in [t.strip() for t in header.split(",")]
+
+
+def _not_modified(request, etag, mtime):
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        return _matches(if_none_match, etag)
+    since = parse_http_date_safe(request.headers.get("If-Modified-Since") or "")
+    return since is not None and int(mtime) <= since
+
+
+def _range_applies(request, etag, mtime):
+    """Whether an If-Range precondition (if any) still holds."""
+    if_range = request.headers.get("If-Range")
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range.strip() == etag
+    since = parse_http_date_safe(if_range)
+    return since is not None and int(mtime) == since
+
+
+def serve(request, name, content_type=None, immutable=None):
+    """
+    Respond with the media file ``name`` (relative to MEDIA_ROOT).
+
+    ``immutable`` overrides the content-hash check, for URLs that map to
+    different files over time. Raises Http404.
+    """
+    try:
+        path = safe_join(settings.MEDIA_ROOT, name)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        raise Http404("No such media file")
+    if not os.path.isfile(path):
+        raise Http404("No such media file")
+
+    if immutable is None:
+        immutable = is_content_hashed(name)
+    etag = file_etag(stat)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(stat.st_mtime),
+        "Cache-Control": (
+            f"private, max-age={immutable_max_age()}, immutable" if immutable else "private, no-cache"
+        ),
+        "Accept-Ranges": "bytes",
+    }
+    if _not_modified(request, etag, stat.st_mtime):
+        return HttpResponseNotModified(headers=headers)
+
+    content_type = content_type or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if accel_redirect_prefix():
+        response = HttpResponse(content_type=content_type, headers=headers)
+        response["X-Accel-Redirect"] = accel_redirect_prefix().rstrip("/") + "/" + quote(name.lstrip("/"))
+        return response
+    if use_sendfile():
+        response = HttpResponse(content_type=content_type, headers=headers)
+        response["X-Sendfile"] = os.path.abspath(path)
+        return response
+
+    span = None
+    if "Range" in request.headers and _range_applies(request, etag, stat.st_mtime):
+        try:
+            span = parse_range(request.headers["Range"], stat.st_size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416, headers=headers)
+            response["Content-Range"] = f"bytes */{stat.st_size}"
+            return response
+
+    file = open(path, "rb")
+    if span is None:
+        response = FileResponse(file, content_type=content_type, headers=headers)
+    else:
+        start, end = span
+        file.seek(start)
+        response = FileResponse(_FileRange(file, end - start + 1), status=206,
+                                content_type=content_type, headers=headers)
+        response["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+        response["Content-Length"] = str(end - start + 1)
+    response.block_size = BLOCK_SIZE
+    return response
@@ -0,0 +1,210 @@
+import zlib
+from collections import namedtuple
+
+from django.db import migrations, models
+
+# A frozen copy of version 1 of the packed stroke format (app.stroke_codec at
+# the time of this migration), so that later codec changes don't change what
+# this migration writes or reads.
+
+MAGIC = b"SK"
+VERSION = 1
+COORD_SCALE = 10
+DEFAULT_WIDTH = 2
+DEFAULT_COLOR = "#000000"
+ZLIB_MIN_BYTES = 256
+FLAG_ZLIB = 0x01
+
+Style = namedtuple("Style", ["color", "width", "eraser", "user"])
+Polyline = namedtuple("Polyline", ["style", "points"])
+
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_zigzag(out, value):
+    _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _quantize(value):
+    return int(round(float(value) * COORD_SCALE))
+
+
+def _user(value):
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        user = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return user if user >= 0 else None
+
+
+def _width(value):
+    try:
+        width = _quantize(value or DEFAULT_WIDTH)
+    except (TypeError, ValueError, OverflowError):
+        width = _quantize(DEFAULT_WIDTH)
+    return max(0, width)
+
+
+def encode_strokes(strokes):
+    polylines = []
+    current = None
+    for segment in strokes:
+        try:
+            x1, y1 = _quantize(segment["x1"]), _quantize(segment["y1"])
+            x2, y2 = _quantize(segment["x2"]), _quantize(segment["y2"])
+        except (KeyError, TypeError, ValueError, OverflowError):
+            continue
+        style = Style(
+            color=str(segment.get("color") or DEFAULT_COLOR),
+            width=_width(segment.get("width")),
+            eraser=bool(segment.get("eraser")),
+            user=_user(segment.get("user")),
+        )
+        if current is not None and current.style == style and current.points[-1] == (x1, y1):
+            current.points.append((x2, y2))
+        else:
+            current = Polyline(style, [(x1, y1), (x2, y2)])
+            polylines.append(current)
+
+    blob = MAGIC + bytes([VERSION])
+    if not polylines:
+        return blob
+
+    styles = {}
+    for polyline in polylines:
+        styles.setdefault(polyline.style, len(styles))
+    body = bytearray()
+    _write_varint(body, len(styles))
+    for style in styles:
+        color = style.color.encode("utf-8")
+        _write_varint(body, len(color))
+        body += color
+        _write_varint(body, style.width)
+        body.append(1 if style.eraser else 0)
+        _write_varint(body, 0 if style.user is None else style.user + 1)
+    _write_varint(body, len(polylines))
+    for style, points in polylines:
+        _write_varint(body, styles[style])
+        _write_varint(body, len(points))
+        px = py = 0
+        for x, y in points:
+            _write_zigzag(body, x - px)
+            _write_zigzag(body, y - py)
+            px, py = x, y
+
+    body = bytes(body)
+    flags = 0
+    if len(body) >= ZLIB_MIN_BYTES:
+        compressed = zlib.compress(body, 6)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_ZLIB
+    chunk = bytearray()
+    _write_varint(chunk, len(body))
+    chunk.append(flags)
+    return blob + bytes(chunk) + body
+
+
+def decode_strokes(blob):
+    blob = bytes(blob or b"")
+    strokes = []
+    if not blob:
+        return strokes
+    pos = 3
+    while pos < len(blob):
+        length, pos = _read_varint(blob, pos)
+        flags = blob[pos]
+        body = blob[pos + 1:pos + 1 + length]
+        pos += 1 + length
+        if flags & FLAG_ZLIB:
+            body = zlib.decompress(body)
+
+        at = 0
+        n_styles, at = _read_varint(body, at)
+        styles = []
+        for _ in range(n_styles):
+            size, at = _read_varint(body, at)
+            color = body[at:at + size].decode("utf-8")
+            at += size
+            width, at = _read_varint(body, at)
+            eraser = bool(body[at])
+            at += 1
+            user, at = _read_varint(body, at)
+            styles.append({"color": color, "eraser": eraser, "width": width / COORD_SCALE,
+                           "user": user - 1 if user else None})
+        n_polylines, at = _read_varint(body, at)
+        for _ in range(n_polylines):
+            index, at = _read_varint(body, at)
+            n_points, at = _read_varint(body, at)
+            x = y = 0
+            for i in range(n_points):
+                dx, at = _read_varint(body, at)
+                dy, at = _read_varint(body, at)
+                px, py = x, y
+                x += _unzigzag(dx)
+                y += _unzigzag(dy)
+                if i:
+                    segment = {
+                        "x1": px / COORD_SCALE, "y1": py / COORD_SCALE,
+                        "x2": x / COORD_SCALE, "y2": y / COORD_SCALE,
+                    }
+                    segment.update(styles[index])
+                    strokes.append(segment)
+    return strokes
+
+
+def pack_strokes(apps, schema_editor):
+    Sketch = apps.get_model("app", "Sketch")
+    for sketch in Sketch.objects.only("id", "strokes").iterator():
+        sketch.strokes_packed = encode_strokes(sketch.strokes or [])
+        sketch.save(update_fields=["strokes_packed"])
+
+
+def unpack_strokes(apps, schema_editor):
+    Sketch = apps.get_model("app", "Sketch")
+    for sketch in Sketch.objects.only("id", "strokes_packed").iterator():
+        sketch.strokes = decode_strokes(sketch.strokes_packed)
+        sketch.save(update_fields=["strokes"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_sketch_audio_generated_at_sketch_audio_summary_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sketch',
+            name='strokes_packed',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+        migrations.RunPython(pack_strokes, unpack_strokes),
+        migrations.RemoveField(
+            model_name='sketch',
+            name='strokes',
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_sketch_strokes_packed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sketch',
+            name='stroke_revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='StrokeClient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client_id', models.CharField(max_length=64)),
+                ('last_seq', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('sketch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stroke_clients', to='app.sketch')),
+            ],
+            options={
+                'unique_together': {('sketch', 'client_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_sketch_stroke_revision_strokeclient'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sketch',
+            name='image_revision',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
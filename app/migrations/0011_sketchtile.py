@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_sketch_image_revision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SketchTile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.PositiveSmallIntegerField()),
+                ('x', models.IntegerField()),
+                ('y', models.IntegerField()),
+                ('png', models.BinaryField()),
+                ('etag', models.CharField(max_length=40)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sketch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tiles', to='app.sketch')),
+            ],
+            options={
+                'unique_together': {('sketch', 'level', 'x', 'y')},
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def link_current_audio(apps, schema_editor):
+    # Audio references used to be held by Sketch.audio_blob; they now belong
+    # to a SketchAudio row each, so the reference counts stay the same
+    Sketch = apps.get_model("app", "Sketch")
+    SketchAudio = apps.get_model("app", "SketchAudio")
+    for sketch in Sketch.objects.filter(audio_blob__isnull=False).select_related("audio_blob"):
+        SketchAudio.objects.create(sketch=sketch, language=sketch.audio_blob.language, blob=sketch.audio_blob)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_audioblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SketchAudio',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('language', models.CharField(max_length=10)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='uses', to='app.audioblob')),
+                ('sketch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='audios', to='app.sketch')),
+            ],
+            options={
+                'unique_together': {('sketch', 'language')},
+            },
+        ),
+        migrations.RunPython(link_current_audio, migrations.RunPython.noop),
+    ]
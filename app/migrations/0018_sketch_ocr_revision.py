@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_geminifile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sketch',
+            name='ocr_revision',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sketch',
+            name='ocr_strokes_digest',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='sketch',
+            name='ocr_strokes_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def snapshot_current_strokes(apps, schema_editor):
+    # Strokes written before the log existed have no ops: start every
+    # sketch's history from a snapshot of what it has now
+    Sketch = apps.get_model("app", "Sketch")
+    StrokeSnapshot = apps.get_model("app", "StrokeSnapshot")
+    for sketch in Sketch.objects.only("id", "strokes_packed", "stroke_revision"):
+        blob = bytes(sketch.strokes_packed or b"")
+        if blob or sketch.stroke_revision:
+            StrokeSnapshot.objects.create(sketch=sketch, revision=sketch.stroke_revision, strokes_packed=blob)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_sketch_ocr_revision'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StrokeOp',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('revision', models.PositiveIntegerField()),
+                ('kind', models.CharField(choices=[('add', 'Add'), ('erase', 'Erase'), ('undo', 'Undo'), ('clear', 'Clear')], max_length=10)),
+                ('added', models.BinaryField(blank=True, default=b'')),
+                ('removed', models.BinaryField(blank=True, default=b'')),
+                ('rect', models.JSONField(blank=True, null=True)),
+                ('target', models.PositiveIntegerField(blank=True, null=True)),
+                ('target_part', models.IntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sketch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stroke_ops', to='app.sketch')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('sketch', 'revision')},
+            },
+        ),
+        migrations.CreateModel(
+            name='StrokeSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('revision', models.PositiveIntegerField()),
+                ('strokes_packed', models.BinaryField(blank=True, default=b'')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sketch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stroke_snapshots', to='app.sketch')),
+            ],
+            options={
+                'unique_together': {('sketch', 'revision')},
+            },
+        ),
+        migrations.RunPython(snapshot_current_strokes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_stroke_log'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StrokeState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('revision', models.PositiveIntegerField()),
+                ('body', models.BinaryField()),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sketch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stroke_states', to='app.sketch')),
+            ],
+            options={
+                'unique_together': {('sketch', 'revision')},
+            },
+        ),
+    ]
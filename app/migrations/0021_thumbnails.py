@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_stroke_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sketch',
+            name='thumbnail_key',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.CreateModel(
+            name='Thumbnail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64)),
+                ('size', models.PositiveSmallIntegerField()),
+                ('file', models.FileField(upload_to='thumbnails/')),
+                ('width', models.PositiveSmallIntegerField()),
+                ('height', models.PositiveSmallIntegerField()),
+                ('file_size', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('key', 'size')},
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_thumbnails'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetiredGeminiFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('retired_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -1,7 +1,10 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 import random
 
+from . import stroke_codec
+
 def random_color():
     return "#{:06x}".format(random.randint(0, 0xFFFFFF))
 
@@ -24,13 +27,224 @@ class Sketch(models.Model):
     name = models.CharField(max_length=200)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     image = models.ImageField(upload_to="sketches/", blank=True, null=True)
-    strokes = models.JSONField(default=list)
+    image_revision = models.PositiveIntegerField(blank=True, null=True)  # stroke_revision the image was rendered from
+    strokes_packed = models.BinaryField(default=b"", blank=True)  # see stroke_codec
+    stroke_revision = models.PositiveIntegerField(default=0)  # bumped on every stroke change
     created_at = models.DateTimeField(auto_now_add=True)
     
     # New fields for OCR and audio
     ocr_explanation = models.TextField(blank=True, null=True)  # Store the explanation text
+    ocr_revision = models.PositiveIntegerField(blank=True, null=True)  # stroke_revision the explanation covers
+    ocr_strokes_size = models.PositiveIntegerField(blank=True, null=True)  # len(strokes_packed) at ocr_revision, see ocr_regions
+    ocr_strokes_digest = models.CharField(max_length=64, blank=True, default="")  # SHA-256 of those bytes
     audio_summary = models.FileField(upload_to="audio_summaries/", blank=True, null=True)  # Store audio file
     audio_generated_at = models.DateTimeField(blank=True, null=True)  # Track when audio was generated
+    audio_blob = models.ForeignKey("AudioBlob", on_delete=models.SET_NULL, blank=True, null=True, related_name="sketches")  # see audio_cache
+    thumbnail_key = models.CharField(max_length=64, blank=True, default="")  # hash of the image the thumbnails show, see thumbnails
     
+    @property
+    def strokes(self):
+        """Stroke segments as the list of dicts the client sends and replays."""
+        return stroke_codec.decode_strokes(self.strokes_packed)
+
+    @strokes.setter
+    def strokes(self, value):
+        self.strokes_packed = stroke_codec.encode_strokes(value or [])
+
     def __str__(self):
-        return f"{self.name} - {self.book.name}"
\ No newline at end of file
+        return f"{self.name} - {self.book.name}"
+
+class StrokeClient(models.Model):
+    """Last stroke batch sequence number applied for one client of a sketch."""
+    sketch = models.ForeignKey(Sketch, on_delete=models.CASCADE, related_name="stroke_clients")
+    client_id = models.CharField(max_length=64)
+    last_seq = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("sketch", "client_id")
+
+
+class StrokeOp(models.Model):
+    """
+    One change to a sketch's strokes (see stroke_log). ``revision`` is the
+    stroke_revision it produced; ``added`` and ``removed`` are packed stroke
+    blobs of the segments it added and removed, so replaying it needs nothing
+    else. A clear replaces the strokes with ``added``.
+    """
+    ADD = "add"
+    ERASE = "erase"
+    UNDO = "undo"
+    CLEAR = "clear"
+    KINDS = [(ADD, "Add"), (ERASE, "Erase"), (UNDO, "Undo"), (CLEAR, "Clear")]
+
+    sketch = models.ForeignKey(Sketch, on_delete=models.CASCADE, related_name="stroke_ops")
+    revision = models.PositiveIntegerField()
+    kind = models.CharField(max_length=10, choices=KINDS)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
+    added = models.BinaryField(default=b"", blank=True)
+    removed = models.BinaryField(default=b"", blank=True)
+    rect = models.JSONField(blank=True, null=True)  # erase rectangle
+    target = models.PositiveIntegerField(blank=True, null=True)  # revision of the op an undo reverts
+    target_part = models.IntegerField(blank=True, null=True)  # which of the user's paths in that op
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("sketch", "revision")
+
+
+class StrokeSnapshot(models.Model):
+    """The packed strokes of a sketch as of ``revision`` (see stroke_log)."""
+    sketch = models.ForeignKey(Sketch, on_delete=models.CASCADE, related_name="stroke_snapshots")
+    revision = models.PositiveIntegerField()
+    strokes_packed = models.BinaryField(default=b"", blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("sketch", "revision")
+
+
+class StrokeState(models.Model):
+    """The gzip-compressed stroke state stream of a sketch at ``revision`` (see stroke_state)."""
+    sketch = models.ForeignKey(Sketch, on_delete=models.CASCADE, related_name="stroke_states")
+    revision = models.PositiveIntegerField()
+    body = models.BinaryField()
+    size = models.PositiveIntegerField(default=0)  # uncompressed bytes
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("sketch", "revision")
+
+
+class Thumbnail(models.Model):
+    """A preview of a sketch image at one size, keyed by a hash of the image (see thumbnails)."""
+    key = models.CharField(max_length=64)
+    size = models.PositiveSmallIntegerField()  # longer side in px
+    file = models.FileField(upload_to="thumbnails/")
+    width = models.PositiveSmallIntegerField()
+    height = models.PositiveSmallIntegerField()
+    file_size = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("key", "size")
+
+
+class SketchTile(models.Model):
+    """A cached PNG tile of a sketch's tile pyramid (see sketch_tiles)."""
+    sketch = models.ForeignKey(Sketch, on_delete=models.CASCADE, related_name="tiles")
+    level = models.PositiveSmallIntegerField()  # 0 = full resolution
+    x = models.IntegerField()
+    y = models.IntegerField()
+    png = models.BinaryField()
+    etag = models.CharField(max_length=40)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("sketch", "level", "x", "y")
+
+
+class OcrResult(models.Model):
+    """Cached OCR explanation, keyed by a hash of the image, prompt and model."""
+    key = models.CharField(max_length=64, unique=True)
+    text = models.TextField()
+    hit_count = models.PositiveIntegerField(default=0)
+    miss_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class GeminiFile(models.Model):
+    """
+    A file uploaded to the Gemini Files API, keyed by a hash of its bytes and
+    mime type, reused until shortly before the remote copy expires.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255)  # "files/..." on the API side
+    uri = models.URLField(max_length=500)
+    mime_type = models.CharField(max_length=100)
+    size = models.PositiveIntegerField(default=0)
+    hit_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+
+class RetiredGeminiFile(models.Model):
+    """A remote upload whose GeminiFile handle was replaced by a new upload, to be deleted by collect_files."""
+    name = models.CharField(max_length=255)  # "files/..." on the API side
+    retired_at = models.DateTimeField(auto_now_add=True)
+
+
+class AudioBlob(models.Model):
+    """
+    Generated audio, keyed by a hash of the explanation, language and audio
+    pipeline version. ``ref_count`` is the number of SketchAudio rows using it.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    language = models.CharField(max_length=10)
+    file = models.FileField(upload_to="audio_summaries/")
+    size = models.PositiveIntegerField(default=0)
+    ref_count = models.IntegerField(default=0)
+    hit_count = models.PositiveIntegerField(default=0)
+    miss_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    released_at = models.DateTimeField(blank=True, null=True)  # when ref_count last dropped to 0
+
+
+class SketchAudio(models.Model):
+    """The current audio of a sketch in one language."""
+    sketch = models.ForeignKey(Sketch, on_delete=models.CASCADE, related_name="audios")
+    language = models.CharField(max_length=10)
+    blob = models.ForeignKey(AudioBlob, on_delete=models.PROTECT, related_name="uses")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("sketch", "language")
+
+
+class SpeechSegment(models.Model):
+    """
+    One spoken sentence: its translated, refined text and MP3 audio, keyed by
+    a hash of the normalized sentence, language and audio pipeline version.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    language = models.CharField(max_length=10)
+    spoken_text = models.TextField()
+    audio = models.BinaryField()
+    size = models.PositiveIntegerField(default=0)
+    hit_count = models.PositiveIntegerField(default=0)
+    miss_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class Job(models.Model):
+    """A background job run by the local worker pool (see jobs.py)."""
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    result = models.JSONField(blank=True, null=True)
+    error = models.TextField(blank=True, default="")
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    locked_by = models.CharField(max_length=64, blank=True, default="")
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
+    sketch = models.ForeignKey(Sketch, on_delete=models.CASCADE, blank=True, null=True, related_name="jobs")
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"])]
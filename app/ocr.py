@@ -0,0 +1,149 @@
+"""
+OCR of sketch images with a content-addressed result cache.
+
+The cache key is a SHA-256 of what the sketch shows (its packed strokes, or
+the uploaded image when it has none), the prompt (which lists the
+collaborators' colors) and the model name. When neither the sketch nor the
+colors changed since the last run, the stored explanation is returned
+without uploading anything to Gemini. On a miss the strokes are rendered
+straight at the OCR scale (or the image is cropped, scaled and flattened)
+by ocr_image, then sent inline or by reference to an earlier upload
+(gemini_files); the full-size sketch image is not needed. A sketch that only grew since its last OCR
+has just the new regions read and appended to its explanation.
+"""
+import hashlib
+import logging
+
+from django.conf import settings
+from django.db.models import F, Sum, Count
+
+from . import gemini_files, ocr_image, ocr_regions
+from .gemini import MODEL_NAME, extract_text_from_image
+from .models import OcrResult, UserColor
+from .sketch_render import sketch_source
+
+logger = logging.getLogger(__name__)
+
+
+def build_prompt(book):
+    """OCR prompt for a sketch of ``book``, listing every collaborator's color."""
+    user_colors = UserColor.objects.filter(book=book).select_related("user").order_by("user_id")
+    color_info = [
+        f"{uc.user.username} used color {uc.color}" for uc in user_colors
+    ]
+    color_info_str = "\n".join(color_info)
+
+    return (
+        "You're analyzing a sketch which contains handwritten math or science problems. "
+        "Try to interpret the equations and expressions drawn. "
+        "Here are the users and their assigned colors:\n\n"
+        f"{color_info_str}\n\n"
+        "Based on this, try to interpret what was written or solved in the sketch mention and correct each others mistake if there any."
+    )
+
+
+def cache_key(source_bytes, prompt):
+    digest = hashlib.sha256()
+    digest.update(MODEL_NAME.encode())
+    digest.update(b"\0")
+    digest.update(prompt.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(source_bytes)
+    return digest.hexdigest()
+
+
+def build_incremental_prompt(book, previous):
+    """OCR prompt for the regions added to a sketch whose explanation so far is ``previous``."""
+    tail = previous[-getattr(settings, "OCR_CONTEXT_CHARS", 1500):]
+    return (
+        build_prompt(book) + "\n\n"
+        "The images show only the parts of the sketch added since it was last explained, "
+        "with some of the surrounding work included for context. "
+        f"The explanation so far ends with:\n\n{tail}\n\n"
+        "Explain only the newly added work, continuing from the explanation so far."
+    )
+
+
+def _send(images, prompt):
+    parts = []
+    for prepared in images:
+        part, sent_as = gemini_files.image_part(prepared.data, prepared.mime_type)
+        logger.debug(
+            "OCR image: %s bytes (%sx%s %s) sent as %s",
+            len(prepared.data), prepared.width, prepared.height, prepared.mime_type, sent_as,
+        )
+        parts.append(part)
+    return extract_text_from_image(parts, prompt)
+
+
+def run_ocr(sketch, refresh=False, polylines=None):
+    """
+    Extract the explanation of ``sketch`` and store it on the sketch.
+
+    ``polylines`` is what sketch_render.sketch_source returned for it; [] reads
+    the uploaded ``sketch.image``. When strokes were only added since the last
+    OCR, just the regions around them are read (see ocr_regions) and the
+    result is appended to the explanation so far. Only results of reading
+    the whole sketch are cached.
+
+    Returns (text, cached). ``refresh`` skips the cache lookup, replaces the
+    cached result and always reads the whole sketch.
+    """
+    if polylines is None:
+        polylines = sketch_source(sketch) or []
+    prompt = build_prompt(sketch.book)
+    image_bytes = None
+    if polylines:
+        key = cache_key(bytes(sketch.strokes_packed), prompt)
+    else:
+        with sketch.image.open("rb") as f:
+            image_bytes = f.read()
+        key = cache_key(image_bytes, prompt)
+
+    result = None if refresh else OcrResult.objects.filter(key=key).first()
+    if result is not None:
+        OcrResult.objects.filter(pk=result.pk).update(hit_count=F("hit_count") + 1)
+        text, cached = result.text, True
+    else:
+        regions = None if refresh else ocr_regions.changed_regions(sketch)
+        if regions:
+            logger.info("Incremental OCR of sketch %s: %s region(s)", sketch.id, len(regions))
+            added = _send(
+                ocr_image.prepare_regions(sketch, regions, polylines or None),
+                build_incremental_prompt(sketch.book, sketch.ocr_explanation),
+            )
+            # Not cached: it is not what reading the whole sketch gives
+            text = f"{sketch.ocr_explanation.rstrip()}\n\n{added.strip()}"
+        else:
+            text = _send([ocr_image.prepare(sketch, image_bytes, polylines)], prompt)
+            result, created = OcrResult.objects.get_or_create(key=key, defaults={"text": text, "miss_count": 1})
+            if not created:
+                result.text = text
+                result.miss_count = F("miss_count") + 1
+                result.save(update_fields=["text", "miss_count", "updated_at"])
+        cached = False
+
+    sketch.ocr_explanation = text
+    fields = ["ocr_explanation"]
+    if polylines:
+        fields += ocr_regions.mark_ocr(sketch)
+    else:
+        sketch.ocr_revision = None
+        fields.append("ocr_revision")
+    sketch.save(update_fields=fields)
+    return text, cached
+
+
+def cache_stats():
+    """Hit/miss totals of the OCR cache."""
+    totals = OcrResult.objects.aggregate(
+        entries=Count("id"), hits=Sum("hit_count"), misses=Sum("miss_count"),
+    )
+    hits = totals["hits"] or 0
+    misses = totals["misses"] or 0
+    return {
+        "entries": totals["entries"],
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+    }
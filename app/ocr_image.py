@@ -0,0 +1,189 @@
+"""
+Preprocessing of sketch images before they are uploaded to Gemini for OCR.
+
+The stored sketch image covers the canvas up to the ink and is mostly white.
+Before upload it is
+
+- cropped to the ink's bounding box plus OCR_IMAGE_MARGIN px, taken from the
+  strokes when the sketch has any and from the non-background pixels of the
+  uploaded image otherwise,
+- scaled down so its longer side is at most OCR_IMAGE_MAX_SIDE px,
+- flattened to a palette of the background, black and the ink colors (the
+  collaborators' colors are always kept, and for uploaded images the image's
+  own most frequent colors are added), and
+- encoded as lossless WebP, which for these images is smaller than a
+  palette PNG.
+
+Sketches with strokes are re-rendered straight at the target scale rather
+than resampled, so thin lines stay solid and map exactly onto the palette.
+"""
+import io
+import math
+from collections import namedtuple
+
+from django.conf import settings
+from PIL import Image, ImageColor, ImageOps, features
+
+from . import stroke_codec
+from .models import UserColor
+from .sketch_render import BACKGROUND, clamp_bbox, polylines_bbox, render_polylines
+
+NEAR = 32  # palette entries closer than this in every channel are merged
+
+PreparedImage = namedtuple("PreparedImage", ["data", "mime_type", "width", "height"])
+
+
+def max_side():
+    return getattr(settings, "OCR_IMAGE_MAX_SIDE", 1536)
+
+
+def margin():
+    return getattr(settings, "OCR_IMAGE_MARGIN", 16)
+
+
+def _scale_for(width, height):
+    """Scale that fits (width, height) within max_side(); never enlarges."""
+    return min(1.0, max_side() / max(width, height, 1))
+
+
+def render_strokes(polylines, box=None):
+    """
+    Render polylines cropped to ``box`` (left, top, right, bottom) in canvas
+    px, by default their ink plus the margin, at the OCR scale.
+    """
+    if box is None:
+        left, top, right, bottom = polylines_bbox(polylines)
+        box = (left - margin(), top - margin(), right + margin(), bottom + margin())
+    # Only the drawable canvas, whatever the strokes' outliers
+    left, top, right, bottom = clamp_bbox(box) or (0.0, 0.0, 1.0, 1.0)
+    scale = _scale_for(right - left, bottom - top)
+    size = (
+        max(1, math.ceil((right - left) * scale)),
+        max(1, math.ceil((bottom - top) * scale)),
+    )
+    return render_polylines(polylines, size=size, origin=(left, top), scale=scale)
+
+
+def crop_image(image):
+    """Crop an uploaded image to its non-background pixels and scale it down."""
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        image = image.convert("RGBA")
+        if image.getchannel("A").getextrema()[0] < 255:
+            background = Image.new("RGBA", image.size, BACKGROUND)
+            image = Image.alpha_composite(background, image)
+    image = image.convert("RGB")
+    # The background is white, so the ink is whatever is non-zero once inverted
+    bbox = ImageOps.invert(image).getbbox()
+    if bbox is not None:
+        image = image.crop((
+            max(0, bbox[0] - margin()), max(0, bbox[1] - margin()),
+            min(image.width, bbox[2] + margin()), min(image.height, bbox[3] + margin()),
+        ))
+    scale = _scale_for(*image.size)
+    if scale < 1:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    return image
+
+
+def _is_new(rgb, palette):
+    return all(max(abs(a - b) for a, b in zip(rgb, other)) >= NEAR for other in palette)
+
+
+def palette_colors(colors):
+    """RGB tuples of the background, black and ``colors``, without near-duplicates."""
+    palette = [ImageColor.getrgb(BACKGROUND), (0, 0, 0)]
+    for color in colors:
+        try:
+            rgb = ImageColor.getrgb(color)[:3] if isinstance(color, str) else tuple(color[:3])
+        except ValueError:
+            continue
+        if _is_new(rgb, palette):
+            palette.append(rgb)
+    return palette
+
+
+def ink_colors(image, limit=None):
+    """Up to ``limit`` distinct colors of ``image`` other than background and black, most frequent first."""
+    limit = limit or getattr(settings, "OCR_IMAGE_INK_COLORS", 16)
+    counts = image.getcolors(1 << 16)
+    if counts is None:
+        # Photo-like image: let Pillow pick representative colors
+        counts = image.quantize(limit * 4, method=Image.Quantize.MEDIANCUT).convert("RGB").getcolors()
+    found = palette_colors([])
+    for _, rgb in sorted(counts, reverse=True):
+        if len(found) - 2 >= limit:
+            break
+        if _is_new(rgb, found):
+            found.append(rgb)
+    return found[2:]
+
+
+def quantize(image, colors):
+    """Map ``image`` onto palette_colors(colors) without dithering."""
+    palette = palette_colors(colors)
+    if len(palette) > 256:
+        return image.quantize(256, dither=Image.Dither.NONE)
+    reference = Image.new("P", (1, 1))
+    # Unused entries repeat the background so nothing is mapped onto them
+    reference.putpalette([c for rgb in palette + palette[:1] * (256 - len(palette)) for c in rgb])
+    return image.quantize(palette=reference, dither=Image.Dither.NONE)
+
+
+def encode(image):
+    """Lossless WebP (PNG when Pillow lacks WebP support), as (bytes, mime type)."""
+    out = io.BytesIO()
+    if features.check("webp"):
+        # Low effort: within a few percent of the smallest output at a
+        # fraction of the encoding time
+        image.save(out, format="WEBP", lossless=True, quality=25, method=2)
+        return out.getvalue(), "image/webp"
+    image.save(out, format="PNG", optimize=True)
+    return out.getvalue(), "image/png"
+
+
+def _book_colors(sketch):
+    return list(UserColor.objects.filter(book=sketch.book).values_list("color", flat=True))
+
+
+def _stroke_colors(polylines):
+    return list(dict.fromkeys(style.color for style, _ in polylines if not style.eraser))
+
+
+def _finish(image, colors):
+    data, mime_type = encode(quantize(image, colors))
+    return PreparedImage(data, mime_type, image.width, image.height)
+
+
+def prepare(sketch, image_bytes=None, polylines=None):
+    """
+    The image to send to Gemini for ``sketch`` as a PreparedImage.
+
+    Sketches with strokes are rendered from ``polylines`` (decoded from the
+    sketch when not given). Otherwise ``image_bytes``, the uploaded image,
+    is used; it is read from ``sketch.image`` when not given.
+    """
+    colors = _book_colors(sketch)
+    if polylines is None:
+        polylines = stroke_codec.decode_polylines(sketch.strokes_packed)
+
+    if polylines:
+        image = render_strokes(polylines)
+        colors += _stroke_colors(polylines)
+    else:
+        if image_bytes is None:
+            with sketch.image.open("rb") as f:
+                image_bytes = f.read()
+        image = crop_image(Image.open(io.BytesIO(image_bytes)))
+        # Colors of strokes drawn before a collaborator changed color, etc.
+        colors += ink_colors(image)
+
+    return _finish(image, colors)
+
+
+def prepare_regions(sketch, boxes, polylines=None):
+    """PreparedImages of the sketch's strokes within each of ``boxes`` (see ocr_regions)."""
+    if polylines is None:
+        polylines = stroke_codec.decode_polylines(sketch.strokes_packed)
+    colors = _book_colors(sketch) + _stroke_colors(polylines)
+    return [_finish(render_strokes(polylines, box), colors) for box in boxes]
@@ -0,0 +1,109 @@
+"""
+Regions of a sketch added since its last OCR.
+
+After every OCR of a sketch rendered from its strokes, the stroke revision,
+the length of ``strokes_packed`` and a SHA-256 of those bytes are stored on
+the sketch (mark_ocr). Appends only add chunks to the end of the blob, so as
+long as the stored prefix is unchanged, the strokes drawn since are exactly
+the chunks after it.
+
+changed_regions clusters the bounding boxes of those strokes into up to
+OCR_MAX_REGIONS regions, each grown by OCR_REGION_CONTEXT px of surrounding
+ink for context. It returns None, meaning the whole board has to be read
+again, when there is no usable previous OCR, when strokes were erased,
+cleared or replaced, when the new strokes include eraser strokes, or when
+the regions would cover more than OCR_INCREMENTAL_MAX_FRACTION of the
+board's ink.
+"""
+import hashlib
+
+from django.conf import settings
+
+from . import stroke_codec
+from .sketch_render import polylines_bbox
+
+
+def region_context():
+    return getattr(settings, "OCR_REGION_CONTEXT", 150)
+
+
+def max_regions():
+    return getattr(settings, "OCR_MAX_REGIONS", 4)
+
+
+def max_fraction():
+    return getattr(settings, "OCR_INCREMENTAL_MAX_FRACTION", 0.5)
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _area(box):
+    return max(0.0, box[2] - box[0]) * max(0.0, box[3] - box[1])
+
+
+def _union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _grow(box, by):
+    return (max(0.0, box[0] - by), max(0.0, box[1] - by), box[2] + by, box[3] + by)
+
+
+def _overlaps(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def merge_boxes(boxes):
+    """Merge overlapping boxes until none overlap."""
+    merged = []
+    for box in boxes:
+        i = 0
+        while i < len(merged):
+            if _overlaps(merged[i], box):
+                box = _union(merged.pop(i), box)
+                i = 0
+            else:
+                i += 1
+        merged.append(box)
+    return merged
+
+
+def mark_ocr(sketch):
+    """Record that the sketch's explanation covers its current strokes (caller saves)."""
+    blob = bytes(sketch.strokes_packed or b"")
+    sketch.ocr_revision = sketch.stroke_revision
+    sketch.ocr_strokes_size = len(blob)
+    sketch.ocr_strokes_digest = _digest(blob)
+    return ["ocr_revision", "ocr_strokes_size", "ocr_strokes_digest"]
+
+
+def changed_regions(sketch):
+    """
+    Boxes (left, top, right, bottom) in canvas px, context included, around
+    the strokes added since the last OCR; None when the whole board has to
+    be read.
+    """
+    if not sketch.ocr_explanation or sketch.ocr_revision is None or sketch.ocr_strokes_size is None:
+        return None
+    if sketch.ocr_revision == sketch.stroke_revision:
+        return None  # nothing new: the prompt changed, read it all again
+    blob = bytes(sketch.strokes_packed or b"")
+    size = sketch.ocr_strokes_size
+    if len(blob) <= size or _digest(blob[:size]) != sketch.ocr_strokes_digest:
+        return None  # rewritten (erase, clear, replace) rather than appended to
+
+    added = stroke_codec.decode_polylines_from(blob, size)
+    if not added or any(style.eraser for style, _ in added):
+        return None
+
+    context = region_context()
+    regions = merge_boxes([_grow(polylines_bbox([p]), context) for p in added])
+    if len(regions) > max_regions():
+        regions = [_grow(polylines_bbox(added), context)]
+
+    board = polylines_bbox(stroke_codec.decode_polylines(blob))
+    if sum(_area(r) for r in regions) > max_fraction() * _area(_grow(board, context)):
+        return None
+    return regions
@@ -0,0 +1,151 @@
+"""
+Server-side rasterizer for sketch strokes.
+
+Renders the packed strokes of a sketch with Pillow, one ImageDraw.line call
+per polyline, so OCR can work from the stored strokes instead of a PNG
+uploaded by one client's (possibly stale) canvas.
+
+The rendered image is stored in ``Sketch.image`` together with the stroke
+revision it was rendered from (``Sketch.image_revision``); ensure_sketch_image
+only re-renders when the strokes changed since.
+
+Only the canvas from (0, 0) to SKETCH_CANVAS_MAX px is ever drawn, however
+far out a client put a point, and an image sized to the ink is scaled down
+to at most SKETCH_RENDER_MAX_SIDE px, so one stray coordinate cannot make a
+worker allocate a huge image.
+"""
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageDraw
+
+from . import stroke_codec
+
+BACKGROUND = "white"
+MARGIN = 20  # px around the ink when the canvas size is not given
+
+
+def canvas_max():
+    return getattr(settings, "SKETCH_CANVAS_MAX", 8192)
+
+
+def render_max_side():
+    return getattr(settings, "SKETCH_RENDER_MAX_SIDE", 4096)
+
+
+def clamp_bbox(bbox):
+    """``bbox`` limited to the drawable canvas, or None when it lies outside it."""
+    if bbox is None:
+        return None
+    limit = canvas_max()
+    left, top = max(0.0, bbox[0]), max(0.0, bbox[1])
+    right, bottom = min(float(limit), bbox[2]), min(float(limit), bbox[3])
+    if left > right or top > bottom:
+        return None
+    return (left, top, right, bottom)
+
+
+def polylines_bbox(polylines):
+    """Bounding box (left, top, right, bottom) in px of the polylines, or None."""
+    bbox = None
+    for style, points in polylines:
+        pad = style.width / stroke_codec.COORD_SCALE / 2
+        xs = [x for x, _ in points]
+        ys = [y for _, y in points]
+        box = (
+            min(xs) / stroke_codec.COORD_SCALE - pad, min(ys) / stroke_codec.COORD_SCALE - pad,
+            max(xs) / stroke_codec.COORD_SCALE + pad, max(ys) / stroke_codec.COORD_SCALE + pad,
+        )
+        if bbox is None:
+            bbox = box
+        else:
+            bbox = (min(bbox[0], box[0]), min(bbox[1], box[1]), max(bbox[2], box[2]), max(bbox[3], box[3]))
+    return bbox
+
+
+def render_polylines(polylines, size=None, origin=(0, 0), scale=1.0, background=BACKGROUND):
+    """
+    Draw polylines onto a new RGB image.
+
+    ``origin`` is the canvas coordinate shown at the image's top-left corner
+    and ``scale`` the number of image pixels per canvas pixel. Without a
+    ``size`` the image covers the canvas from ``origin`` to the ink plus
+    MARGIN, and ``scale`` is lowered so neither side exceeds
+    SKETCH_RENDER_MAX_SIDE.
+    """
+    if size is None:
+        bbox = clamp_bbox(polylines_bbox(polylines))
+        right, bottom = (bbox[2], bbox[3]) if bbox else (0, 0)
+        width, height = right - origin[0] + MARGIN, bottom - origin[1] + MARGIN
+        scale = min(scale, render_max_side() / max(width, height, 1))
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+
+    image = Image.new("RGB", size, background)
+    draw = ImageDraw.Draw(image)
+    factor = scale / stroke_codec.COORD_SCALE
+    ox, oy = origin[0] * scale, origin[1] * scale
+
+    for style, points in polylines:
+        color = background if style.eraser else style.color
+        width = max(1, int(round(style.width * factor)))
+        xy = [(x * factor - ox, y * factor - oy) for x, y in points]
+        try:
+            draw.line(xy, fill=color, width=width, joint="curve")
+        except ValueError:
+            # Unparseable color from an old client: draw it black
+            color = "black"
+            draw.line(xy, fill=color, width=width, joint="curve")
+        if width > 2:
+            # round caps, like the browser's brush
+            r = width / 2
+            for x, y in (xy[0], xy[-1]):
+                draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+    return image
+
+
+def render_png(blob, **kwargs):
+    """Render a packed stroke blob to PNG bytes."""
+    image = render_polylines(stroke_codec.decode_polylines(blob), **kwargs)
+    out = io.BytesIO()
+    image.save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+
+def sketch_source(sketch):
+    """
+    What ``sketch`` shows: its polylines when it has strokes, [] when it
+    shows an uploaded image instead, None when it shows nothing.
+    """
+    polylines = stroke_codec.decode_polylines(sketch.strokes_packed)
+    if polylines:
+        return polylines
+    if sketch.image_revision is not None or not sketch.image:
+        return None  # nothing, or an image rendered before the sketch was cleared
+    return []
+
+
+def ensure_sketch_image(sketch):
+    """
+    Make sure ``sketch.image`` shows the current strokes and return it.
+
+    Renders only when the strokes changed since the last render. Sketches
+    without stored strokes keep whatever image was uploaded for them.
+    Returns None when there is neither strokes nor an image.
+    """
+    if sketch.image and sketch.image_revision == sketch.stroke_revision:
+        return sketch.image
+    polylines = sketch_source(sketch)
+    if not polylines:
+        return None if polylines is None else sketch.image
+
+    out = io.BytesIO()
+    render_polylines(polylines).save(out, format="PNG", optimize=True)
+    png = out.getvalue()
+    if sketch.image and sketch.image.name:
+        sketch.image.delete(save=False)
+    filename = f"sketches/{sketch.book}_sk_{sketch.id}.png"
+    sketch.image.save(filename, ContentFile(png), save=False)
+    sketch.image_revision = sketch.stroke_revision
+    sketch.save(update_fields=["image", "image_revision"])
+    return sketch.image
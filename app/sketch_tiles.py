@@ -0,0 +1,147 @@
+"""
+Tile pyramid for sketches.
+
+Strokes are rendered into SKETCH_TILE_SIZE square PNG tiles. Level 0 is full
+resolution and every level above halves it, up to SKETCH_TILE_LEVELS - 1.
+Rendered tiles are kept in SketchTile rows; when strokes are appended only the
+tiles their bounding box touches are deleted, and clearing or replacing the
+strokes drops the whole pyramid.
+
+Each tile's ETag is the SHA-1 of its PNG, so clients can revalidate cheaply.
+
+Only tiles that intersect the ink's bounding box (within the drawable canvas,
+see sketch_render.clamp_bbox) exist; get_tile returns None for the others.
+Tiles with no stroke on them are rendered but not stored, so the number of
+rows is bounded by the ink rather than by the requests.
+"""
+import hashlib
+import io
+import math
+
+from django.conf import settings
+from django.db import transaction
+
+from . import stroke_codec
+from .models import Sketch, SketchTile
+from .sketch_render import clamp_bbox, polylines_bbox, render_polylines
+
+
+def tile_size():
+    return getattr(settings, "SKETCH_TILE_SIZE", 256)
+
+
+def tile_levels():
+    return getattr(settings, "SKETCH_TILE_LEVELS", 4)
+
+
+def level_scale(level):
+    return 1.0 / (2 ** level)
+
+
+def strokes_bbox(strokes):
+    """Bounding box (left, top, right, bottom) in px of segment dicts, or None."""
+    bbox = None
+    for s in strokes:
+        try:
+            pad = float(s.get("width") or stroke_codec.DEFAULT_WIDTH) / 2
+            xs = (float(s["x1"]), float(s["x2"]))
+            ys = (float(s["y1"]), float(s["y2"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+        box = (min(xs) - pad, min(ys) - pad, max(xs) + pad, max(ys) + pad)
+        if bbox is None:
+            bbox = box
+        else:
+            bbox = (min(bbox[0], box[0]), min(bbox[1], box[1]), max(bbox[2], box[2]), max(bbox[3], box[3]))
+    return bbox
+
+
+def tile_range(bbox, level):
+    """Inclusive (x0, y0, x1, y1) tile indexes covering ``bbox`` at ``level``."""
+    span = tile_size() / level_scale(level)  # canvas px per tile
+    return (
+        math.floor(bbox[0] / span), math.floor(bbox[1] / span),
+        math.floor(bbox[2] / span), math.floor(bbox[3] / span),
+    )
+
+
+def tile_bounds(level, x, y):
+    """Canvas-space (left, top, right, bottom) of a tile."""
+    span = tile_size() / level_scale(level)
+    return (x * span, y * span, (x + 1) * span, (y + 1) * span)
+
+
+def invalidate(sketch_id, bbox=None):
+    """Drop cached tiles touched by ``bbox``, or all tiles of the sketch."""
+    tiles = SketchTile.objects.filter(sketch_id=sketch_id)
+    if bbox is None:
+        tiles.delete()
+        return
+    for level in range(tile_levels()):
+        x0, y0, x1, y1 = tile_range(bbox, level)
+        tiles.filter(level=level, x__range=(x0, x1), y__range=(y0, y1)).delete()
+
+
+def _intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _visible(polylines, bounds):
+    return [p for p in polylines if _intersects(polylines_bbox([p]), bounds)]
+
+
+def render_tile(polylines, level, x, y):
+    """Render one tile of the given polylines to PNG bytes."""
+    bounds = tile_bounds(level, x, y)
+    image = render_polylines(
+        _visible(polylines, bounds),
+        size=(tile_size(), tile_size()),
+        origin=(bounds[0], bounds[1]),
+        scale=level_scale(level),
+    )
+    out = io.BytesIO()
+    image.save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+
+def get_tile(sketch, level, x, y):
+    """
+    Return the cached SketchTile, rendering and storing it if needed, or
+    None when the tile is outside the ink's bounding box.
+    """
+    tile = SketchTile.objects.filter(sketch=sketch, level=level, x=x, y=y).first()
+    if tile is not None:
+        return tile
+
+    polylines = stroke_codec.decode_polylines(sketch.strokes_packed)
+    bbox = clamp_bbox(polylines_bbox(polylines))
+    if bbox is None or not _intersects(bbox, tile_bounds(level, x, y)):
+        return None
+
+    revision = sketch.stroke_revision
+    png = render_tile(polylines, level, x, y)
+    tile = SketchTile(
+        sketch=sketch, level=level, x=x, y=y,
+        png=png, etag=hashlib.sha1(png).hexdigest(),
+    )
+    if not _visible(polylines, tile_bounds(level, x, y)):
+        return tile  # blank, served but not kept
+    with transaction.atomic():
+        # Only cache it if no strokes were added while we were rendering
+        if Sketch.objects.filter(pk=sketch.pk, stroke_revision=revision).exists():
+            SketchTile.objects.filter(sketch=sketch, level=level, x=x, y=y).delete()
+            tile.save()
+    return tile
+
+
+def pyramid_info(sketch):
+    """What a client needs to request the visible tiles of a sketch."""
+    polylines = stroke_codec.decode_polylines(sketch.strokes_packed)
+    bbox = clamp_bbox(polylines_bbox(polylines))
+    return {
+        "tile_size": tile_size(),
+        "levels": tile_levels(),
+        "revision": sketch.stroke_revision,
+        "segments": sum(len(points) - 1 for _, points in polylines),
+        "bbox": list(bbox) if bbox else None,
+    }
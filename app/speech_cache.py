@@ -0,0 +1,211 @@
+"""
+Sentence-level cache of translated, refined and spoken text.
+
+Text converted by MathToSpeech is split into sentences, and every sentence is
+translated, refined and synthesized on its own. The result (spoken text and
+MP3 segment) is stored as a SpeechSegment keyed by a hash of (normalized
+sentence, language, pipeline version). When an explanation changes by one
+line, only the changed sentences go to Gemini and gTTS again; the rest come
+from the cache and the segments are joined into the final file (MP3 frames
+concatenate). The missing sentences of one language are translated and
+refined together, in one Gemini call per AUDIO_PREPARE_BATCH sentences.
+
+Generation is split in three steps so callers can choose where the work runs:
+plan looks the sentences up, submit queues the Gemini and gTTS work for the
+missing ones on a thread pool (no database access there), and assemble
+stores the rendered segments and yields all of them in order.
+stream_segments chains the three for one language. Sentences whose
+translation or refinement failed are spoken in English but never stored;
+assemble reports them so callers don't cache audio built from them either.
+
+Segments unused for AUDIO_SEGMENT_TTL seconds are deleted by collect (see
+the collect_audio command); cache_stats reports the sentence hit rate.
+"""
+import hashlib
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from .audio_generator import (
+    PIPELINE_VERSION, SUPPORTED_LANGUAGES, prepare_sentences, split_sentences, synthesize_chunk,
+)
+from .models import SpeechSegment
+
+logger = logging.getLogger(__name__)
+
+Rendered = namedtuple("Rendered", ["language", "spoken_text", "audio", "degraded"])
+
+
+def normalize_sentence(sentence):
+    return " ".join(sentence.split())
+
+
+def segment_key(sentence, language):
+    digest = hashlib.sha256()
+    digest.update(str(PIPELINE_VERSION).encode())
+    digest.update(b"\0")
+    digest.update(language.encode())
+    digest.update(b"\0")
+    digest.update(normalize_sentence(sentence).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def tts_workers():
+    return getattr(settings, "AUDIO_TTS_WORKERS", 4)
+
+
+def plan(speech_text, language):
+    """
+    Split ``speech_text`` into sentences and look each one up.
+
+    Returns a list of [key, sentence, audio] in text order, audio being None
+    for sentences that still have to be rendered. Hits are counted.
+    """
+    sentences = [normalize_sentence(s) for s in split_sentences(speech_text, max_chars=0)]
+    if not sentences:
+        raise ValueError("Nothing to speak")
+
+    parts = [[segment_key(sentence, language), sentence, None] for sentence in sentences]
+    keys = {key for key, _, _ in parts}
+    cached = dict(SpeechSegment.objects.filter(key__in=keys).values_list("key", "audio"))
+    if cached:
+        SpeechSegment.objects.filter(key__in=cached).update(
+            hit_count=F("hit_count") + 1, last_used_at=timezone.now()
+        )
+    for part in parts:
+        audio = cached.get(part[0])
+        if audio is not None:
+            part[2] = bytes(audio)
+
+    hits = sum(1 for part in parts if part[2] is not None)
+    logger.debug("Sentence cache (%s): %s/%s sentences reused", language, hits, len(parts))
+    return parts
+
+
+def _speak(prepared, index):
+    """Speak sentence ``index`` of a prepare_sentences future as a Rendered."""
+    language, spoken_text, degraded = prepared.result()[index]
+    audio = synthesize_chunk(spoken_text, SUPPORTED_LANGUAGES[language]["tts_lang"])
+    return Rendered(language, spoken_text, audio, degraded)
+
+
+def submit(pool, parts, language, futures=None):
+    """
+    Start rendering every missing sentence of ``parts``: one task prepares
+    them all (see prepare_sentences), one task per sentence speaks it.
+    Returns {key: future of a Rendered}.
+    """
+    futures = {} if futures is None else futures
+    missing = {}
+    for key, sentence, audio in parts:
+        if audio is None and key not in futures:
+            missing.setdefault(key, sentence)
+    if missing:
+        # Queued before the tasks waiting for it, so a worker always picks
+        # it up first and they cannot starve it of threads
+        prepared = pool.submit(prepare_sentences, list(missing.values()), language)
+        for index, key in enumerate(missing):
+            futures[key] = pool.submit(_speak, prepared, index)
+    return futures
+
+
+def _store(key, language, spoken_text, audio):
+    try:
+        _, created = SpeechSegment.objects.get_or_create(
+            key=key,
+            defaults={
+                "language": language, "spoken_text": spoken_text,
+                "audio": audio, "size": len(audio), "miss_count": 1,
+            },
+        )
+    except IntegrityError:
+        # Rendered concurrently by another worker
+        created = False
+    if not created:
+        SpeechSegment.objects.filter(key=key).update(miss_count=F("miss_count") + 1)
+
+
+def assemble(parts, language, futures, degraded=None):
+    """
+    Yield the audio of every sentence in ``parts`` in order, waiting for the
+    rendered ones and storing them as they arrive.
+
+    Sentences whose translation or refinement failed are yielded but not
+    stored; their keys are added to the ``degraded`` set when given.
+    """
+    stored = {}
+    for key, _, audio in parts:
+        if audio is None:
+            audio = stored.get(key)
+        if audio is None:
+            rendered = futures[key].result()
+            audio = rendered.audio
+            if rendered.degraded or rendered.language != language:
+                if degraded is not None:
+                    degraded.add(key)
+            else:
+                _store(key, language, rendered.spoken_text, audio)
+            stored[key] = audio
+        yield audio
+
+
+def stream_segments(speech_text, language, max_workers=None, degraded=None):
+    """
+    The audio of ``speech_text`` in ``language``, yielded sentence by sentence.
+
+    Missing sentences are rendered concurrently on up to AUDIO_TTS_WORKERS
+    threads; the database is only used on the calling thread. ``degraded``
+    is passed on to assemble.
+    """
+    if language not in SUPPORTED_LANGUAGES:
+        language = "en"
+    parts = plan(speech_text, language)
+    missing = len({key for key, _, audio in parts if audio is None})
+    if not missing:
+        yield from (audio for _, _, audio in parts)
+        return
+
+    # One more thread for the Gemini call that the others wait for
+    pool = ThreadPoolExecutor(max_workers=max(1, min(missing, max_workers or tts_workers())) + 1,
+                              thread_name_prefix="tts")
+    try:
+        yield from assemble(parts, language, submit(pool, parts, language), degraded)
+    finally:
+        # A consumer that stops early (client gone) doesn't wait for the rest
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def collect(ttl=None, dry_run=False):
+    """
+    Delete segments not used for ``ttl`` seconds (default AUDIO_SEGMENT_TTL).
+    Returns (segments, bytes) freed.
+    """
+    if ttl is None:
+        ttl = getattr(settings, "AUDIO_SEGMENT_TTL", 30 * 24 * 3600)
+    stale = SpeechSegment.objects.filter(last_used_at__lt=timezone.now() - timedelta(seconds=ttl))
+    totals = stale.aggregate(n=Count("id"), size=Sum("size"))
+    if not dry_run:
+        stale.delete()
+    return totals["n"], totals["size"] or 0
+
+
+def cache_stats():
+    """Hit/miss totals and size of the sentence cache."""
+    totals = SpeechSegment.objects.aggregate(
+        entries=Count("id"), hits=Sum("hit_count"), misses=Sum("miss_count"), size=Sum("size"),
+    )
+    hits = totals["hits"] or 0
+    misses = totals["misses"] or 0
+    return {
+        "entries": totals["entries"],
+        "bytes": totals["size"] or 0,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+    }
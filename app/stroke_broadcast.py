@@ -0,0 +1,100 @@
+"""
+Coalesces stroke broadcasts per sketch room.
+
+Instead of one channel-layer ``group_send`` per segment, segments received in
+this process for the same room are collected for STROKE_BROADCAST_TICK seconds
+and fanned out as a single ``broadcast_draw`` event carrying the whole batch.
+A tick of 0 sends every batch immediately.
+"""
+import asyncio
+import json
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+_rooms = {}
+
+
+def _tick():
+    return getattr(settings, "STROKE_BROADCAST_TICK", 0.008)
+
+
+class RoomCoalescer:
+    """Pending broadcast segments of one room group."""
+
+    def __init__(self, channel_layer, group_name):
+        self.channel_layer = channel_layer
+        self.group_name = group_name
+        self.pending = []
+        self.connections = 0
+        self._timer = None
+        self._tasks = set()
+
+    async def add(self, strokes):
+        self.pending.extend(strokes)
+        tick = _tick()
+        if tick <= 0:
+            await self.flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(tick, self._flush_soon)
+
+    def _flush_soon(self):
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            await self.channel_layer.group_send(
+                self.group_name,
+                {
+                    'type': 'broadcast_draw',
+                    'strokes': batch,
+                }
+            )
+
+
+def acquire(channel_layer, group_name):
+    """Register a connection to ``group_name`` and return its coalescer."""
+    room = _rooms.get(group_name)
+    if room is None:
+        room = _rooms[group_name] = RoomCoalescer(channel_layer, group_name)
+    room.connections += 1
+    return room
+
+
+async def release(group_name):
+    """Unregister a connection; the last one out sends what is pending."""
+    room = _rooms.get(group_name)
+    if room is None:
+        return
+    room.connections -= 1
+    if room.connections > 0:
+        return
+    await room.flush()
+    if room.connections <= 0:
+        _rooms.pop(group_name, None)
+
+
+def notify_room(sketch_id, message):
+    """
+    Send a JSON message to everyone in a sketch room from synchronous code
+    (HTTP views). Does nothing when no channel layer is configured.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    async_to_sync(channel_layer.group_send)(
+        f"sketch_{sketch_id}",
+        {
+            'type': 'broadcast_draw',
+            'text': json.dumps(message),
+        }
+    )
@@ -0,0 +1,129 @@
+"""
+Write-behind buffer for strokes received over the sketch WebSocket.
+
+Segments are collected in memory per sketch and appended to the database in
+batches (see stroke_store.append_strokes) when the buffer reaches
+STROKE_FLUSH_SEGMENTS, when STROKE_FLUSH_INTERVAL seconds have passed since
+the first buffered segment, and when the last connection to the sketch in
+this process closes. Every stored batch schedules the sketch's thumbnails.
+
+Receiving never waits for the database: a flush swaps the pending list out
+and writes it in a background task, so bursts keep accumulating into the next
+batch while the previous one is being written. At most one such task waits
+behind the one writing. A failed write puts its strokes back and retries
+after STROKE_FLUSH_INTERVAL, also when no connection is left; the buffer is
+dropped once it is empty and unused.
+"""
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import stroke_store, thumbnails
+
+logger = logging.getLogger(__name__)
+
+_buffers = {}
+
+
+def _flush_segments():
+    return getattr(settings, "STROKE_FLUSH_SEGMENTS", 500)
+
+
+def _flush_interval():
+    return getattr(settings, "STROKE_FLUSH_INTERVAL", 2.0)
+
+
+class StrokeBuffer:
+    """Pending strokes of one sketch and the connections that feed them."""
+
+    def __init__(self, sketch_id):
+        self.sketch_id = sketch_id
+        self.pending = []
+        self.connections = 0
+        self._lock = asyncio.Lock()
+        self._timer = None
+        self._scheduled = False
+        self._tasks = set()
+
+    def add(self, strokes):
+        self.pending.extend(strokes)
+        if len(self.pending) >= _flush_segments():
+            self._flush_soon()
+        elif self._timer is None:
+            self._arm_timer()
+
+    def _arm_timer(self):
+        self._timer = asyncio.get_running_loop().call_later(_flush_interval(), self._flush_soon)
+
+    def _flush_soon(self):
+        # At most one scheduled flush waits for the lock; it writes whatever
+        # is pending once it gets it
+        if self._scheduled:
+            return
+        self._scheduled = True
+        task = asyncio.ensure_future(self._scheduled_flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _scheduled_flush(self):
+        async with self._lock:
+            self._scheduled = False
+            await self._write()
+
+    async def flush(self):
+        async with self._lock:
+            await self._write()
+
+    async def _write(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        try:
+            await database_sync_to_async(_persist)(self.sketch_id, batch)
+        except Exception:
+            logger.exception("Failed to persist %d strokes for sketch %s", len(batch), self.sketch_id)
+            # Keep them for the next flush, which is retried even when every
+            # connection is gone
+            self.pending[:0] = batch
+            if self._timer is None:
+                self._arm_timer()
+            return
+        if self.connections <= 0 and not self.pending:
+            _discard(self)
+
+
+def _persist(sketch_id, batch):
+    stroke_store.append_strokes(sketch_id, batch)
+    thumbnails.schedule(sketch_id)
+
+
+def _discard(buffer):
+    if _buffers.get(buffer.sketch_id) is buffer:
+        del _buffers[buffer.sketch_id]
+
+
+def acquire(sketch_id):
+    """Register a connection to ``sketch_id`` and return its buffer."""
+    buffer = _buffers.get(sketch_id)
+    if buffer is None:
+        buffer = _buffers[sketch_id] = StrokeBuffer(sketch_id)
+    buffer.connections += 1
+    return buffer
+
+
+async def release(sketch_id):
+    """Unregister a connection; the last one out flushes the buffer."""
+    buffer = _buffers.get(sketch_id)
+    if buffer is None:
+        return
+    buffer.connections -= 1
+    if buffer.connections > 0:
+        return
+    await buffer.flush()
+    if buffer.connections <= 0 and not buffer.pending:
+        _discard(buffer)
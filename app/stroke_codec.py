@@ -0,0 +1,343 @@
+"""
+Packed storage format for sketch strokes.
+
+The browser sends strokes as one dict per line segment::
+
+    {"x1": .., "y1": .., "x2": .., "y2": .., "color": "#rrggbb",
+     "eraser": False, "width": 2, "user": 1}
+
+Storing that list as JSON repeats the style keys for every segment. This
+codec groups consecutive segments that share a style and join end-to-start
+into polylines, keeps one style table per chunk and writes the points as
+zigzag/varint deltas of coordinates quantized to 1/COORD_SCALE px.
+
+Blob layout::
+
+    MAGIC VERSION chunk*
+    chunk = varint(body_len) flags body          (flags bit 0: zlib)
+    body  = varint(n_styles) style* varint(n_polylines) polyline*
+    style = varint(len) color_utf8 varint(width*COORD_SCALE) eraser varint(user+1)
+    polyline = varint(style_index) varint(n_points) (zz(dx) zz(dy))*
+
+Chunks are self-contained, so new strokes can be appended to an existing
+blob without decoding it (see append_strokes).
+"""
+import zlib
+from collections import namedtuple
+
+MAGIC = b"SK"
+VERSION = 1
+COORD_SCALE = 10          # 0.1px precision
+DEFAULT_WIDTH = 2         # what the client draws when width is missing
+DEFAULT_COLOR = "#000000"
+ZLIB_MIN_BYTES = 256      # don't bother compressing tiny chunks
+FLAG_ZLIB = 0x01
+
+Style = namedtuple("Style", ["color", "width", "eraser", "user"])
+Polyline = namedtuple("Polyline", ["style", "points"])
+
+
+class StrokeCodecError(ValueError):
+    """Raised when a packed stroke blob cannot be decoded."""
+
+
+# ---------------------------------------------------------------------------
+# varint helpers
+# ---------------------------------------------------------------------------
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_zigzag(out, value):
+    _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        try:
+            byte = buf[pos]
+        except IndexError:
+            raise StrokeCodecError("Truncated stroke blob")
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+# ---------------------------------------------------------------------------
+# segment <-> polyline conversion
+# ---------------------------------------------------------------------------
+
+def _quantize(value):
+    return int(round(float(value) * COORD_SCALE))
+
+
+def _user(value):
+    """A segment's user id; None when missing or not a non-negative integer."""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        user = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return user if user >= 0 else None
+
+
+def _width(value):
+    """A segment's quantized width; the default when missing or invalid."""
+    try:
+        width = _quantize(value or DEFAULT_WIDTH)
+    except (TypeError, ValueError, OverflowError):
+        width = _quantize(DEFAULT_WIDTH)
+    return max(0, width)
+
+
+def _segment_style(segment):
+    """The segment's Style, with invalid users and widths normalized rather than rejected."""
+    return Style(
+        color=str(segment.get("color") or DEFAULT_COLOR),
+        width=_width(segment.get("width")),
+        eraser=bool(segment.get("eraser")),
+        user=_user(segment.get("user")),
+    )
+
+
+def segments_to_polylines(strokes):
+    """
+    Group segment dicts into polylines of quantized points.
+
+    Segments without finite numeric coordinates (legacy ``path`` entries)
+    carry no drawable geometry and are skipped.
+    """
+    polylines = []
+    current = None
+    for segment in strokes:
+        try:
+            x1, y1 = _quantize(segment["x1"]), _quantize(segment["y1"])
+            x2, y2 = _quantize(segment["x2"]), _quantize(segment["y2"])
+        except (KeyError, TypeError, ValueError, OverflowError):
+            continue
+        style = _segment_style(segment)
+        if current is not None and current.style == style and current.points[-1] == (x1, y1):
+            current.points.append((x2, y2))
+        else:
+            current = Polyline(style, [(x1, y1), (x2, y2)])
+            polylines.append(current)
+    return polylines
+
+
+def _style_dict(style):
+    return {
+        "color": style.color,
+        "eraser": style.eraser,
+        "width": style.width / COORD_SCALE,
+        "user": style.user,
+    }
+
+
+def polylines_to_segments(polylines):
+    """Expand polylines back into the segment dicts the client understands."""
+    strokes = []
+    for style, points in polylines:
+        base = _style_dict(style)
+        px, py = points[0]
+        for x, y in points[1:]:
+            segment = {
+                "x1": px / COORD_SCALE, "y1": py / COORD_SCALE,
+                "x2": x / COORD_SCALE, "y2": y / COORD_SCALE,
+            }
+            segment.update(base)
+            strokes.append(segment)
+            px, py = x, y
+    return strokes
+
+
+# ---------------------------------------------------------------------------
+# chunk encoding
+# ---------------------------------------------------------------------------
+
+def _encode_body(polylines):
+    styles = {}
+    for polyline in polylines:
+        styles.setdefault(polyline.style, len(styles))
+
+    body = bytearray()
+    _write_varint(body, len(styles))
+    for style in styles:
+        color = style.color.encode("utf-8")
+        _write_varint(body, len(color))
+        body += color
+        _write_varint(body, style.width)
+        body.append(1 if style.eraser else 0)
+        _write_varint(body, 0 if style.user is None else style.user + 1)
+
+    _write_varint(body, len(polylines))
+    for style, points in polylines:
+        _write_varint(body, styles[style])
+        _write_varint(body, len(points))
+        px = py = 0
+        for x, y in points:
+            _write_zigzag(body, x - px)
+            _write_zigzag(body, y - py)
+            px, py = x, y
+    return bytes(body)
+
+
+def _encode_chunk(polylines):
+    body = _encode_body(polylines)
+    flags = 0
+    if len(body) >= ZLIB_MIN_BYTES:
+        compressed = zlib.compress(body, 6)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_ZLIB
+    out = bytearray()
+    _write_varint(out, len(body))
+    out.append(flags)
+    out += body
+    return bytes(out)
+
+
+def _decode_body(body, polylines):
+    pos = 0
+    n_styles, pos = _read_varint(body, pos)
+    styles = []
+    for _ in range(n_styles):
+        length, pos = _read_varint(body, pos)
+        color = body[pos:pos + length].decode("utf-8")
+        pos += length
+        width, pos = _read_varint(body, pos)
+        eraser = bool(body[pos])
+        pos += 1
+        user, pos = _read_varint(body, pos)
+        styles.append(Style(color, width, eraser, user - 1 if user else None))
+
+    n_polylines, pos = _read_varint(body, pos)
+    for _ in range(n_polylines):
+        index, pos = _read_varint(body, pos)
+        n_points, pos = _read_varint(body, pos)
+        points = []
+        x = y = 0
+        for _ in range(n_points):
+            dx, pos = _read_varint(body, pos)
+            dy, pos = _read_varint(body, pos)
+            x += _unzigzag(dx)
+            y += _unzigzag(dy)
+            points.append((x, y))
+        try:
+            polylines.append(Polyline(styles[index], points))
+        except IndexError:
+            raise StrokeCodecError("Unknown style index in stroke blob")
+
+
+# ---------------------------------------------------------------------------
+# public API
+# ---------------------------------------------------------------------------
+
+def encode_strokes(strokes):
+    """Pack a list of segment dicts into a stroke blob."""
+    return append_strokes(b"", strokes)
+
+
+def append_strokes(blob, strokes):
+    """
+    Return ``blob`` with ``strokes`` appended as a new chunk.
+
+    The existing chunks are not decoded, so the cost is proportional to the
+    number of new segments only.
+    """
+    blob = bytes(blob or b"")
+    if not blob:
+        blob = MAGIC + bytes([VERSION])
+    polylines = segments_to_polylines(strokes or [])
+    if not polylines:
+        return blob
+    return blob + _encode_chunk(polylines)
+
+
+def decode_polylines(blob):
+    """Decode a stroke blob into a list of Polyline(style, points) tuples."""
+    blob = bytes(blob or b"")
+    polylines = []
+    if not blob:
+        return polylines
+    if blob[:2] != MAGIC:
+        raise StrokeCodecError("Not a packed stroke blob")
+    if blob[2] != VERSION:
+        raise StrokeCodecError(f"Unsupported stroke blob version {blob[2]}")
+
+    pos = 3
+    while pos < len(blob):
+        length, pos = _read_varint(blob, pos)
+        flags = blob[pos]
+        pos += 1
+        body = blob[pos:pos + length]
+        if len(body) != length:
+            raise StrokeCodecError("Truncated stroke blob")
+        pos += length
+        if flags & FLAG_ZLIB:
+            body = zlib.decompress(body)
+        _decode_body(body, polylines)
+    return polylines
+
+
+def decode_polylines_from(blob, offset):
+    """
+    Decode only the chunks from byte ``offset`` on. ``offset`` must be a chunk
+    boundary, such as the length of an earlier version of an append-only blob.
+    """
+    blob = bytes(blob or b"")
+    if offset < len(MAGIC) + 1:
+        return decode_polylines(blob)
+    return decode_polylines(MAGIC + bytes([VERSION]) + blob[offset:])
+
+
+def decode_strokes(blob):
+    """Decode a stroke blob back into the segment dicts used by the client."""
+    return polylines_to_segments(decode_polylines(blob))
+
+
+def concat(blob, other):
+    """Return ``blob`` followed by the chunks of ``other``."""
+    blob = bytes(blob or b"") or MAGIC + bytes([VERSION])
+    return blob + bytes(other or b"")[len(MAGIC) + 1:]
+
+
+def encode_polylines(polylines):
+    """Pack polylines into a single-chunk blob, merging those that join up."""
+    polylines = _merge_polylines(polylines)
+    if not polylines:
+        return MAGIC + bytes([VERSION])
+    return MAGIC + bytes([VERSION]) + _encode_chunk(polylines)
+
+
+def compact(blob):
+    """Re-encode a blob as a single chunk, merging appended chunks."""
+    return encode_polylines(decode_polylines(blob))
+
+
+def _merge_polylines(polylines):
+    merged = []
+    for polyline in polylines:
+        last = merged[-1] if merged else None
+        if last is not None and last.style == polyline.style and last.points[-1] == polyline.points[0]:
+            last.points.extend(polyline.points[1:])
+        else:
+            merged.append(Polyline(polyline.style, list(polyline.points)))
+    return merged
+
+
+def segment_count(blob):
+    """Number of segments stored in a blob, without building the dicts."""
+    return sum(len(points) - 1 for _, points in decode_polylines(blob))
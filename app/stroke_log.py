@@ -0,0 +1,187 @@
+"""
+Operation log and snapshots of sketch strokes.
+
+``Sketch.strokes_packed`` stays the materialized head that drawing, tiles,
+rendering and OCR read. Next to it every change is recorded as a StrokeOp,
+in the same transaction that moves the head to the op's revision: an append
+(the chunk it added), an erase (the segments it removed), an undo, or a clear
+(the strokes that replaced everything). Since an op stores its concrete
+effect, replaying it never needs the op it depends on, and
+
+- load rebuilds the strokes at any revision still in the log from the newest
+  StrokeSnapshot at or before it plus the ops after that;
+- undo_target finds a user's last path or erase that hasn't been undone yet,
+  so undo works on the server for every client of the sketch.
+
+Every STROKE_SNAPSHOT_EVERY revisions a compact_strokes job snapshots the
+head. Once there are STROKE_SNAPSHOTS_KEPT snapshots, it keeps the newest of
+them and deletes the older snapshots and the ops up to the oldest one kept,
+which bounds both the log and the replay while leaving at least
+STROKE_SNAPSHOTS_KEPT - 1 intervals of ops to undo. History before the
+oldest kept snapshot can no longer be loaded or undone.
+"""
+from collections import Counter, namedtuple
+
+from django.conf import settings
+from django.db import transaction
+
+from . import jobs, stroke_codec
+from .models import Sketch, StrokeOp, StrokeSnapshot
+
+UndoTarget = namedtuple("UndoTarget", ["revision", "part", "added", "removed"])
+
+
+class HistoryUnavailable(LookupError):
+    """Raised when a revision is no longer (or not yet) covered by the log."""
+
+
+def snapshot_every():
+    return getattr(settings, "STROKE_SNAPSHOT_EVERY", 500)
+
+
+def snapshots_kept():
+    return getattr(settings, "STROKE_SNAPSHOTS_KEPT", 2)
+
+
+def _segment_keys(polylines):
+    for style, points in polylines:
+        for a, b in zip(points, points[1:]):
+            yield style, a, b
+
+
+def remove_segments(blob, removed):
+    """``blob`` without the segments of ``removed``, each matched once."""
+    counts = Counter(_segment_keys(stroke_codec.decode_polylines(removed)))
+    if not counts:
+        return bytes(blob or b"")
+    kept = []
+    for style, points in stroke_codec.decode_polylines(blob):
+        run = points[:1]
+        for a, b in zip(points, points[1:]):
+            key = (style, a, b)
+            if counts[key]:
+                counts[key] -= 1
+                if len(run) > 1:
+                    kept.append(stroke_codec.Polyline(style, run))
+                run = [b]
+            else:
+                run.append(b)
+        if len(run) > 1:
+            kept.append(stroke_codec.Polyline(style, run))
+    return stroke_codec.encode_polylines(kept)
+
+
+def apply_change(blob, added=b"", removed=b""):
+    """Remove the segments of ``removed`` from ``blob``, then append ``added``."""
+    if removed:
+        blob = remove_segments(blob, removed)
+    if added:
+        blob = stroke_codec.concat(blob, added)
+    return blob
+
+
+def apply(blob, op):
+    """The strokes after replaying ``op`` on ``blob``."""
+    if op.kind == StrokeOp.CLEAR:
+        return bytes(op.added or b"")
+    return apply_change(blob, bytes(op.added or b""), bytes(op.removed or b""))
+
+
+def record(sketch_id, revision, kind, user_id=None, added=b"", removed=b"", **fields):
+    """
+    Log the change that took the sketch to ``revision``. Call inside the
+    transaction that updated the head; schedules a compaction every
+    STROKE_SNAPSHOT_EVERY revisions once it commits.
+    """
+    op = StrokeOp.objects.create(
+        sketch_id=sketch_id, revision=revision, kind=kind, user_id=user_id,
+        added=bytes(added or b""), removed=bytes(removed or b""), **fields,
+    )
+    every = snapshot_every()
+    if every and revision % every == 0:
+        transaction.on_commit(lambda: jobs.enqueue_once("compact_strokes", {"sketch_id": sketch_id}))
+    return op
+
+
+def load(sketch_id, revision=None):
+    """
+    The packed strokes of a sketch at ``revision`` (default: its current
+    revision), replayed from the log. Raises HistoryUnavailable.
+    """
+    if revision is None:
+        revision = Sketch.objects.values_list("stroke_revision", flat=True).get(pk=sketch_id)
+    snapshot = (
+        StrokeSnapshot.objects.filter(sketch_id=sketch_id, revision__lte=revision)
+        .order_by("-revision").values("revision", "strokes_packed").first()
+    )
+    base, blob = (snapshot["revision"], bytes(snapshot["strokes_packed"])) if snapshot else (0, b"")
+
+    ops = StrokeOp.objects.filter(
+        sketch_id=sketch_id, revision__gt=base, revision__lte=revision,
+    ).only("kind", "added", "removed").order_by("revision")
+    replayed = 0
+    for op in ops.iterator():
+        blob = apply(blob, op)
+        replayed += 1
+    if replayed != revision - base:
+        raise HistoryUnavailable(f"Revision {revision} of sketch {sketch_id} is not in the stroke log")
+    return blob
+
+
+def undo_target(sketch_id, user_id):
+    """
+    The change that undoing for ``user_id`` reverts, as an UndoTarget whose
+    ``added``/``removed`` are what the undo adds and removes, or None.
+
+    The candidates, newest first, are the user's paths (polylines attributed
+    to them in appended chunks) and the user's erases, skipping the ones
+    already undone. History ends at a clear.
+    """
+    undone = set()
+    ops = StrokeOp.objects.filter(sketch_id=sketch_id).order_by("-revision").only(
+        "revision", "kind", "user_id", "added", "removed", "target", "target_part",
+    )
+    for op in ops.iterator():
+        if op.kind == StrokeOp.CLEAR:
+            return None
+        if op.kind == StrokeOp.UNDO:
+            undone.add((op.target, op.target_part))
+        elif op.kind == StrokeOp.ERASE:
+            if op.user_id == user_id and (op.revision, None) not in undone:
+                return UndoTarget(op.revision, None, bytes(op.removed), b"")
+        elif op.kind == StrokeOp.ADD:
+            polylines = stroke_codec.decode_polylines(op.added)
+            for part in range(len(polylines) - 1, -1, -1):
+                if polylines[part].style.user == user_id and (op.revision, part) not in undone:
+                    removed = stroke_codec.encode_polylines([polylines[part]])
+                    return UndoTarget(op.revision, part, b"", removed)
+    return None
+
+
+def compact(sketch_id, keep=None):
+    """
+    Snapshot the sketch's head and, once there are ``keep`` snapshots
+    (default STROKE_SNAPSHOTS_KEPT), drop the history older than the oldest
+    of the newest ``keep``. Until then nothing is dropped, so the ops since
+    the first snapshot can still be undone.
+
+    Returns (snapshot revision, ops deleted, snapshots deleted).
+    """
+    keep = max(1, keep or snapshots_kept())
+    with transaction.atomic():
+        row = Sketch.objects.values("strokes_packed", "stroke_revision").get(pk=sketch_id)
+        StrokeSnapshot.objects.get_or_create(
+            sketch_id=sketch_id, revision=row["stroke_revision"],
+            defaults={"strokes_packed": bytes(row["strokes_packed"] or b"")},
+        )
+
+    kept = list(
+        StrokeSnapshot.objects.filter(sketch_id=sketch_id)
+        .order_by("-revision").values_list("revision", flat=True)[:keep]
+    )
+    if len(kept) < keep:
+        return row["stroke_revision"], 0, 0
+    horizon = kept[-1]
+    ops_deleted, _ = StrokeOp.objects.filter(sketch_id=sketch_id, revision__lte=horizon).delete()
+    snapshots_deleted, _ = StrokeSnapshot.objects.filter(sketch_id=sketch_id, revision__lt=horizon).delete()
+    return row["stroke_revision"], ops_deleted, snapshots_deleted
@@ -0,0 +1,78 @@
+"""
+Stroke simplification applied when strokes are ingested.
+
+Fabric's PencilBrush emits a point every pixel or two and the client sends
+every adjacent pair as a segment. Segments are regrouped into polylines (see
+stroke_codec.segments_to_polylines) and each polyline is reduced with
+Ramer-Douglas-Peucker: points closer than STROKE_SIMPLIFY_TOLERANCE px to
+the simplified line are dropped. The per-range distance computation is
+vectorized with NumPy.
+"""
+import numpy as np
+from django.conf import settings
+
+from . import stroke_codec
+
+
+def simplify_tolerance():
+    return getattr(settings, "STROKE_SIMPLIFY_TOLERANCE", 0.5)
+
+
+def rdp_mask(points, tolerance):
+    """
+    Boolean mask of the points Ramer-Douglas-Peucker keeps.
+
+    ``points`` is an (n, 2) array; the first and last points are always kept.
+    """
+    n = len(points)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a = points[start]
+        d = points[end] - a
+        rel = points[start + 1:end] - a
+        norm = np.hypot(d[0], d[1])
+        if norm == 0:
+            dists = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            dists = np.abs(d[0] * rel[:, 1] - d[1] * rel[:, 0]) / norm
+        i = int(np.argmax(dists))
+        if dists[i] > tolerance:
+            index = start + 1 + i
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return keep
+
+
+def simplify_polylines(polylines, tolerance):
+    """Simplify quantized polylines; ``tolerance`` is in px."""
+    limit = tolerance * stroke_codec.COORD_SCALE
+    simplified = []
+    for style, points in polylines:
+        if len(points) > 2:
+            array = np.asarray(points, dtype=np.float64)
+            mask = rdp_mask(array, limit)
+            points = [p for p, k in zip(points, mask) if k]
+        simplified.append(stroke_codec.Polyline(style, points))
+    return simplified
+
+
+def simplify_strokes(strokes, tolerance=None):
+    """
+    Simplify a list of segment dicts and return the reduced list.
+
+    A tolerance of 0 (or less) returns the strokes unchanged.
+    """
+    if tolerance is None:
+        tolerance = simplify_tolerance()
+    if tolerance <= 0 or not strokes:
+        return strokes
+    polylines = stroke_codec.segments_to_polylines(strokes)
+    return stroke_codec.polylines_to_segments(simplify_polylines(polylines, tolerance))
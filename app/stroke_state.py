@@ -0,0 +1,124 @@
+"""
+Initial stroke state of a sketch, streamed to the sketch page.
+
+The page no longer carries the strokes inline; it fetches them from
+sketch/<id>/strokes/state/ and draws them as they arrive. The body is
+newline-delimited JSON: a header line {"revision": .., "segments": ..}
+followed by arrays of up to STROKE_STATE_CHUNK segment dicts.
+
+The body is compressed while it is produced (gzip, or deflate for clients
+that only accept that) and flushed after every line, so the browser can
+decode and draw each chunk before the next one is encoded. The gzip stream
+is kept as a StrokeState row for the sketch's revision: until the strokes
+change, the next page load is served that blob without decoding anything,
+and a client that still has it gets a 304 for its ETag. Only the newest
+revision of each sketch is kept.
+"""
+import json
+import zlib
+
+from django.conf import settings
+from django.db import IntegrityError
+
+from . import stroke_codec
+from .models import StrokeState
+
+CONTENT_TYPE = "application/x-ndjson"
+ENCODINGS = ("gzip", "deflate")
+_WBITS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+
+def chunk_segments():
+    return getattr(settings, "STROKE_STATE_CHUNK", 2000)
+
+
+def compress_level():
+    return getattr(settings, "STROKE_STATE_GZIP_LEVEL", 6)
+
+
+def negotiate(accept_encoding):
+    """The encoding to answer an Accept-Encoding header with: "gzip", "deflate" or "identity"."""
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return "identity"
+
+
+def etag(sketch, encoding):
+    return f'"strokes-{sketch.pk}-{sketch.stroke_revision}-{encoding}"'
+
+
+def lines(blob, revision):
+    """The uncompressed body of the state stream, one line at a time."""
+    polylines = stroke_codec.decode_polylines(blob)
+    total = sum(len(points) - 1 for _, points in polylines)
+    yield json.dumps({"revision": revision, "segments": total}).encode() + b"\n"
+
+    limit = chunk_segments()
+    batch = []
+    count = 0
+    for polyline in polylines:
+        batch.append(polyline)
+        count += len(polyline.points) - 1
+        if count >= limit:
+            yield json.dumps(stroke_codec.polylines_to_segments(batch)).encode() + b"\n"
+            batch = []
+            count = 0
+    if batch:
+        yield json.dumps(stroke_codec.polylines_to_segments(batch)).encode() + b"\n"
+
+
+def cached_body(sketch):
+    """The stored gzip body for the sketch's current revision, or None."""
+    body = (
+        StrokeState.objects.filter(sketch_id=sketch.pk, revision=sketch.stroke_revision)
+        .values_list("body", flat=True).first()
+    )
+    return bytes(body) if body is not None else None
+
+
+def _store(sketch_id, revision, body, size):
+    try:
+        StrokeState.objects.get_or_create(
+            sketch_id=sketch_id, revision=revision, defaults={"body": body, "size": size},
+        )
+    except IntegrityError:
+        pass  # produced concurrently by another request
+    StrokeState.objects.filter(sketch_id=sketch_id, revision__lt=revision).delete()
+
+
+def stream(sketch, encoding):
+    """
+    Yield the state stream of ``sketch`` in ``encoding``, flushing the
+    compressor after every line. A complete gzip stream is stored for the
+    sketch's revision.
+    """
+    blob = bytes(sketch.strokes_packed or b"")
+    revision = sketch.stroke_revision
+    if encoding not in _WBITS:
+        yield from lines(blob, revision)
+        return
+
+    compressor = zlib.compressobj(compress_level(), zlib.DEFLATED, _WBITS[encoding])
+    parts = []
+    size = 0
+    for line in lines(blob, revision):
+        size += len(line)
+        part = compressor.compress(line) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        parts.append(part)
+        yield part
+    part = compressor.flush()
+    parts.append(part)
+    yield part
+    if encoding == "gzip":
+        _store(sketch.pk, revision, b"".join(parts), size)
@@ -0,0 +1,286 @@
+"""
+Stroke persistence helpers shared by the HTTP views and the WebSocket consumer.
+
+Appends use optimistic concurrency on ``Sketch.stroke_revision``: the new
+chunk is written only if the revision is still the one we read, otherwise the
+transaction is rolled back and retried. This keeps ``Sketch.strokes``
+consistent when several collaborators append at the same time without holding
+a lock while encoding.
+
+Every write also logs its effect as a StrokeOp in the same transaction (see
+stroke_log), which is what undo and the history snapshots are built from.
+"""
+from collections import namedtuple
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import sketch_tiles, stroke_codec, stroke_index, stroke_log
+from .models import Sketch, StrokeClient, StrokeOp
+
+MAX_APPEND_RETRIES = 10
+
+AppendResult = namedtuple("AppendResult", ["status", "revision", "last_seq"])
+
+
+class StrokeConflict(Exception):
+    """Raised when an append keeps losing the revision race."""
+
+
+class _RevisionChanged(Exception):
+    pass
+
+
+def _claim_seq(sketch_id, client_id, seq):
+    """
+    Advance the client's cursor from seq - 1 to seq.
+
+    Returns "ok", "duplicate" or "gap" together with the cursor's last_seq.
+    """
+    client, _ = StrokeClient.objects.get_or_create(sketch_id=sketch_id, client_id=client_id)
+    claimed = StrokeClient.objects.filter(pk=client.pk, last_seq=seq - 1).update(
+        last_seq=seq, updated_at=timezone.now(),
+    )
+    if claimed:
+        return "ok", seq
+    last_seq = StrokeClient.objects.values_list("last_seq", flat=True).get(pk=client.pk)
+    return ("duplicate" if seq <= last_seq else "gap"), last_seq
+
+
+def client_ttl():
+    return getattr(settings, "STROKE_CLIENT_TTL", 7 * 24 * 3600)
+
+
+def expire_clients(sketch_id=None, ttl=None):
+    """
+    Delete the seq cursors of clients that appended nothing for ``ttl``
+    seconds (default STROKE_CLIENT_TTL), of one sketch or of all. A client
+    that comes back starts again from seq 1. Returns how many were deleted.
+    """
+    if ttl is None:
+        ttl = client_ttl()
+    stale = StrokeClient.objects.filter(updated_at__lt=timezone.now() - timedelta(seconds=ttl))
+    if sketch_id is not None:
+        stale = stale.filter(sketch_id=sketch_id)
+    deleted, _ = stale.delete()
+    return deleted
+
+
+def append_strokes(sketch_id, strokes, client_id=None, seq=None):
+    """
+    Append ``strokes`` to a sketch without rewriting the existing ones.
+
+    When ``client_id``/``seq`` are given the append is idempotent: a batch
+    whose seq was already applied is reported as "duplicate", and a batch that
+    skips a seq is rejected as "gap" so the client can resync.
+
+    Raises Sketch.DoesNotExist and StrokeConflict.
+    """
+    for _ in range(MAX_APPEND_RETRIES):
+        try:
+            with transaction.atomic():
+                last_seq = None
+                if client_id is not None:
+                    status, last_seq = _claim_seq(sketch_id, client_id, seq)
+                    if status != "ok":
+                        revision = Sketch.objects.values_list("stroke_revision", flat=True).get(pk=sketch_id)
+                        return AppendResult(status, revision, last_seq)
+
+                row = Sketch.objects.values("strokes_packed", "stroke_revision").get(pk=sketch_id)
+                revision = row["stroke_revision"]
+                if not strokes:
+                    return AppendResult("appended", revision, last_seq)
+
+                # The paths keep their authors in their style, the op has none
+                added = stroke_codec.encode_strokes(strokes)
+                blob = stroke_codec.concat(row["strokes_packed"], added)
+                updated = Sketch.objects.filter(pk=sketch_id, stroke_revision=revision).update(
+                    strokes_packed=blob,
+                    stroke_revision=F("stroke_revision") + 1,
+                )
+                if not updated:
+                    raise _RevisionChanged()
+                stroke_log.record(sketch_id, revision + 1, StrokeOp.ADD, added=added)
+                bbox = sketch_tiles.strokes_bbox(strokes)
+                if bbox is not None:
+                    sketch_tiles.invalidate(sketch_id, bbox)
+            stroke_index.note_append(sketch_id, revision, revision + 1, strokes)
+            return AppendResult("appended", revision + 1, last_seq)
+        except _RevisionChanged:
+            continue
+    raise StrokeConflict(f"Could not append strokes to sketch {sketch_id}")
+
+
+def _rewrite(sketch_id, change, kind):
+    """
+    Replace the strokes of a sketch with ``change(blob)`` under optimistic
+    concurrency. ``change`` returns (new blob, op fields) or None when there
+    is nothing to do; the fields may give another ``kind`` for the op.
+    Returns (changed, revision).
+    """
+    for _ in range(MAX_APPEND_RETRIES):
+        with transaction.atomic():
+            row = Sketch.objects.values("strokes_packed", "stroke_revision").get(pk=sketch_id)
+            revision = row["stroke_revision"]
+            result = change(bytes(row["strokes_packed"] or b""))
+            if result is None:
+                return False, revision
+            blob, fields = result
+            updated = Sketch.objects.filter(pk=sketch_id, stroke_revision=revision).update(
+                strokes_packed=blob,
+                stroke_revision=F("stroke_revision") + 1,
+            )
+            if updated:
+                bbox = fields.pop("bbox", None)
+                stroke_log.record(sketch_id, revision + 1, fields.pop("kind", kind), **fields)
+                sketch_tiles.invalidate(sketch_id, bbox)
+        if updated:
+            stroke_index.forget(sketch_id)
+            return True, revision + 1
+    raise StrokeConflict(f"Could not rewrite strokes of sketch {sketch_id}")
+
+
+def _segment_key(stroke):
+    return (stroke["x1"], stroke["y1"], stroke["x2"], stroke["y2"],
+            stroke["color"], stroke["width"], stroke["eraser"])
+
+
+def _removed_segments(current, keys):
+    """
+    The segments of ``current`` left out when ``keys`` (segment keys) is a
+    subsequence of it, or None when it isn't.
+    """
+    removed = []
+    matched = 0
+    for stroke in current:
+        if matched < len(keys) and keys[matched] == _segment_key(stroke):
+            matched += 1
+        else:
+            removed.append(stroke)
+    return removed if matched == len(keys) else None
+
+
+def set_strokes(sketch_id, strokes, user_id=None):
+    """
+    Replace all strokes of a sketch with ``strokes``. Segments already on the
+    sketch keep their author; the others are attributed to ``user_id``,
+    whatever ``user`` they carry.
+
+    The change is logged as what it did, so that saving the whole sketch
+    doesn't end everyone's undo history: new segments after the existing
+    ones as an add, segments left out as an erase (both undoable by
+    ``user_id``), and anything else as a clear. Unchanged strokes log
+    nothing.
+
+    Returns the new revision. Raises Sketch.DoesNotExist and StrokeConflict.
+    """
+    # Compared after a round trip through the codec, which quantizes them
+    strokes = stroke_codec.decode_strokes(stroke_codec.encode_strokes(strokes))
+    keys = [_segment_key(stroke) for stroke in strokes]
+
+    def change(blob):
+        current = stroke_codec.decode_strokes(blob)
+        authors = {_segment_key(stroke): stroke["user"] for stroke in current}
+        for stroke in strokes:
+            stroke["user"] = authors.get(_segment_key(stroke), user_id)
+
+        if strokes and keys[:len(current)] == [_segment_key(stroke) for stroke in current]:
+            new = strokes[len(current):]
+            if not new:
+                return None
+            added = stroke_codec.encode_strokes(new)
+            return stroke_log.apply_change(blob, added=added), {
+                "kind": StrokeOp.ADD, "user_id": user_id, "added": added,
+                "bbox": sketch_tiles.strokes_bbox(new),
+            }
+        left_out = _removed_segments(current, keys) if strokes else None
+        if left_out:
+            removed = stroke_codec.encode_strokes(left_out)
+            return stroke_log.apply_change(blob, removed=removed), {
+                "kind": StrokeOp.ERASE, "user_id": user_id, "removed": removed,
+                "bbox": sketch_tiles.strokes_bbox(left_out),
+            }
+        added = stroke_codec.encode_strokes(strokes)
+        return added, {"user_id": user_id, "added": added}
+
+    _, revision = _rewrite(sketch_id, change, StrokeOp.CLEAR)
+    return revision
+
+
+def clear_strokes(sketch_id, user_id=None):
+    """Remove every stroke of a sketch (logged as a clear); returns the new revision."""
+    def change(blob):
+        return stroke_codec.encode_strokes([]), {"user_id": user_id}
+
+    _, revision = _rewrite(sketch_id, change, StrokeOp.CLEAR)
+    return revision
+
+
+def undo(sketch_id, user_id):
+    """
+    Revert ``user_id``'s last path or erase on a sketch (see
+    stroke_log.undo_target). Returns (undone, revision).
+
+    Raises Sketch.DoesNotExist and StrokeConflict.
+    """
+    def change(blob):
+        target = stroke_log.undo_target(sketch_id, user_id)
+        if target is None:
+            return None
+        blob = stroke_log.apply_change(blob, target.added, target.removed)
+        bbox = sketch_tiles.strokes_bbox(
+            stroke_codec.decode_strokes(target.added) + stroke_codec.decode_strokes(target.removed)
+        )
+        return blob, {
+            "user_id": user_id, "added": target.added, "removed": target.removed,
+            "target": target.revision, "target_part": target.part, "bbox": bbox,
+        }
+
+    return _rewrite(sketch_id, change, StrokeOp.UNDO)
+
+
+def erase_region(sketch_id, rect, user_id=None):
+    """
+    Remove every segment that crosses ``rect`` (left, top, right, bottom).
+
+    Uses the sketch's spatial index to find the segments, rewrites the stroke
+    blob without them under the same optimistic concurrency as appends, and
+    returns (number of erased segments, new revision). The erase is logged
+    for ``user_id``, who can undo it.
+
+    Raises Sketch.DoesNotExist and StrokeConflict.
+    """
+    for _ in range(MAX_APPEND_RETRIES):
+        sketch = Sketch.objects.only("id", "strokes_packed", "stroke_revision").get(pk=sketch_id)
+        index = stroke_index.get_index(sketch)
+        hits = index.query(rect, exact=True)
+        if not len(hits):
+            return 0, sketch.stroke_revision
+
+        keep = np.ones(len(index), dtype=bool)
+        keep[hits] = False
+        blob = stroke_codec.compact(stroke_codec.encode_strokes(index.segments(np.flatnonzero(keep))))
+        erased = index.segments(hits)
+        removed = stroke_codec.encode_strokes(erased)
+        # Whole segments go, also where they reach past the rect
+        left, top, right, bottom = sketch_tiles.strokes_bbox(erased)
+        bbox = (min(left, rect[0]), min(top, rect[1]), max(right, rect[2]), max(bottom, rect[3]))
+        with transaction.atomic():
+            updated = Sketch.objects.filter(pk=sketch.pk, stroke_revision=sketch.stroke_revision).update(
+                strokes_packed=blob,
+                stroke_revision=F("stroke_revision") + 1,
+            )
+            if updated:
+                stroke_log.record(
+                    sketch.pk, sketch.stroke_revision + 1, StrokeOp.ERASE, user_id,
+                    removed=removed, rect=list(rect),
+                )
+                sketch_tiles.invalidate(sketch.pk, bbox)
+        if updated:
+            stroke_index.forget(sketch.pk)
+            return len(hits), sketch.stroke_revision + 1
+    raise StrokeConflict(f"Could not erase strokes of sketch {sketch_id}")
@@ -0,0 +1,168 @@
+"""
+Compact binary WebSocket frames for stroke traffic.
+
+Clients that connect with ``?enc=bin`` exchange strokes as binary frames
+instead of JSON text. A frame carries a batch of segments::
+
+    u8      frame type (FRAME_STROKES)
+    varint  n_colors, then n_colors * 3 bytes RGB        (the palette)
+    varint  n_segments, then per segment:
+        varint  user + 1 (0 = no user)
+        u8      palette index
+        u8      flags (bit 0: eraser)
+        u8      width * WIDTH_SCALE
+        int16   x1, y1, x2, y2 * COORD_SCALE  (little endian)
+
+Coordinates are clamped to the int16 range, i.e. +-8191px at COORD_SCALE 4.
+A batch with a color that is not ``#rrggbb``, more than 256 colors, or a
+user that is not a non-negative integer cannot be framed; use can_encode()
+to fall back to JSON for those. encode_frame raises WireFormatError for them
+(and for segments without finite coordinates).
+"""
+import re
+import struct
+
+FRAME_STROKES = 0x01
+COORD_SCALE = 4           # 0.25px precision
+WIDTH_SCALE = 4
+DEFAULT_WIDTH = 2
+
+MAX_COLORS = 256
+
+_COORDS = struct.Struct("<hhhh")
+_HEX_COLOR = re.compile(r"^#[0-9a-fA-F]{6}$")
+
+
+class WireFormatError(ValueError):
+    """Raised for malformed binary stroke frames."""
+
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise WireFormatError("Truncated stroke frame")
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _coord(value):
+    return max(-32768, min(32767, int(round(float(value) * COORD_SCALE))))
+
+
+def _color(stroke):
+    return str(stroke.get("color") or "#000000").lower()
+
+
+def _user(stroke):
+    """The user field of a segment as written: user + 1, 0 for none."""
+    user = stroke.get("user")
+    if user is None:
+        return 0
+    if isinstance(user, bool) or not isinstance(user, (int, str)):
+        raise WireFormatError(f"Invalid user {user!r}")
+    try:
+        user = int(user)
+    except ValueError:
+        raise WireFormatError(f"Invalid user {user!r}")
+    if user < 0:
+        raise WireFormatError(f"Invalid user {user!r}")
+    return user + 1
+
+
+def can_encode(strokes):
+    """True if every segment's color and user fit a binary frame."""
+    colors = set()
+    for stroke in strokes:
+        color = _color(stroke)
+        if not _HEX_COLOR.match(color):
+            return False
+        colors.add(color)
+        try:
+            _user(stroke)
+        except WireFormatError:
+            return False
+    return len(colors) <= MAX_COLORS
+
+
+def encode_frame(strokes):
+    """Encode a batch of segment dicts as one binary frame. Raises WireFormatError."""
+    palette = {}
+    for stroke in strokes:
+        color = _color(stroke)
+        if not _HEX_COLOR.match(color):
+            raise WireFormatError(f"Color {color!r} is not #rrggbb")
+        palette.setdefault(color, len(palette))
+    if len(palette) > MAX_COLORS:
+        raise WireFormatError("Too many colors for one frame")
+
+    out = bytearray([FRAME_STROKES])
+    _write_varint(out, len(palette))
+    for color in palette:
+        out += bytes.fromhex(color[1:])
+
+    _write_varint(out, len(strokes))
+    for stroke in strokes:
+        _write_varint(out, _user(stroke))
+        try:
+            width = float(stroke.get("width") or DEFAULT_WIDTH)
+            coords = _COORDS.pack(
+                _coord(stroke["x1"]), _coord(stroke["y1"]),
+                _coord(stroke["x2"]), _coord(stroke["y2"]),
+            )
+            width = max(0, min(255, int(round(width * WIDTH_SCALE))))
+        except (KeyError, TypeError, ValueError, OverflowError):
+            raise WireFormatError("Segment without finite coordinates and width")
+        out.append(palette[_color(stroke)])
+        out.append(1 if stroke.get("eraser") else 0)
+        out.append(width)
+        out += coords
+    return bytes(out)
+
+
+def decode_frame(data):
+    """Decode a binary frame into the segment dicts used everywhere else."""
+    if not data or data[0] != FRAME_STROKES:
+        raise WireFormatError("Unknown stroke frame type")
+    n_colors, pos = _read_varint(data, 1)
+    palette = []
+    for _ in range(n_colors):
+        if pos + 3 > len(data):
+            raise WireFormatError("Truncated stroke frame")
+        palette.append("#" + data[pos:pos + 3].hex())
+        pos += 3
+
+    n_segments, pos = _read_varint(data, pos)
+    strokes = []
+    for _ in range(n_segments):
+        user, pos = _read_varint(data, pos)
+        if pos + 3 + _COORDS.size > len(data):
+            raise WireFormatError("Truncated stroke frame")
+        index, flags, width = data[pos], data[pos + 1], data[pos + 2]
+        x1, y1, x2, y2 = _COORDS.unpack_from(data, pos + 3)
+        pos += 3 + _COORDS.size
+        try:
+            color = palette[index]
+        except IndexError:
+            raise WireFormatError("Unknown palette index in stroke frame")
+        strokes.append({
+            "x1": x1 / COORD_SCALE, "y1": y1 / COORD_SCALE,
+            "x2": x2 / COORD_SCALE, "y2": y2 / COORD_SCALE,
+            "color": color,
+            "eraser": bool(flags & 1),
+            "width": width / WIDTH_SCALE,
+            "user": user - 1 if user else None,
+        })
+    return strokes
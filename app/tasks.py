@@ -0,0 +1,144 @@
+"""
+Background job handlers for OCR, audio generation, thumbnails and stroke
+log compaction (see jobs.py).
+
+Each handler returns the same JSON body the corresponding view used to
+return synchronously, so clients read it from the job's ``result``.
+"""
+from . import stroke_log, stroke_store, thumbnails
+from .audio_cache import assign_audio, get_audio, get_audios
+from .audio_generator import SUPPORTED_LANGUAGES
+from .jobs import PermanentJobError, handler
+from .models import Sketch
+from .ocr import run_ocr
+from .sketch_render import sketch_source
+
+
+def _get_sketch(sketch_id):
+    try:
+        return Sketch.objects.select_related("book").get(id=sketch_id)
+    except Sketch.DoesNotExist:
+        raise PermanentJobError("Sketch not found.")
+
+
+def create_sketch_audio(sketch, text, language):
+    """
+    Make the audio summary of ``text`` in ``language`` the sketch's latest
+    audio, reusing cached audio when possible. Returns (audio_url, cached).
+    """
+    blob, cached = get_audio(text, language)
+    assign_audio(sketch, blob)
+    return blob.file.url, cached
+
+
+@handler("sketch_ocr")
+def sketch_ocr(sketch_id, refresh=False):
+    sketch = _get_sketch(sketch_id)
+    # OCR renders the strokes itself, at its own scale
+    polylines = sketch_source(sketch)
+    if polylines is None:
+        raise PermanentJobError("No image found.")
+
+    text, cached = run_ocr(sketch, refresh=refresh, polylines=polylines)
+    return {
+        "text": text.split("\n"),
+        "sketch_id": sketch.id,
+        "cached": cached,
+    }
+
+
+@handler("sketch_audio")
+def sketch_audio(sketch_id, language="en"):
+    sketch = _get_sketch(sketch_id)
+    if not sketch.ocr_explanation:
+        raise PermanentJobError("No explanation found. Please run OCR first.")
+
+    audio_url, audio_cached = create_sketch_audio(sketch, sketch.ocr_explanation, language)
+    language_name = SUPPORTED_LANGUAGES[language]['name']
+    return {
+        "status": "success",
+        "audio_url": audio_url,
+        "audio_cached": audio_cached,
+        "language": language,
+        "language_name": language_name,
+        "message": f"Audio generated successfully in {language_name}",
+    }
+
+
+@handler("sketch_audio_multi")
+def sketch_audio_multi(sketch_id, languages):
+    """
+    Audio of the sketch's explanation in several languages, generated
+    concurrently. Languages that failed are listed in ``errors``; the job
+    only fails (and is retried) when every language failed.
+    """
+    sketch = _get_sketch(sketch_id)
+    if not sketch.ocr_explanation:
+        raise PermanentJobError("No explanation found. Please run OCR first.")
+
+    results = {}
+    errors = {}
+    for language, outcome in get_audios(sketch.ocr_explanation, languages).items():
+        if isinstance(outcome, Exception):
+            errors[language] = str(outcome)
+            continue
+        blob, cached = outcome
+        # The first requested language that succeeded becomes the latest audio
+        assign_audio(sketch, blob, latest=not results)
+        results[language] = {
+            "audio_url": blob.file.url,
+            "audio_cached": cached,
+            "language_name": SUPPORTED_LANGUAGES[language]['name'],
+        }
+
+    if not results:
+        raise RuntimeError("; ".join(f"{language}: {error}" for language, error in errors.items()))
+    return {
+        "status": "partial" if errors else "success",
+        "results": results,
+        "errors": errors,
+        "message": f"Audio generated in {len(results)} of {len(languages)} languages",
+    }
+
+
+@handler("sketch_ocr_audio")
+def sketch_ocr_audio(sketch_id, language="en", refresh=False):
+    sketch = _get_sketch(sketch_id)
+    # OCR renders the strokes itself, at its own scale
+    polylines = sketch_source(sketch)
+    if polylines is None:
+        raise PermanentJobError("No image found.")
+
+    text, cached = run_ocr(sketch, refresh=refresh, polylines=polylines)
+    audio_url, audio_cached = create_sketch_audio(sketch, text, language)
+    language_name = SUPPORTED_LANGUAGES[language]['name']
+    return {
+        "status": "success",
+        "text": text.split("\n"),
+        "cached": cached,
+        "audio_url": audio_url,
+        "audio_cached": audio_cached,
+        "language": language,
+        "language_name": language_name,
+        "message": f"OCR and audio generation completed in {language_name}",
+    }
+
+
+@handler("compact_strokes")
+def compact_strokes(sketch_id):
+    try:
+        revision, ops, snapshots = stroke_log.compact(sketch_id)
+    except Sketch.DoesNotExist:
+        raise PermanentJobError("Sketch not found.")
+    clients = stroke_store.expire_clients(sketch_id)
+    return {
+        "sketch_id": sketch_id, "revision": revision, "ops_deleted": ops,
+        "snapshots_deleted": snapshots, "clients_expired": clients,
+    }
+
+
+@handler("sketch_thumbnails")
+def sketch_thumbnails(sketch_id):
+    sketch = _get_sketch(sketch_id)
+    key = thumbnails.update_sketch(sketch)
+    return {"sketch_id": sketch.id, "thumbnail_key": key}
@@ -0,0 +1,131 @@
+"""
+The original step-by-step MathToSpeech converter, kept unchanged as the
+reference that audio_generator.MathToSpeech is tested and benchmarked
+against (see bench_math_speech). Not used to generate audio.
+"""
+import re
+
+class MathToSpeech:
+    """Converts mathematical notation to speech-friendly text"""
+    
+    def __init__(self):
+        self.greek_letters = {
+            'α': 'alpha', 'β': 'beta', 'γ': 'gamma', 'δ': 'delta',
+            'ε': 'epsilon', 'ζ': 'zeta', 'η': 'eta', 'θ': 'theta',
+            'ι': 'iota', 'κ': 'kappa', 'λ': 'lambda', 'μ': 'mu',
+            'ν': 'nu', 'ξ': 'xi', 'π': 'pi', 'ρ': 'rho',
+            'σ': 'sigma', 'τ': 'tau', 'φ': 'phi', 'χ': 'chi',
+            'ψ': 'psi', 'ω': 'omega', 'Δ': 'Delta', 'Σ': 'Sigma',
+            'Ω': 'Omega', 'Φ': 'Phi', 'Π': 'Pi', 'Θ': 'Theta'
+        }
+        
+        self.operators = {
+            '∫': ' integral of ',
+            '∑': ' sum of ',
+            '∏': ' product of ',
+            '∂': ' partial derivative of ',
+            '∇': ' gradient of ',
+            '√': ' square root of ',
+            '∞': ' infinity ',
+            '≈': ' approximately equals ',
+            '≠': ' not equal to ',
+            '≤': ' less than or equal to ',
+            '≥': ' greater than or equal to ',
+            '±': ' plus or minus ',
+            '×': ' times ',
+            '÷': ' divided by ',
+            '→': ' approaches ',
+            '∈': ' is an element of ',
+            '⊂': ' is a subset of ',
+            '⊆': ' is a subset of or equal to ',
+            '∪': ' union ',
+            '∩': ' intersection '
+        }
+    
+    def convert_greek_letters(self, text):
+        """Convert Greek letters to their names"""
+        for symbol, word in self.greek_letters.items():
+            text = text.replace(symbol, f' {word} ')
+        return text
+    
+    def convert_operators(self, text):
+        """Convert mathematical operators to words"""
+        for symbol, word in self.operators.items():
+            text = text.replace(symbol, word)
+        return text
+    
+    def convert_superscripts(self, text):
+        """Convert superscripts to spoken form"""
+        superscripts = {
+            '²': ' squared', '³': ' cubed',
+            '⁴': ' to the power of 4', '⁵': ' to the power of 5',
+            '⁶': ' to the power of 6', '⁷': ' to the power of 7',
+            '⁸': ' to the power of 8', '⁹': ' to the power of 9',
+            '⁰': ' to the power of 0', '¹': '',
+            'ⁿ': ' to the power of n'
+        }
+        for sup, word in superscripts.items():
+            text = text.replace(sup, word)
+        
+        # Handle x^n pattern
+        text = re.sub(r'(\w+)\^(\d+)', r'\1 to the power of \2', text)
+        text = re.sub(r'(\w+)\^(\w+)', r'\1 to the power of \2', text)
+        text = re.sub(r'(\w+)\^\{(.+?)\}', r'\1 to the power of \2', text)
+        return text
+    
+    def convert_subscripts(self, text):
+        """Convert subscripts to spoken form"""
+        subscripts = {
+            '₀': ' sub 0', '₁': ' sub 1', '₂': ' sub 2',
+            '₃': ' sub 3', '₄': ' sub 4', '₅': ' sub 5',
+            '₆': ' sub 6', '₇': ' sub 7', '₈': ' sub 8',
+            '₉': ' sub 9'
+        }
+        for sub, word in subscripts.items():
+            text = text.replace(sub, word)
+        
+        # Handle x_n pattern
+        text = re.sub(r'(\w+)_(\w+)', r'\1 sub \2', text)
+        text = re.sub(r'(\w+)_\{(.+?)\}', r'\1 sub \2', text)
+        return text
+    
+    def convert_fractions(self, text):
+        """Convert fractions to spoken form"""
+        # Handle simple fractions: a/b
+        text = re.sub(r'(\d+(?:\.\d+)?)\s*/\s*(\d+(?:\.\d+)?)', 
+                     r'\1 over \2', text)
+        return text
+    
+    def handle_derivatives(self, text):
+        """Convert derivative notation to spoken form"""
+        # d/dx → "derivative with respect to x"
+        text = re.sub(r'd/d(\w+)', r'derivative with respect to \1', text)
+        # dy/dx → "derivative of y with respect to x"
+        text = re.sub(r'd(\w+)/d(\w+)', 
+                     r'derivative of \1 with respect to \2', text)
+        # d²y/dx² → "second derivative of y with respect to x"
+        text = re.sub(r'd²(\w+)/d(\w+)²', 
+                     r'second derivative of \1 with respect to \2', text)
+        return text
+    
+    def remove_markdown(self, text):
+        """Remove markdown formatting"""
+        text = text.replace('**', '')
+        text = text.replace('*', '')
+        text = text.replace('`', '')
+        text = re.sub(r'#{1,6}\s+', '', text)
+        return text
+    
+    def convert(self, text):
+        """Main conversion method"""
+        text = self.remove_markdown(text)
+        text = self.convert_greek_letters(text)
+        text = self.convert_operators(text)
+        text = self.handle_derivatives(text)
+        text = self.convert_superscripts(text)
+        text = self.convert_subscripts(text)
+        text = self.convert_fractions(text)
+        
+        # Clean up extra spaces
+        text = re.sub(r'\s+', ' ', text)
+        return text.strip()
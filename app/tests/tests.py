@@ -0,0 +1,1406 @@
+import asyncio
+import gzip
+import importlib
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from datetime import timedelta
+from unittest import mock
+
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import AnonymousUser, User
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from google.api_core.exceptions import NotFound, ResourceExhausted
+from PIL import Image, ImageDraw
+
+from .. import access, audio_cache, gemini, gemini_files, jobs, media_files, ocr, ocr_image, sketch_render, speech_cache, stroke_broadcast, stroke_buffer, stroke_codec, stroke_index, stroke_log, stroke_state, stroke_store, stroke_wire, thumbnails, views
+from ..consumer import SketchConsumer
+from ..stroke_simplify import rdp_mask, simplify_strokes
+from ..audio_generator import MathToSpeech
+from .math_speech_reference import MathToSpeech as ReferenceMathToSpeech
+from ..models import AudioBlob, Book, GeminiFile, Job, OcrResult, RetiredGeminiFile, Sketch, SketchAudio, SketchTile, SpeechSegment, StrokeClient, StrokeOp, StrokeState, Thumbnail, UserColor
+
+# The tests run the queue themselves, with jobs.work(..., idle_exit=True)
+_no_job_workers = override_settings(JOB_WORKERS=0)
+
+
+def setUpModule():
+    _no_job_workers.enable()
+
+
+def tearDownModule():
+    _no_job_workers.disable()
+
+
+# Outputs of the original step-by-step converter
+GOLDEN = [
+    ('**admin** wrote $x^2 + 3x = 10$, so x = 2 or x = -5.',
+     'admin wrote $x to the power of 2 + 3x = 10$, so x = 2 or x = -5.'),
+    ('## Solution\nThe derivative is d/dx (x^3) = 3x^2, and dy/dx = 2x.',
+     'Solution The derivative is derivative with respect to x (x to the power of 3) = 3x to the power of 2, and derivative of y with respect to x = 2x.'),
+    ('The area of a square of side 10 cm is 10² = 100 cm².',
+     'The area of a square of side 10 cm is 10 squared = 100 cm squared.'),
+    ('Using the power rule, $\\frac{d}{dx}(x^n) = nx^{n-1}$.',
+     'Using the power rule, $\\frac{d}{dx}(x to the power of n) = nx to the power of n-1$.'),
+    ('∫ x² dx = x³/3 + C, where C is a constant.',
+     'integral of x squared dx = x cubed/3 + C, where C is a constant.'),
+    ('For a triangle, α + β + γ = 180°, and Δx ≈ 0.5 when θ → 0.',
+     'For a triangle, alpha + beta + gamma = 180°, and Delta x approximately equals 0.5 when theta approaches 0.'),
+    ('x₁ + x₂ = 5 and x_1 × x_2 = 6, so x_{n+1} ≥ x_n.',
+     'x sub 1 + x sub 2 = 5 and x sub 1 times x sub 2 = 6, so x sub n+1 greater than or equal to x sub n.'),
+    ('Half of 3/4 is 3 / 8, and 1.5/0.5 = 3.',
+     'Half of 3 over 4 is 3 over 8, and 1.5 over 0.5 = 3.'),
+    ('`E = mc^2` relates energy and mass; c^{2} is the speed of light squared.',
+     'E = mc to the power of 2 relates energy and mass; c to the power of 2 is the speed of light squared.'),
+    ('If a ∈ A ∪ B and a ∉ A ∩ B, then √16 = 4 ± 0.',
+     'If a is an element of A union B and a ∉ A intersection B, then square root of 16 = 4 plus or minus 0.'),
+    ('### Step 2\n* Expand (a+b)^2 = a^2 + 2ab + b^2\n* Simplify: ∑ k = n(n+1)/2',
+     'Step 2 Expand (a+b)^2 = a to the power of 2 + 2ab + b to the power of 2 Simplify: sum of k = n(n+1)/2'),
+    ('The second derivative d²y/dx² of y = x⁴ is 12x².',
+     'The second derivative derivative of squaredy with respect to x squared of y = x to the power of 4 is 12x squared.'),
+    ('e^{iπ} + 1 = 0 and x^2/2 is the integral of x; σ_{x}² is the variance.',
+     'e to the power of i pi + 1 = 0 and x to the power of 2 over 2 is the integral of x; sigma _{x} squared is the variance.'),
+]
+
+
+class MathToSpeechTests(SimpleTestCase):
+    def setUp(self):
+        self.converter = MathToSpeech()
+        self.reference = ReferenceMathToSpeech()
+
+    def test_golden_outputs(self):
+        for text, expected in GOLDEN:
+            with self.subTest(text=text):
+                self.assertEqual(self.converter.convert(text), expected)
+
+    def test_golden_outputs_are_the_original_converter_outputs(self):
+        for text, expected in GOLDEN:
+            with self.subTest(text=text):
+                self.assertEqual(self.reference.convert(text), expected)
+
+    def test_matches_original_converter(self):
+        # Random strings dense in the characters the steps interact on
+        alphabet = (
+            list("abxyzdn0123456789^_/{}#*`. .\n\t") + list("²³¹ⁿ₁₂αδπ∫×≤√")
+            + ['\xa0', 'd/d', '^{', '_{', '} ', ' / ', '# ', '**']
+        )
+        rng = random.Random(15)
+        for _ in range(20000):
+            text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+            self.assertEqual(self.converter.convert(text), self.reference.convert(text), repr(text))
+
+    def test_long_unclosed_groups(self):
+        # The original patterns backtrack quadratically on these
+        for text in ("x^{" * 1000, "x_{" * 1000, "a^1" * 1000 + "}", "1 /" * 1000):
+            with self.subTest(text=text[:6]):
+                self.assertEqual(self.converter.convert(text), self.reference.convert(text))
+
+
+def segment(x1, y1, x2, y2, user=1, color="#000000", width=2, eraser=False):
+    return {"x1": x1, "y1": y1, "x2": x2, "y2": y2, "color": color,
+            "eraser": eraser, "width": width, "user": user}
+
+
+class StrokeCodecTests(SimpleTestCase):
+    def test_round_trip(self):
+        strokes = [
+            segment(0, 0, 10.5, 3.2), segment(10.5, 3.2, 20, -4),  # one polyline
+            segment(100, 100, 101, 101, color="#ff0000", width=4.5, user=None),
+            segment(1, 1, 2, 2, eraser=True, width=20, user=7),
+        ]
+        self.assertEqual(stroke_codec.decode_strokes(stroke_codec.encode_strokes(strokes)), strokes)
+
+    def test_the_packing_migration_writes_version_1_blobs(self):
+        migration = importlib.import_module("app.migrations.0008_sketch_strokes_packed")
+        rng = random.Random(8)
+        strokes = [segment(0, 0, 1, 1, user="abc", width="wide"), {"path": "M0 0"}]
+        x, y = 0.0, 0.0
+        for i in range(500):  # long enough for a zlib chunk
+            nx, ny = x + rng.uniform(-20, 20), y + rng.uniform(-20, 20)
+            strokes.append(segment(x, y, nx, ny, color=rng.choice(["#000000", "#ff0000"]), user=i % 3))
+            x, y = (nx, ny) if rng.random() < 0.9 else (rng.uniform(0, 500), rng.uniform(0, 500))
+        blob = migration.encode_strokes(strokes)
+        self.assertEqual(blob[:3], b"SK\x01")
+        self.assertEqual(blob, stroke_codec.encode_strokes(strokes))
+        self.assertEqual(migration.decode_strokes(blob), stroke_codec.decode_strokes(blob))
+        self.assertEqual(migration.encode_strokes([]), stroke_codec.encode_strokes([]))
+
+    def test_coordinates_are_quantized_to_a_tenth_of_a_pixel(self):
+        decoded = stroke_codec.decode_strokes(stroke_codec.encode_strokes([segment(0.04, 0.06, 1.23, 4.56)]))
+        self.assertEqual((decoded[0]["x1"], decoded[0]["y1"], decoded[0]["x2"], decoded[0]["y2"]), (0, 0.1, 1.2, 4.6))
+
+    def test_segments_without_coordinates_are_skipped(self):
+        blob = stroke_codec.encode_strokes([{"path": "M0 0"}, segment(0, 0, 1, 1)])
+        self.assertEqual(stroke_codec.segment_count(blob), 1)
+
+    def test_append_and_concat_keep_earlier_chunks(self):
+        first, second = [segment(0, 0, 1, 1)], [segment(5, 5, 6, 6, user=2)]
+        blob = stroke_codec.append_strokes(stroke_codec.encode_strokes(first), second)
+        self.assertTrue(blob.startswith(stroke_codec.encode_strokes(first)))
+        self.assertEqual(stroke_codec.decode_strokes(blob), first + second)
+        self.assertEqual(stroke_codec.concat(stroke_codec.encode_strokes(first), stroke_codec.encode_strokes(second)), blob)
+        self.assertEqual(
+            stroke_codec.decode_polylines_from(blob, len(stroke_codec.encode_strokes(first))),
+            stroke_codec.decode_polylines(stroke_codec.encode_strokes(second)),
+        )
+
+    def test_compact_merges_chunks_that_join_up(self):
+        blob = stroke_codec.encode_strokes([segment(0, 0, 1, 1)])
+        blob = stroke_codec.append_strokes(blob, [segment(1, 1, 2, 2)])
+        compacted = stroke_codec.compact(blob)
+        self.assertEqual(len(stroke_codec.decode_polylines(compacted)), 1)
+        self.assertEqual(stroke_codec.decode_strokes(compacted), stroke_codec.decode_strokes(blob))
+        self.assertLess(len(compacted), len(blob))
+
+    def test_large_chunks_are_compressed(self):
+        strokes = [segment(i, 0, i + 1, 0, color=f"#{i:06x}") for i in range(500)]
+        blob = stroke_codec.encode_strokes(strokes)
+        self.assertLess(len(blob), len(json.dumps(strokes)) // 4)
+        self.assertEqual(stroke_codec.decode_strokes(blob), strokes)
+
+    def test_invalid_blobs_raise(self):
+        blob = stroke_codec.encode_strokes([segment(0, 0, 1, 1)])
+        for bad in (b"XX\x01", blob[:2] + b"\x09" + blob[3:], blob[:-2]):
+            with self.subTest(bad=bad):
+                with self.assertRaises(stroke_codec.StrokeCodecError):
+                    stroke_codec.decode_polylines(bad)
+
+
+class TempMediaMixin:
+    """Runs the tests with MEDIA_ROOT in a temporary directory."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls._media_root = tempfile.mkdtemp()
+        cls._media_override = override_settings(MEDIA_ROOT=cls._media_root)
+        cls._media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls._media_override.disable()
+        shutil.rmtree(cls._media_root, ignore_errors=True)
+
+
+class StrokeSimplifyTests(SimpleTestCase):
+    def test_rdp_keeps_the_corners(self):
+        import numpy as np
+        points = np.array([(0, 0), (1, 0.1), (2, -0.1), (3, 0), (3, 1), (3, 2), (3.1, 3)], dtype=float)
+        self.assertEqual(rdp_mask(points, 0.5).tolist(), [True, False, False, True, False, False, True])
+
+    def test_simplified_strokes_stay_within_the_tolerance(self):
+        xs = [i * 0.5 for i in range(200)]
+        curve = [(x, 20 * math.sin(x / 15)) for x in xs]
+        strokes = [segment(*a, *b) for a, b in zip(curve, curve[1:])]
+        simplified = simplify_strokes(strokes, tolerance=0.5)
+        self.assertLess(len(simplified), len(strokes) // 4)
+        self.assertEqual((simplified[0]["x1"], simplified[-1]["x2"]), (strokes[0]["x1"], strokes[-1]["x2"]))
+        for x, y in curve:
+            nearest = min(
+                abs((s["y2"] - s["y1"]) * (x - s["x1"]) - (s["x2"] - s["x1"]) * (y - s["y1"]))
+                / math.hypot(s["x2"] - s["x1"], s["y2"] - s["y1"])
+                for s in simplified if s["x1"] <= x <= s["x2"]
+            )
+            self.assertLessEqual(nearest, 0.5 + 0.1)
+
+    def test_paths_of_different_styles_are_not_merged(self):
+        strokes = [segment(0, 0, 1, 0), segment(1, 0, 2, 0, color="#ff0000"), segment(2, 0, 3, 0)]
+        self.assertEqual(simplify_strokes(strokes, tolerance=5), strokes)
+
+    def test_zero_tolerance_returns_the_strokes_unchanged(self):
+        strokes = [segment(0, 0, 1, 0), segment(1, 0, 2, 0)]
+        self.assertIs(simplify_strokes(strokes, tolerance=0), strokes)
+
+    def test_invalid_styles_are_normalized(self):
+        strokes = [
+            segment(0, 0, 1, 1, user="abc"), segment(5, 5, 6, 6, user=-3, width="wide"),
+            segment(9, 9, 8, 8, user=True, width=-4), segment(float("inf"), 0, 1, 1), segment(float("nan"), 0, 1, 1),
+        ]
+        simplified = simplify_strokes(strokes, tolerance=0.5)
+        self.assertEqual([(s["user"], s["width"]) for s in simplified], [(None, 2), (None, 2), (None, 0)])
+
+
+class SketchTestCase(TestCase):
+    """A book owned by ``owner`` with one empty sketch."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user("owner", password="pw")
+        cls.book = Book.objects.create(name="Algebra", created_by=cls.owner)
+        cls.sketch = Sketch.objects.create(name="Page 1", book=cls.book, created_by=cls.owner)
+
+    def setUp(self):
+        self.client.force_login(self.owner)
+        # Revisions restart with every test, an index cached by another would look current
+        stroke_index.forget(self.sketch.id)
+
+    def post_json(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type="application/json")
+
+
+class AppendStrokesTests(SketchTestCase):
+    def url(self):
+        return f"/sketch/{self.sketch.id}/strokes/append/"
+
+    def test_appends_in_seq_order_and_ignores_resends(self):
+        first = self.post_json(self.url(), {"client_id": "tab", "seq": 1, "strokes": [segment(0, 0, 5, 5)]})
+        self.assertEqual(first.json(), {"status": "appended", "seq": 1, "revision": 1})
+        resent = self.post_json(self.url(), {"client_id": "tab", "seq": 1, "strokes": [segment(0, 0, 5, 5)]})
+        self.assertEqual(resent.json()["status"], "duplicate")
+        self.assertEqual(len(Sketch.objects.get(pk=self.sketch.pk).strokes), 1)
+
+    def test_seq_gap_is_rejected_with_expected_seq(self):
+        response = self.post_json(self.url(), {"client_id": "tab", "seq": 3, "strokes": [segment(0, 0, 5, 5)]})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["expected_seq"], 1)
+        self.assertEqual(Sketch.objects.get(pk=self.sketch.pk).stroke_revision, 0)
+
+    def test_strokes_are_attributed_to_the_sender(self):
+        self.post_json(self.url(), {"client_id": "tab", "seq": 1, "strokes": [segment(0, 0, 5, 5, user=999)]})
+        self.assertEqual(Sketch.objects.get(pk=self.sketch.pk).strokes[0]["user"], self.owner.id)
+
+    def test_payload_that_is_not_an_object_is_rejected(self):
+        for payload in ([], "strokes", 3):
+            with self.subTest(payload=payload):
+                self.assertEqual(self.post_json(self.url(), payload).status_code, 400)
+
+    def test_idle_clients_expire(self):
+        self.post_json(self.url(), {"client_id": "old", "seq": 1, "strokes": [segment(0, 0, 5, 5)]})
+        self.post_json(self.url(), {"client_id": "new", "seq": 1, "strokes": [segment(5, 5, 9, 9)]})
+        StrokeClient.objects.filter(client_id="old").update(updated_at=timezone.now() - timedelta(days=30))
+        self.assertEqual(stroke_store.expire_clients(self.sketch.id, ttl=24 * 3600), 1)
+        self.assertEqual(list(StrokeClient.objects.values_list("client_id", flat=True)), ["new"])
+
+
+@override_settings(STROKE_FLUSH_SEGMENTS=2, STROKE_FLUSH_INTERVAL=0.01)
+class StrokeBufferTests(SimpleTestCase):
+    def setUp(self):
+        self.written = []
+        self.failures = 0
+        patcher = mock.patch.object(thumbnails, "schedule")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def append(self, sketch_id, strokes):
+        time.sleep(0.02)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("database is locked")
+        self.written.extend(strokes)
+
+    async def test_a_burst_queues_at_most_one_flush_behind_the_running_one(self):
+        with mock.patch.object(stroke_store, "append_strokes", self.append):
+            buffer = stroke_buffer.acquire(-1)
+            for i in range(100):
+                buffer.add([segment(i, 0, i + 1, 0)] * 2)
+                self.assertLessEqual(len(buffer._tasks), 2)
+                if i % 10 == 0:
+                    await asyncio.sleep(0)
+            await stroke_buffer.release(-1)
+        self.assertEqual([s["x1"] for s in self.written], [i for i in range(100) for _ in range(2)])
+        self.assertNotIn(-1, stroke_buffer._buffers)
+
+    async def test_a_failed_flush_is_retried_after_the_last_connection_left(self):
+        self.failures = 1
+        with mock.patch.object(stroke_store, "append_strokes", self.append):
+            buffer = stroke_buffer.acquire(-2)
+            buffer.add([segment(0, 0, 1, 1)])
+            await stroke_buffer.release(-2)
+            self.assertEqual(self.written, [])
+            self.assertIn(-2, stroke_buffer._buffers)
+            for _ in range(50):
+                await asyncio.sleep(0.01)
+                if -2 not in stroke_buffer._buffers:
+                    break
+        self.assertEqual(len(self.written), 1)
+        self.assertNotIn(-2, stroke_buffer._buffers)
+
+
+class FakeChannelLayer:
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+
+class RoomCoalescerTests(SimpleTestCase):
+    @override_settings(STROKE_BROADCAST_TICK=0.01)
+    async def test_segments_within_a_tick_go_out_as_one_event(self):
+        layer = FakeChannelLayer()
+        room = stroke_broadcast.acquire(layer, "sketch_-1")
+        for i in range(5):
+            await room.add([segment(i, 0, i + 1, 0)])
+        self.assertEqual(layer.sent, [])
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(layer.sent), 1)
+        group, message = layer.sent[0]
+        self.assertEqual((group, message["type"], len(message["strokes"])), ("sketch_-1", "broadcast_draw", 5))
+        await stroke_broadcast.release("sketch_-1")
+        self.assertNotIn("sketch_-1", stroke_broadcast._rooms)
+
+    @override_settings(STROKE_BROADCAST_TICK=0)
+    async def test_no_tick_sends_every_batch(self):
+        layer = FakeChannelLayer()
+        room = stroke_broadcast.acquire(layer, "sketch_-2")
+        await room.add([segment(0, 0, 1, 1)])
+        await room.add([segment(1, 1, 2, 2)])
+        self.assertEqual(len(layer.sent), 2)
+        await stroke_broadcast.release("sketch_-2")
+
+    @override_settings(STROKE_BROADCAST_TICK=10)
+    async def test_the_last_connection_out_sends_what_is_pending(self):
+        layer = FakeChannelLayer()
+        stroke_broadcast.acquire(layer, "sketch_-3")
+        room = stroke_broadcast.acquire(layer, "sketch_-3")
+        await room.add([segment(0, 0, 1, 1)])
+        await stroke_broadcast.release("sketch_-3")
+        self.assertEqual(layer.sent, [])
+        await stroke_broadcast.release("sketch_-3")
+        self.assertEqual(len(layer.sent), 1)
+
+
+class StrokeWireTests(SimpleTestCase):
+    def test_round_trip(self):
+        strokes = [
+            segment(0, 0, 10.25, -3.5, color="#FF0000", user=3),
+            segment(10.25, -3.5, 12, 4, width=5.5, eraser=True, user=None),
+        ]
+        decoded = stroke_wire.decode_frame(stroke_wire.encode_frame(strokes))
+        strokes[0]["color"] = "#ff0000"
+        self.assertEqual(decoded, strokes)
+
+    def test_batches_that_do_not_fit_a_frame(self):
+        too_many_colors = [segment(i, 0, i + 1, 0, color=f"#{i:06x}") for i in range(257)]
+        cases = {
+            "named color": [segment(0, 0, 1, 1, color="red")],
+            "too many colors": too_many_colors,
+            "non-numeric user": [segment(0, 0, 1, 1, user="abc")],
+            "negative user": [segment(0, 0, 1, 1, user=-2)],
+        }
+        self.assertTrue(stroke_wire.can_encode(too_many_colors[:256]))
+        for name, strokes in cases.items():
+            with self.subTest(name):
+                self.assertFalse(stroke_wire.can_encode(strokes))
+                with self.assertRaises(stroke_wire.WireFormatError):
+                    stroke_wire.encode_frame(strokes)
+
+    def test_segments_without_finite_coordinates_raise_a_wire_error(self):
+        with self.assertRaises(stroke_wire.WireFormatError):
+            stroke_wire.encode_frame([segment(float("inf"), 0, 1, 1)])
+
+    def test_truncated_frames_raise(self):
+        frame = stroke_wire.encode_frame([segment(0, 0, 1, 1)])
+        for bad in (b"", b"\x02", frame[:-1]):
+            with self.subTest(bad=bad):
+                with self.assertRaises(stroke_wire.WireFormatError):
+                    stroke_wire.decode_frame(bad)
+
+    async def test_binary_clients_get_json_when_a_batch_cannot_be_framed(self):
+        consumer = SketchConsumer()
+        consumer.sketch_id, consumer.binary, consumer.batched = 1, True, False
+        sent = []
+
+        async def send(text_data=None, bytes_data=None):
+            sent.append(bytes_data if bytes_data is not None else json.loads(text_data))
+
+        consumer.send = send
+        await consumer.broadcast_draw({"type": "broadcast_draw", "strokes": [segment(0, 0, 1, 1)]})
+        await consumer.broadcast_draw({"type": "broadcast_draw", "strokes": [segment(0, 0, 1, 1, user="abc")]})
+        with mock.patch.object(stroke_wire, "can_encode", return_value=True):
+            await consumer.broadcast_draw({"type": "broadcast_draw", "strokes": [segment("x", 0, 1, 1)]})
+        self.assertIsInstance(sent[0], bytes)
+        self.assertEqual(sent[1]["type"], "strokes")
+        self.assertEqual(sent[2]["type"], "strokes")
+
+
+class SketchRenderTests(TempMediaMixin, SketchTestCase):
+    def test_image_covers_the_ink_plus_margin(self):
+        polylines = stroke_codec.decode_polylines(stroke_codec.encode_strokes([segment(10, 10, 100, 50)]))
+        image = sketch_render.render_polylines(polylines)
+        self.assertEqual(image.size, (100 + 1 + sketch_render.MARGIN, 50 + 1 + sketch_render.MARGIN))
+        self.assertEqual(image.getpixel((55, 30)), (0, 0, 0))
+
+    @override_settings(SKETCH_CANVAS_MAX=2000, SKETCH_RENDER_MAX_SIDE=500)
+    def test_stray_points_cannot_make_a_huge_image(self):
+        strokes = [segment(10, 10, 100, 100), segment(100, 100, 1e6, 1e6)]
+        image = sketch_render.render_polylines(stroke_codec.decode_polylines(stroke_codec.encode_strokes(strokes)))
+        self.assertLessEqual(max(image.size), 500)
+        self.assertEqual(sketch_render.clamp_bbox((-5, 10, 1e6, 20)), (0.0, 10, 2000.0, 20))
+        self.assertIsNone(sketch_render.clamp_bbox((3000, 3000, 4000, 4000)))
+
+    def test_sketch_image_is_rendered_once_per_revision(self):
+        stroke_store.append_strokes(self.sketch.id, [segment(0, 0, 50, 50)])
+        sketch = Sketch.objects.get(pk=self.sketch.pk)
+        image = sketch_render.ensure_sketch_image(sketch)
+        self.assertEqual((sketch.image_revision, image.name), (1, sketch.image.name))
+        with mock.patch.object(sketch_render, "render_polylines") as render:
+            sketch_render.ensure_sketch_image(Sketch.objects.get(pk=self.sketch.pk))
+        render.assert_not_called()
+
+    def test_cleared_sketch_has_no_image(self):
+        stroke_store.append_strokes(self.sketch.id, [segment(0, 0, 50, 50)])
+        sketch_render.ensure_sketch_image(Sketch.objects.get(pk=self.sketch.pk))
+        stroke_store.clear_strokes(self.sketch.id)
+        self.assertIsNone(sketch_render.ensure_sketch_image(Sketch.objects.get(pk=self.sketch.pk)))
+
+    def test_ocr_renders_the_strokes_without_the_full_size_image(self):
+        stroke_store.append_strokes(self.sketch.id, [segment(0, 0, 50, 50)])
+        sketch = Sketch.objects.select_related("book").get(pk=self.sketch.pk)
+        with mock.patch.object(ocr, "_send", return_value="A diagonal line.") as send:
+            text, cached = ocr.run_ocr(sketch)
+        self.assertEqual((text, cached), ("A diagonal line.", False))
+        self.assertEqual(send.call_args[0][0][0].mime_type.split("/")[0], "image")
+        self.assertFalse(Sketch.objects.get(pk=self.sketch.pk).image)
+
+
+@override_settings(THUMBNAIL_SIZES=(40, 80))
+class ThumbnailTests(TempMediaMixin, SketchTestCase):
+    def thumbnail_jobs(self):
+        return list(Job.objects.filter(kind="sketch_thumbnails").values_list("payload", "status"))
+
+    def test_stroke_changes_queue_one_job_per_sketch(self):
+        queued = [({"sketch_id": self.sketch.id}, Job.QUEUED)]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post_json(f"/sketch/{self.sketch.id}/strokes/append/", {"client_id": "tab", "seq": 1, "strokes": [segment(0, 0, 50, 50)]})
+            self.post_json(f"/sketch/{self.sketch.id}/strokes/append/", {"client_id": "tab", "seq": 2, "strokes": [segment(50, 50, 90, 10)]})
+        self.assertEqual(self.thumbnail_jobs(), queued)
+
+        for url, data in [
+            (f"/sketch/{self.sketch.id}/erase/", {"rect": [40, 0, 100, 60]}),
+            (f"/sketch/{self.sketch.id}/undo/", {}),
+            (f"/clear-sketch/{self.sketch.id}/", {}),
+        ]:
+            with self.subTest(url=url):
+                Job.objects.filter(kind="sketch_thumbnails").update(status=Job.DONE)
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.assertLess(self.post_json(url, data).status_code, 300)
+                self.assertEqual(self.thumbnail_jobs().count(queued[0]), 1)
+
+    @override_settings(THUMBNAIL_DELAY=60)
+    def test_jobs_wait_for_the_changes_that_follow(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                thumbnails.schedule(self.sketch.id)
+        job = Job.objects.get(kind="sketch_thumbnails")
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=50))
+        jobs.work("test", idle_exit=True)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.QUEUED)
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        jobs.work("test", idle_exit=True)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result), (Job.DONE, {"sketch_id": self.sketch.id, "thumbnail_key": ""}))
+
+    async def test_websocket_changes_queue_a_job(self):
+        consumer = SketchConsumer()
+        consumer.sketch_id, consumer.scope = self.sketch.id, {"user": self.owner}
+        consumer.stroke_buffer, consumer.room = mock.AsyncMock(), mock.AsyncMock()
+        consumer.channel_layer, consumer.room_group_name = FakeChannelLayer(), "sketch"
+        with mock.patch.object(thumbnails, "schedule") as schedule:
+            await consumer.receive(text_data=json.dumps({"type": "erase", "rect": [0, 0, 10, 10]}))
+            await consumer.receive(text_data=json.dumps({"type": "undo"}))
+            schedule.assert_not_called()  # nothing to erase or undo
+
+            await database_sync_to_async(stroke_buffer._persist)(self.sketch.id, [segment(0, 0, 5, 5, user=self.owner.id)])
+            await consumer.receive(text_data=json.dumps({"type": "erase", "rect": [0, 0, 10, 10]}))
+            await consumer.receive(text_data=json.dumps({"type": "undo"}))
+        self.assertEqual(schedule.call_args_list, [mock.call(self.sketch.id)] * 3)
+
+    def test_job_makes_each_size_once(self):
+        stroke_store.append_strokes(self.sketch.id, [segment(0, 0, 300, 100)])
+        key = thumbnails.update_sketch(Sketch.objects.get(pk=self.sketch.pk))
+        self.assertEqual(Sketch.objects.get(pk=self.sketch.pk).thumbnail_key, key)
+        made = Thumbnail.objects.filter(key=key).order_by("size")
+        self.assertEqual([(t.size, max(t.width, t.height)) for t in made], [(40, 40), (80, 80)])
+        with mock.patch.object(thumbnails, "render") as render:
+            self.assertEqual(thumbnails.update_sketch(Sketch.objects.get(pk=self.sketch.pk)), key)
+        render.assert_not_called()
+
+        stroke_store.clear_strokes(self.sketch.id)
+        self.assertEqual(thumbnails.update_sketch(Sketch.objects.get(pk=self.sketch.pk)), "")
+        Thumbnail.objects.update(created_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(thumbnails.collect()[0], 2)
+        self.assertFalse(Thumbnail.objects.exists())
+
+    def test_covers_show_the_newest_sketch_of_each_book(self):
+        other = Book.objects.create(name="Geometry", created_by=self.owner)
+        empty = Book.objects.create(name="Empty", created_by=self.owner)
+        for book, name, key in [(self.book, "Page 2", "b" * 64), (self.book, "Page 3", ""), (other, "Page 1", "c" * 64)]:
+            Sketch.objects.create(name=name, book=book, created_by=self.owner, thumbnail_key=key)
+        Sketch.objects.filter(pk=self.sketch.pk).update(thumbnail_key="a" * 64)
+        for key in ("a", "b", "c"):
+            Thumbnail.objects.create(key=key * 64, size=40, width=40, height=20, file=f"thumbnails/{key}-40.webp")
+
+        with self.assertNumQueries(2):
+            books = views._attach_covers([self.book, other, empty])
+        self.assertEqual([book.cover and book.cover["url"] for book in books],
+                         ["/media/thumbnails/b-40.webp", "/media/thumbnails/c-40.webp", None])
+
+
+@override_settings(SKETCH_TILE_SIZE=256, SKETCH_TILE_LEVELS=4)
+class SketchTileTests(SketchTestCase):
+    def tile(self, level, x, y, **headers):
+        return self.client.get(f"/sketch/{self.sketch.id}/tiles/{level}/{x}/{y}.png", headers=headers)
+
+    def test_tiles_with_ink_are_cached_and_revalidated(self):
+        stroke_store.append_strokes(self.sketch.id, [segment(10, 10, 600, 20)])
+        response = self.tile(0, 1, 0)
+        self.assertEqual((response.status_code, response["Content-Type"]), (200, "image/png"))
+        self.assertEqual(SketchTile.objects.filter(sketch=self.sketch).count(), 1)
+        self.assertEqual(self.tile(0, 1, 0, if_none_match=response["ETag"]).status_code, 304)
+
+    def test_tiles_outside_the_ink_are_not_found_and_not_stored(self):
+        stroke_store.append_strokes(self.sketch.id, [segment(10, 10, 20, 20)])
+        self.assertEqual(self.tile(0, 999999, 999999).status_code, 404)
+        self.assertEqual(self.tile(0, 1, 0).status_code, 404)
+        self.assertFalse(SketchTile.objects.exists())
+
+    def test_blank_tiles_inside_the_ink_box_are_not_stored(self):
+        # An L: the bounding box covers tile (1, 1) but no stroke crosses it
+        stroke_store.append_strokes(self.sketch.id, [segment(10, 10, 10, 500), segment(10, 10, 500, 10)])
+        self.assertEqual(self.tile(0, 1, 1).status_code, 200)
+        self.assertFalse(SketchTile.objects.exists())
+
+    def test_appends_invalidate_the_tiles_they_touch(self):
+        stroke_store.append_strokes(self.sketch.id, [segment(10, 10, 600, 20)])
+        self.tile(0, 0, 0)
+        self.tile(0, 2, 0)
+        stroke_store.append_strokes(self.sketch.id, [segment(20, 20, 30, 30)])
+        self.assertEqual(list(SketchTile.objects.values_list("x", flat=True)), [2])
+
+    def test_erases_invalidate_the_tiles_of_the_whole_erased_segments(self):
+        stroke_store.append_strokes(self.sketch.id, [segment(10, 10, 600, 20)])
+        self.tile(0, 0, 0)
+        self.tile(0, 2, 0)
+        # Only touches tile (0, 0), but the segment goes on to tile (2, 0)
+        self.assertEqual(stroke_store.erase_region(self.sketch.id, (5, 5, 30, 30))[0], 1)
+        self.assertFalse(SketchTile.objects.exists())
+        self.assertEqual(self.tile(0, 2, 0).status_code, 404)
+
+    def test_info_reports_the_clamped_ink_box(self):
+        stroke_store.append_strokes(self.sketch.id, [segment(10, 10, 100, 1e6)])
+        info = self.client.get(f"/sketch/{self.sketch.id}/tiles/").json()
+        self.assertEqual(info["segments"], 1)
+        self.assertEqual(info["bbox"][3], 8192)
+
+
+class InvalidStrokeTests(SketchTestCase):
+    def test_save_sketch_accepts_strokes_with_invalid_users(self):
+        response = self.post_json("/save-sketch/", {"id": self.sketch.id, "strokes": [segment(0, 0, 1, 1, user="abc")]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(Sketch.objects.get(pk=self.sketch.pk).strokes), 1)
+
+    async def test_websocket_strokes_with_invalid_users_are_buffered(self):
+        consumer = SketchConsumer()
+        consumer.scope = {"user": self.owner}
+        consumer.stroke_buffer = mock.Mock()
+        consumer.room = mock.AsyncMock()
+        await consumer.receive(text_data=json.dumps({"type": "strokes", "strokes": [segment(0, 0, 1, 1, user="abc")]}))
+        consumer.stroke_buffer.add.assert_called_once()
+
+    async def test_websocket_strokes_are_attributed_to_the_connected_user(self):
+        consumer = SketchConsumer()
+        consumer.scope = {"user": self.owner}
+        consumer.stroke_buffer = mock.Mock()
+        consumer.room = mock.AsyncMock()
+        await consumer.receive(text_data=json.dumps([segment(0, 0, 1, 1, user=999), segment(5, 5, 6, 6)]))
+        [strokes], _ = consumer.stroke_buffer.add.call_args
+        self.assertEqual([s["user"] for s in strokes], [self.owner.id, self.owner.id])
+
+    def test_save_sketch_attributes_only_new_strokes_to_the_sender(self):
+        other = User.objects.create_user("other", password="pw")
+        stroke_store.append_strokes(self.sketch.id, [segment(0, 0, 1, 1, user=other.id)])
+        self.post_json("/save-sketch/", {"id": self.sketch.id, "strokes": [
+            segment(0, 0, 1, 1, user=other.id), segment(5, 5, 6, 6, user=other.id),
+        ]})
+        self.assertEqual([s["user"] for s in Sketch.objects.get(pk=self.sketch.pk).strokes], [other.id, self.owner.id])
+
+
+@override_settings(STROKE_SNAPSHOT_EVERY=0)
+class StrokeLogTests(SketchTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = User.objects.create_user("other", password="pw")
+
+    def setUp(self):
+        super().setUp()
+        self.a, self.b = self.owner.id, self.other.id
+
+    def draw(self, *strokes):
+        stroke_store.append_strokes(self.sketch.id, list(strokes))
+        return self.head()
+
+    def head(self):
+        return bytes(Sketch.objects.get(pk=self.sketch.pk).strokes_packed)
+
+    def users(self, blob):
+        return [s["user"] for s in stroke_codec.decode_strokes(blob)]
+
+    def test_load_replays_every_revision_in_the_log(self):
+        heads = [b"", self.draw(segment(0, 0, 10, 0, user=self.a)), self.draw(segment(0, 5, 10, 5, user=self.b))]
+        stroke_store.erase_region(self.sketch.id, [-1, -1, 11, 1], self.a)
+        heads.append(self.head())
+        for revision, head in enumerate(heads):
+            with self.subTest(revision=revision):
+                self.assertEqual(stroke_log.load(self.sketch.id, revision), head)
+        self.assertEqual(self.users(heads[3]), [self.b])
+        with self.assertRaises(stroke_log.HistoryUnavailable):
+            stroke_log.load(self.sketch.id, 4)
+
+    def test_undo_reverts_the_users_own_paths_and_erases(self):
+        self.draw(segment(0, 0, 10, 0, user=self.a))
+        self.draw(segment(0, 5, 10, 5, user=self.b))
+        stroke_store.erase_region(self.sketch.id, [-1, -1, 11, 1], self.a)
+        self.assertEqual(self.users(self.head()), [self.b])
+
+        self.assertEqual(stroke_store.undo(self.sketch.id, self.a), (True, 4))  # the erase
+        self.assertEqual(sorted(self.users(self.head())), [self.a, self.b])
+        self.assertEqual(stroke_store.undo(self.sketch.id, self.a), (True, 5))  # the path
+        self.assertEqual(self.users(self.head()), [self.b])
+        self.assertEqual(stroke_store.undo(self.sketch.id, self.a), (False, 5))
+
+        stroke_store.clear_strokes(self.sketch.id, self.b)
+        self.assertEqual(stroke_store.undo(self.sketch.id, self.b), (False, 6))  # history ends at a clear
+
+    def test_saving_the_whole_sketch_keeps_the_undo_history(self):
+        first, second, third = segment(0, 0, 10, 0), segment(0, 5, 10, 5), segment(0, 9, 10, 9)
+        self.draw(segment(50, 50, 60, 60, user=self.b))
+        other = stroke_codec.decode_strokes(self.head())
+        kinds = lambda: list(StrokeOp.objects.order_by("revision").values_list("kind", flat=True))
+
+        self.assertEqual(stroke_store.set_strokes(self.sketch.id, other + [first], self.a), 2)
+        self.assertEqual(stroke_store.set_strokes(self.sketch.id, other + [first, second], self.a), 3)
+        self.assertEqual(stroke_store.set_strokes(self.sketch.id, other + [first, second], self.a), 3)  # unchanged
+        self.assertEqual(stroke_store.set_strokes(self.sketch.id, other + [second], self.a), 4)
+        self.assertEqual(kinds(), [StrokeOp.ADD, StrokeOp.ADD, StrokeOp.ADD, StrokeOp.ERASE])
+        self.assertEqual(stroke_codec.decode_strokes(stroke_log.load(self.sketch.id, 4)),
+                         stroke_codec.decode_strokes(self.head()))
+
+        self.assertEqual(stroke_store.undo(self.sketch.id, self.a), (True, 5))  # the erase
+        self.assertEqual(len(stroke_codec.decode_strokes(self.head())), 3)
+        self.assertEqual(stroke_store.undo(self.sketch.id, self.a), (True, 6))  # the second path
+        self.assertEqual(self.users(self.head()), [self.b, self.a])
+
+        # Anything else replaces the strokes, and so does a real clear
+        stroke_store.set_strokes(self.sketch.id, [third], self.a)
+        stroke_store.clear_strokes(self.sketch.id, self.a)
+        self.assertEqual(kinds()[-2:], [StrokeOp.CLEAR, StrokeOp.CLEAR])
+        self.assertEqual(stroke_store.undo(self.sketch.id, self.a), (False, 8))
+
+    def test_compaction_keeps_the_ops_to_undo(self):
+        self.draw(segment(0, 0, 10, 0, user=self.a))
+        self.draw(segment(0, 5, 10, 5, user=self.a))
+        # One snapshot of the two kept: nothing is dropped yet
+        self.assertEqual(stroke_log.compact(self.sketch.id, keep=2), (2, 0, 0))
+        self.assertEqual(stroke_store.undo(self.sketch.id, self.a), (True, 3))
+
+        self.draw(segment(0, 9, 10, 9, user=self.a))
+        # Snapshots at 2 and 4: the ops up to 2 are covered by the older one
+        self.assertEqual(stroke_log.compact(self.sketch.id, keep=2), (4, 2, 0))
+        self.assertEqual(
+            stroke_codec.decode_strokes(stroke_log.load(self.sketch.id, 2)),
+            [segment(0, 0, 10, 0, user=self.a), segment(0, 5, 10, 5, user=self.a)],
+        )
+        with self.assertRaises(stroke_log.HistoryUnavailable):
+            stroke_log.load(self.sketch.id, 1)
+        self.assertEqual(stroke_store.undo(self.sketch.id, self.a), (True, 5))
+        # The first path was drawn before the oldest snapshot kept
+        self.assertEqual(stroke_store.undo(self.sketch.id, self.a), (False, 5))
+        self.assertEqual(self.users(self.head()), [self.a])
+
+        self.draw(segment(0, 0, 1, 1, user=self.a))
+        # Snapshots at 4 and 6; the one at 2 goes with the ops up to 4
+        self.assertEqual(stroke_log.compact(self.sketch.id, keep=2), (6, 2, 1))
+
+
+@override_settings(STROKE_STATE_CHUNK=2)
+class StrokeStateTests(SketchTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = f"/sketch/{self.sketch.id}/strokes/state/"
+        stroke_store.append_strokes(self.sketch.id, [segment(0, 0, 1, 1), segment(1, 1, 2, 2), segment(5, 5, 6, 6)])
+
+    def get(self, encoding="gzip", etag=None):
+        headers = {"HTTP_ACCEPT_ENCODING": encoding}
+        if etag:
+            headers["HTTP_IF_NONE_MATCH"] = etag
+        return self.client.get(self.url, **headers)
+
+    def body(self, response):
+        return response.content if not response.streaming else b"".join(response.streaming_content)
+
+    def test_state_is_streamed_in_chunks_and_stored(self):
+        response = self.get()
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        body = gzip.decompress(self.body(response))
+        lines = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(lines[0], {"revision": 1, "segments": 3})
+        self.assertEqual([len(chunk) for chunk in lines[1:]], [2, 1])
+        self.assertEqual(StrokeState.objects.get().revision, 1)
+
+        # Served from the stored body without decoding the strokes again
+        with mock.patch.object(stroke_state, "lines") as lines_mock:
+            again = self.get()
+        lines_mock.assert_not_called()
+        self.assertFalse(again.streaming)
+        self.assertEqual(gzip.decompress(again.content), body)
+
+    def test_unchanged_strokes_are_not_modified(self):
+        etag = self.get()["ETag"]
+        response = self.get(etag=f'"other", {etag}')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        stroke_store.append_strokes(self.sketch.id, [segment(9, 9, 8, 8)])
+        response = self.get(etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(json.loads(gzip.decompress(self.body(response)).splitlines()[0])["revision"], 2)
+        self.assertEqual(list(StrokeState.objects.values_list("revision", flat=True)), [2])
+
+    def test_etag_differs_per_encoding(self):
+        deflated = self.get("deflate")
+        self.assertEqual(deflated["Content-Encoding"], "deflate")
+        self.assertEqual(json.loads(zlib.decompress(self.body(deflated)).splitlines()[0])["segments"], 3)
+        plain = self.get("gzip;q=0, identity")
+        self.assertFalse(plain.has_header("Content-Encoding"))
+        self.assertEqual(len(self.body(plain).splitlines()), 3)
+        self.assertEqual(self.get("gzip", etag=deflated["ETag"]).status_code, 200)
+        self.assertEqual(self.get("deflate", etag=deflated["ETag"]).status_code, 304)
+        self.assertEqual(stroke_state.negotiate("*"), "gzip")
+        self.assertEqual(stroke_state.negotiate("br"), "identity")
+
+
+class MediaFilesTests(TempMediaMixin, SketchTestCase):
+    def setUp(self):
+        super().setUp()
+        access.forget()
+        for folder in ("sketches", "thumbnails", "audio_summaries"):
+            os.makedirs(os.path.join(self._media_root, folder), exist_ok=True)
+        self.write("sketches/page.png", b"0123456789")
+        Sketch.objects.filter(pk=self.sketch.pk).update(image="sketches/page.png")
+
+    def write(self, name, data):
+        with open(os.path.join(self._media_root, name), "wb") as f:
+            f.write(data)
+
+    def get(self, name="sketches/page.png", **headers):
+        response = self.client.get(f"/media/{name}", **headers)
+        body = b"".join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_files_carry_validators(self):
+        response, body = self.get()
+        self.assertEqual((response.status_code, body), (200, b"0123456789"))
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+        self.assertTrue(response.has_header("Last-Modified"))
+        Sketch.objects.filter(pk=self.sketch.pk).update(thumbnail_key="ab" * 32)
+        name = f"thumbnails/{'ab' * 32}-40.webp"
+        self.write(name, b"x")
+        self.assertIn("immutable", self.get(name)[0]["Cache-Control"])
+
+    def test_range_requests(self):
+        for header, status, body, content_range in [
+            ("bytes=2-5", 206, b"2345", "bytes 2-5/10"),
+            ("bytes=7-", 206, b"789", "bytes 7-9/10"),
+            ("bytes=-3", 206, b"789", "bytes 7-9/10"),
+            ("bytes=8-100", 206, b"89", "bytes 8-9/10"),
+            ("bytes=0-1,4-5", 200, b"0123456789", None),  # multi-range: whole file
+            ("bytes=5-2", 200, b"0123456789", None),
+            ("bytes=10-", 416, b"", "bytes */10"),
+        ]:
+            with self.subTest(header=header):
+                response, content = self.get(HTTP_RANGE=header)
+                self.assertEqual((response.status_code, content), (status, body))
+                self.assertEqual(response.get("Content-Range"), content_range)
+                if status == 206:
+                    self.assertEqual(response["Content-Length"], str(len(body)))
+
+    def test_if_range_with_an_old_etag_gets_the_whole_file(self):
+        etag = self.get()[0]["ETag"]
+        self.assertEqual(self.get(HTTP_RANGE="bytes=0-1", HTTP_IF_RANGE=etag)[0].status_code, 206)
+        self.assertEqual(self.get(HTTP_RANGE="bytes=0-1", HTTP_IF_RANGE='"old"')[0].status_code, 200)
+
+    def test_unchanged_files_are_not_modified(self):
+        response, _ = self.get()
+        etag, modified = response["ETag"], response["Last-Modified"]
+        for headers in ({"HTTP_IF_NONE_MATCH": etag}, {"HTTP_IF_NONE_MATCH": "*"}, {"HTTP_IF_MODIFIED_SINCE": modified}):
+            with self.subTest(headers=headers):
+                not_modified, body = self.get(**headers)
+                self.assertEqual((not_modified.status_code, body), (304, b""))
+                self.assertEqual(not_modified["ETag"], etag)
+
+        self.write("sketches/page.png", b"changed")
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag)[0].status_code, 200)
+
+    def test_files_are_served_to_the_users_of_their_sketches_only(self):
+        key = audio_cache.cache_key("The sum is 5.", "hi")
+        self.write(audio_cache.blob_name(key), b"mp3")
+        blob = AudioBlob.objects.create(key=key, language="hi", file=audio_cache.blob_name(key), size=3)
+        Sketch.objects.filter(pk=self.sketch.pk).update(thumbnail_key="cd" * 32)
+        self.write(f"thumbnails/{'cd' * 32}-40.webp", b"webp")
+        names = ["sketches/page.png", f"thumbnails/{'cd' * 32}-40.webp", audio_cache.blob_name(key)]
+        self.assertEqual([self.get(name)[0].status_code for name in names], [200, 200, 403])
+        SketchAudio.objects.create(sketch=self.sketch, language="hi", blob=blob)
+        self.assertEqual(self.get(audio_cache.blob_name(key))[0].status_code, 200)
+
+        stranger = User.objects.create_user("stranger", password="pw")
+        self.client.force_login(stranger)
+        self.assertEqual([self.get(name)[0].status_code for name in names], [403, 403, 403])
+        self.book.collaborators.add(stranger)
+        self.assertEqual([self.get(name)[0].status_code for name in names], [200, 200, 200])
+        self.client.logout()
+        self.assertEqual(self.get()[0].status_code, 403)
+
+    def test_files_no_sketch_uses_are_not_served(self):
+        self.write("sketches/other.png", b"x")
+        for name in ("sketches/other.png", "sketches", "../settings.py", "thumbnails/x.webp", "db.sqlite3"):
+            with self.subTest(name=name):
+                self.assertEqual(self.get(name)[0].status_code, 403)
+        # Used, but gone from the disk
+        Sketch.objects.filter(pk=self.sketch.pk).update(image="sketches/none.png")
+        self.assertEqual(self.get("sketches/none.png")[0].status_code, 404)
+
+    def test_sending_is_handed_off_to_the_front_server(self):
+        with override_settings(MEDIA_ACCEL_REDIRECT="/protected-media/"):
+            response, body = self.get(HTTP_RANGE="bytes=0-1")
+            self.assertEqual((response.status_code, body), (200, b""))
+            self.assertEqual(response["X-Accel-Redirect"], "/protected-media/sketches/page.png")
+        with override_settings(MEDIA_X_SENDFILE=True):
+            response, _ = self.get()
+            self.assertEqual(response["X-Sendfile"], os.path.join(os.path.abspath(self._media_root), "sketches", "page.png"))
+
+
+class AccessCacheTests(SketchTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = User.objects.create_user("other", password="pw")
+
+    def setUp(self):
+        super().setUp()
+        access.forget()
+        self.addCleanup(access.forget)
+
+    def test_owners_and_collaborators_only(self):
+        self.assertTrue(access.can_access(self.owner, self.book.id))
+        self.assertFalse(access.can_access(self.other, self.book.id))
+        self.assertFalse(access.can_access(self.owner, self.book.id + 100))
+        self.assertFalse(access.can_access(self.owner, None))
+        self.assertFalse(access.can_access(AnonymousUser(), self.book.id))
+        self.assertTrue(access.can_access_sketch(self.owner, self.sketch.id))
+        self.assertFalse(access.can_access_sketch(self.owner, self.sketch.id + 100))
+
+    def test_answers_are_cached(self):
+        with self.assertNumQueries(1):
+            for _ in range(3):
+                self.assertFalse(access.can_access(self.other, self.book.id))
+        with override_settings(ACCESS_CACHE_TTL=-1), self.assertNumQueries(2):
+            access.can_access(self.owner, self.book.id)
+            access.can_access(self.owner, self.book.id)
+
+    def test_request_memo_outlives_invalidation(self):
+        request = mock.Mock(spec=[])
+        self.assertFalse(access.can_access(self.other, self.book.id, request))
+        self.book.collaborators.add(self.other)
+        with self.assertNumQueries(0):
+            self.assertFalse(access.can_access(self.other, self.book.id, request))
+        self.assertTrue(access.can_access(self.other, self.book.id))
+
+    def test_collaborator_changes_invalidate(self):
+        self.assertFalse(access.can_access(self.other, self.book.id))
+        self.book.collaborators.add(self.other)
+        self.assertTrue(access.can_access(self.other, self.book.id))
+        self.book.collaborators.remove(self.other)
+        self.assertFalse(access.can_access(self.other, self.book.id))
+        # From the user's side of the relation
+        self.other.collaborating_books.add(self.book)
+        self.assertTrue(access.can_access(self.other, self.book.id))
+        self.other.collaborating_books.clear()
+        self.assertFalse(access.can_access(self.other, self.book.id))
+
+    def test_book_changes_invalidate(self):
+        self.assertTrue(access.can_access(self.owner, self.book.id))
+        Book.objects.get(pk=self.book.pk).delete()
+        self.assertFalse(access.can_access(self.owner, self.book.id))
+
+        book = Book.objects.create(name="Geometry", created_by=self.other)
+        self.assertFalse(access.can_access(self.owner, book.id))
+        book.created_by = self.owner
+        book.save()
+        self.assertTrue(access.can_access(self.owner, book.id))
+
+    def test_answers_racing_an_invalidation_are_not_stored(self):
+        def query(user_id, book_id):
+            access.forget(book_id=book_id)  # a collaborator was added meanwhile
+            return False
+        with mock.patch.object(access, "_query", side_effect=query):
+            self.assertFalse(access.can_access(self.other, self.book.id))
+        self.assertNotIn((self.other.id, self.book.id), access._cache)
+
+    @override_settings(ACCESS_CACHE_SIZE=2)
+    def test_least_recently_used_answers_are_evicted(self):
+        books = [Book.objects.create(name=f"Book {i}", created_by=self.owner) for i in range(3)]
+        access.can_access(self.owner, books[0].id)
+        access.can_access(self.owner, books[1].id)
+        access.can_access(self.owner, books[0].id)
+        access.can_access(self.owner, books[2].id)
+        self.assertEqual(list(access._cache), [(self.owner.id, books[0].id), (self.owner.id, books[2].id)])
+
+    def test_views_see_new_collaborators_at_once(self):
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(f"/book/{self.book.id}/").status_code, 403)
+        self.book.collaborators.add(self.other)
+        self.assertEqual(self.client.get(f"/book/{self.book.id}/").status_code, 200)
+
+
+class StrokeIndexTests(SketchTestCase):
+    def test_rect_queries_match_bounding_boxes_or_segments(self):
+        index = stroke_index.StrokeIndex.from_polylines(stroke_codec.segments_to_polylines([
+            segment(0, 0, 1000, 1000), segment(500, 0, 510, 10), segment(2000, 2000, 2010, 2010),
+        ]))
+        # The diagonal's bounding box covers (900, 100), the line itself doesn't
+        self.assertEqual(index.query((890, 90, 910, 110)).tolist(), [0])
+        self.assertEqual(index.query((890, 90, 910, 110), exact=True).tolist(), [])
+        self.assertEqual(index.query((495, 0, 600, 600), exact=True).tolist(), [0, 1])
+        self.assertEqual(index.segments(index.query((1990, 1990, 2020, 2020))), [segment(2000, 2000, 2010, 2010)])
+
+    def test_appends_extend_the_cached_index(self):
+        stroke_store.append_strokes(self.sketch.id, [segment(0, 0, 10, 10)])
+        sketch = Sketch.objects.get(pk=self.sketch.pk)
+        index = stroke_index.get_index(sketch)
+        stroke_store.append_strokes(self.sketch.id, [segment(300, 300, 310, 310)])
+        sketch.refresh_from_db()
+        self.assertIs(stroke_index.get_index(sketch), index)
+        self.assertEqual(index.query((290, 290, 320, 320)).tolist(), [1])
+
+    def test_viewport_query(self):
+        stroke_store.append_strokes(self.sketch.id, [segment(0, 0, 10, 10), segment(500, 500, 510, 510)])
+        response = self.client.get(f"/sketch/{self.sketch.id}/strokes/", {"rect": "490,490,600,600"})
+        self.assertEqual(response.json()["strokes"], [segment(500, 500, 510, 510)])
+
+    def test_non_finite_rects_are_rejected(self):
+        for rect in ["inf,0,1,1", "0,nan,1,1", "0,0,-inf,1"]:
+            response = self.client.get(f"/sketch/{self.sketch.id}/strokes/", {"rect": rect})
+            self.assertEqual(response.status_code, 400, rect)
+        response = self.client.post(
+            f"/sketch/{self.sketch.id}/erase/", json.dumps({"rect": [0, 0, 1e400, 1]}), content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+
+    async def test_websocket_erases_need_a_finite_rect_and_an_erased_segment(self):
+        consumer = SketchConsumer()
+        consumer.sketch_id, consumer.scope = self.sketch.id, {"user": self.owner}
+        consumer.stroke_buffer, consumer.room = mock.AsyncMock(), mock.AsyncMock()
+        consumer.channel_layer, consumer.room_group_name = FakeChannelLayer(), "sketch"
+        with mock.patch.object(stroke_store, "erase_region", return_value=(0, 0)) as erase_region:
+            for rect in ([0, 0, float("nan"), 1], [float("-inf"), 0, 1, 1], [0, 0, 1], "0,0,1,1"):
+                await consumer.receive(text_data=json.dumps({"type": "erase", "rect": rect}))
+            self.assertEqual(erase_region.call_count, 1)  # the string
+            erase_region.side_effect = stroke_store.StrokeConflict("busy")
+            with self.assertLogs("app.consumer", "ERROR"):
+                await consumer.receive(text_data=json.dumps({"type": "erase", "rect": [0, 0, 1, 1]}))
+        self.assertEqual(consumer.channel_layer.sent, [])
+
+
+class OcrCacheTests(SketchTestCase):
+    def setUp(self):
+        super().setUp()
+        stroke_store.append_strokes(self.sketch.id, [segment(10, 10, 200, 200)])
+        self.sketch.refresh_from_db()
+        patcher = mock.patch("app.ocr.extract_text_from_image", return_value="x = 2")
+        self.extract = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unchanged_sketch_is_answered_from_the_cache(self):
+        self.assertEqual(ocr.run_ocr(self.sketch), ("x = 2", False))
+        self.assertEqual(ocr.run_ocr(self.sketch), ("x = 2", True))
+        self.assertEqual(self.extract.call_count, 1)
+        self.assertEqual(
+            {k: ocr.cache_stats()[k] for k in ("entries", "hits", "misses")},
+            {"entries": 1, "hits": 1, "misses": 1},
+        )
+
+    def test_refresh_and_color_changes_miss_the_cache(self):
+        ocr.run_ocr(self.sketch)
+        self.extract.return_value = "x = 3"
+        self.assertEqual(ocr.run_ocr(self.sketch, refresh=True), ("x = 3", False))
+        self.assertEqual(OcrResult.objects.get().text, "x = 3")
+        UserColor.objects.create(book=self.book, user=self.owner, color="#ff0000")
+        self.assertEqual(ocr.run_ocr(self.sketch), ("x = 3", False))
+        self.assertEqual(self.extract.call_count, 3)
+        # The prompt names the collaborators' colors
+        self.assertIn("owner used color #ff0000", self.extract.call_args.args[1])
+
+    def test_incremental_results_are_not_cached(self):
+        ocr.run_ocr(self.sketch)
+        stroke_store.append_strokes(self.sketch.id, [segment(2000, 2000, 2010, 2010)])
+        self.sketch.refresh_from_db()
+        self.extract.return_value = "y = 1"
+        with self.assertLogs("app.ocr", "INFO"):
+            self.assertEqual(ocr.run_ocr(self.sketch), ("x = 2\n\ny = 1", False))
+        self.assertIn("Explain only the newly added work", self.extract.call_args.args[1])
+        self.assertEqual(list(OcrResult.objects.values_list("text", flat=True)), ["x = 2"])
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        patcher = mock.patch.dict(jobs._handlers, {
+            "echo": lambda **payload: self.calls.append(payload) or payload,
+            "broken": mock.Mock(side_effect=RuntimeError("try again")),
+            "invalid": mock.Mock(side_effect=jobs.PermanentJobError("bad payload")),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_queue(self):
+        jobs.work("test", idle_exit=True)
+
+    def test_jobs_run_once_and_store_their_result(self):
+        job = jobs.enqueue("echo", {"n": 1})
+        self.assertEqual(jobs.enqueue_once("echo", {"n": 1}), job)
+        self.run_queue()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result, job.attempts), (Job.DONE, {"n": 1}, 1))
+        self.assertEqual(self.calls, [{"n": 1}])
+        self.assertNotEqual(jobs.enqueue_once("echo", {"n": 1}), job)
+
+    def test_failures_are_retried_later_unless_permanent(self):
+        broken = jobs.enqueue("broken", {})
+        invalid = jobs.enqueue("invalid", {})
+        with self.assertLogs("app.jobs", "WARNING"):
+            self.run_queue()
+        broken.refresh_from_db()
+        invalid.refresh_from_db()
+        self.assertEqual((broken.status, broken.error), (Job.QUEUED, "try again"))
+        self.assertGreater(broken.run_after, timezone.now())
+        self.assertEqual((invalid.status, invalid.error), (Job.FAILED, "bad payload"))
+
+    def test_running_jobs_send_heartbeats(self):
+        beats = []
+        with override_settings(JOB_HEARTBEAT_INTERVAL=0.01), \
+                mock.patch.object(jobs, "heartbeat", side_effect=lambda job: beats.append(job.id) or True):
+            jobs._handlers["echo"] = lambda **payload: time.sleep(0.2)
+            job = jobs.enqueue("echo", {})
+            self.run_queue()
+        self.assertGreater(len(beats), 1)
+        self.assertEqual(set(beats), {job.id})
+
+    def test_only_jobs_without_heartbeat_are_requeued(self):
+        stale = timezone.now() - timedelta(hours=1)
+        alive = jobs.enqueue("echo", {"n": 1})
+        dead = jobs.enqueue("echo", {"n": 2})
+        Job.objects.update(status=Job.RUNNING, locked_at=stale, locked_by="w", attempts=1)
+        alive.locked_by = "w"
+        self.assertTrue(jobs.heartbeat(alive))
+        self.assertEqual(jobs.cleanup()["requeued"], 1)
+        self.assertEqual(Job.objects.get(pk=alive.pk).status, Job.RUNNING)
+        self.assertEqual(Job.objects.get(pk=dead.pk).status, Job.QUEUED)
+        # A worker whose job was requeued lost its lock
+        dead.locked_by = "w"
+        self.assertFalse(jobs.heartbeat(dead))
+
+    def test_workers_start_with_the_first_request(self):
+        with mock.patch.object(jobs, "_workers", []), mock.patch.object(jobs, "ensure_workers") as ensure:
+            self.client.get("/login/")
+        ensure.assert_called()
+
+
+def gemini_answer(prompt):
+    """A Gemini reply that "translates" every sentence of a batch prompt by upper-casing it."""
+    sentences = json.loads(re.search(r"^\[.*\]$", prompt, re.M).group())
+    return "```json\n" + json.dumps([sentence.upper() for sentence in sentences]) + "\n```"
+
+
+class SpeechCacheTests(TestCase):
+    text = "The sum is 5. Then x is 2. Done."
+
+    def setUp(self):
+        patchers = [
+            mock.patch("app.audio_generator.gemini.generate_text", side_effect=gemini_answer),
+            mock.patch("app.speech_cache.synthesize_chunk", side_effect=lambda text, lang: f"[{lang}:{text}]".encode()),
+        ]
+        self.generate, self.synthesize = [patcher.start() for patcher in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+    def speak(self, language="hi", degraded=None):
+        return b"".join(speech_cache.stream_segments(self.text, language, degraded=degraded))
+
+    def test_missing_sentences_are_prepared_in_one_call_and_cached(self):
+        self.assertEqual(self.speak(), b"[hi:THE SUM IS 5.][hi:THEN X IS 2.][hi:DONE.]")
+        self.assertEqual(self.generate.call_count, 1)
+        self.assertIn("to Hindi", self.generate.call_args.args[0])
+        self.assertEqual(SpeechSegment.objects.count(), 3)
+
+        self.text = "The sum is 5. Then x is 3. Done."
+        self.assertEqual(self.speak(), b"[hi:THE SUM IS 5.][hi:THEN X IS 3.][hi:DONE.]")
+        self.assertEqual(self.generate.call_count, 2)
+        self.assertEqual(json.loads(re.search(r"^\[.*\]$", self.generate.call_args.args[0], re.M).group()),
+                         ["Then x is 3."])
+
+    @override_settings(AUDIO_PREPARE_BATCH=2)
+    def test_long_texts_are_prepared_in_batches(self):
+        self.speak()
+        self.assertEqual(self.generate.call_count, 2)
+
+    def test_failed_translations_are_spoken_in_english_but_not_cached(self):
+        for failure in [RuntimeError("quota"), None]:
+            with self.subTest(failure=failure):
+                # None: an answer with the wrong number of sentences
+                self.generate.side_effect = failure or (lambda prompt: '["only one"]')
+                degraded = set()
+                with self.assertLogs("app.audio_generator", "WARNING"):
+                    audio = self.speak(degraded=degraded)
+                self.assertEqual(audio, b"[en:The sum is 5.][en:Then x is 2.][en:Done.]")
+                self.assertEqual(len(degraded), 3)
+                self.assertFalse(SpeechSegment.objects.exists())
+
+
+class AudioCacheTests(TempMediaMixin, SpeechCacheTests):
+    def setUp(self):
+        super().setUp()
+        shutil.rmtree(os.path.join(self._media_root, "audio_summaries"), ignore_errors=True)
+
+    def test_audio_is_stored_once_per_text_and_language(self):
+        blob, cached = audio_cache.get_audio(self.text, "hi")
+        self.assertFalse(cached)
+        with blob.file.open("rb") as f:
+            self.assertEqual(f.read(), b"[hi:THE SUM IS 5.][hi:THEN X IS 2.][hi:DONE.]")
+        self.assertEqual(audio_cache.get_audio(self.text, "hi"), (blob, True))
+        self.assertEqual(self.generate.call_count, 1)
+
+    def test_audio_with_failed_translations_is_not_stored(self):
+        self.generate.side_effect = RuntimeError("quota")
+        stored = mock.Mock()
+        with self.assertLogs("app", "WARNING"):
+            with self.assertRaises(audio_cache.AudioDegraded):
+                audio_cache.get_audio(self.text, "hi")
+            streamed = b"".join(audio_cache.stream_audio(self.text, "hi", on_stored=stored))
+            results = audio_cache.get_audios(self.text, ["hi", "kn"])
+        self.assertEqual(streamed, b"[en:The sum is 5.][en:Then x is 2.][en:Done.]")
+        stored.assert_not_called()
+        self.assertIsInstance(results["hi"], audio_cache.AudioDegraded)
+        self.assertIsInstance(results["kn"], audio_cache.AudioDegraded)
+        self.assertFalse(AudioBlob.objects.exists())
+        self.assertFalse(SpeechSegment.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self._media_root, "audio_summaries")), [])  # no blob, no temp file
+
+        # Once Gemini answers again, the audio is generated and kept
+        self.generate.side_effect = gemini_answer
+        blob, cached = audio_cache.get_audio(self.text, "hi")
+        self.assertFalse(cached)
+        self.assertTrue(blob.file.storage.exists(blob.file.name))
+
+    def test_languages_are_generated_concurrently(self):
+        # Both languages' first sentences must be spoken at the same time
+        barrier = threading.Barrier(2, timeout=5)
+        speak = self.synthesize.side_effect
+
+        def synthesize(text, lang):
+            if text == "THE SUM IS 5.":
+                barrier.wait()
+            return speak(text, lang)
+
+        self.synthesize.side_effect = synthesize
+        results = audio_cache.get_audios(self.text, ["kn", "hi"])
+        self.assertEqual(list(results), ["kn", "hi"])
+        self.assertEqual([cached for _, cached in results.values()], [False, False])
+        self.assertEqual({blob.language for blob, _ in results.values()}, {"kn", "hi"})
+        self.assertEqual(self.generate.call_count, 2)
+
+        self.synthesize.side_effect = speak
+        self.assertEqual(
+            {language: cached for language, (_, cached) in audio_cache.get_audios(self.text, ["hi", "en"]).items()},
+            {"hi": True, "en": False},
+        )
+
+
+class StreamAudioTests(TempMediaMixin, SketchTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sketch.ocr_explanation = "The sum is 5. Then x is 2."
+        self.sketch.save(update_fields=["ocr_explanation"])
+        self.url = f"/stream-audio/{self.sketch.id}/?language=hi"
+        self.answered = threading.Event()
+        patchers = [
+            mock.patch("app.audio_generator.gemini.generate_text", side_effect=self.answer),
+            mock.patch("app.speech_cache.synthesize_chunk", side_effect=lambda text, lang: f"[{lang}:{text}]".encode()),
+        ]
+        self.generate = patchers[0].start()
+        patchers[1].start()
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+    def answer(self, prompt):
+        self.assertTrue(self.answered.wait(5))
+        return gemini_answer(prompt)
+
+    def test_missing_audio_is_streamed_sentence_by_sentence(self):
+        self.answered.set()
+        response = self.client.get(self.url)
+        self.assertEqual((response.status_code, response["Content-Type"]), (200, "audio/mpeg"))
+        self.assertEqual(list(response.streaming_content), [b"[hi:THE SUM IS 5.]", b"[hi:THEN X IS 2.]"])
+        self.assertFalse(Job.objects.exists())
+        self.sketch.refresh_from_db()
+        self.assertEqual(self.sketch.audio_blob.key, audio_cache.cache_key(self.sketch.ocr_explanation, "hi"))
+        with self.sketch.audio_summary.open("rb") as f:
+            self.assertEqual(f.read(), b"[hi:THE SUM IS 5.][hi:THEN X IS 2.]")
+
+    def test_cached_sentences_are_sent_before_the_missing_ones_are_ready(self):
+        SpeechSegment.objects.create(
+            key=speech_cache.segment_key("The sum is 5.", "hi"), language="hi",
+            spoken_text="THE SUM IS 5.", audio=b"[cached]", size=8,
+        )
+        chunks = iter(self.client.get(self.url).streaming_content)
+        self.assertEqual(next(chunks), b"[cached]")  # while Gemini hasn't answered
+        self.answered.set()
+        self.assertEqual(list(chunks), [b"[hi:THEN X IS 2.]"])
+
+    def test_cached_audio_is_served(self):
+        key = audio_cache.cache_key(self.sketch.ocr_explanation, "hi")
+        os.makedirs(os.path.join(self._media_root, "audio_summaries"), exist_ok=True)
+        with open(os.path.join(self._media_root, audio_cache.blob_name(key)), "wb") as f:
+            f.write(b"mp3")
+        blob = AudioBlob.objects.create(key=key, language="hi", file=audio_cache.blob_name(key), size=3)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"mp3")
+        self.sketch.refresh_from_db()
+        self.assertEqual(self.sketch.audio_blob, blob)
+        self.assertFalse(Job.objects.exists())
+
+
+class GeminiClientTests(SimpleTestCase):
+    def limiters(self, concurrency=2, rate=1e6, burst=10):
+        limiters = (threading.BoundedSemaphore(concurrency), gemini.TokenBucket(rate, burst))
+        return mock.patch.object(gemini, "_limiters", return_value=limiters)
+
+    def test_token_bucket_allows_a_burst_then_waits(self):
+        bucket = gemini.TokenBucket(rate=50, capacity=2)
+        self.assertEqual([bucket.acquire(), bucket.acquire()], [0.0, 0.0])
+        started = time.monotonic()
+        self.assertGreater(bucket.acquire(), 0)
+        self.assertGreaterEqual(time.monotonic() - started, 0.015)
+
+    def test_rate_limit_errors_are_retried_with_backoff(self):
+        func = mock.Mock(side_effect=[ResourceExhausted("429"), ResourceExhausted("429"), "ok"])
+        with self.limiters(), mock.patch.object(gemini.time, "sleep") as sleep:
+            self.assertEqual(gemini.call(func, "prompt"), "ok")
+        self.assertEqual([c.args for c in sleep.call_args_list], [(2,), (4,)])
+        func.assert_called_with("prompt")
+
+        with self.limiters(), mock.patch.object(gemini.time, "sleep"), override_settings(GEMINI_RETRIES=0):
+            with self.assertRaises(ResourceExhausted):
+                gemini.call(mock.Mock(side_effect=ResourceExhausted("429")))
+
+    def test_calls_are_capped_at_the_concurrency_limit(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def request():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+
+        with self.limiters(concurrency=2):
+            threads = [threading.Thread(target=gemini.call, args=(request,)) for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(max(peak), 2)
+
+
+class GeminiFilesTests(TestCase):
+    def handle(self, name, expires_in):
+        return GeminiFile.objects.create(
+            key=name, name=name, uri=f"https://example.com/{name}", mime_type="image/png",
+            expires_at=timezone.now() + timedelta(seconds=expires_in),
+        )
+
+    def test_collect_deletes_only_the_uploads_of_expired_handles(self):
+        self.handle("files/old", -60)
+        self.handle("files/gone", -60)
+        live = self.handle("files/live", 3600)
+
+        def delete_file(name):
+            if name == "files/gone":
+                raise NotFound("expired")
+
+        with mock.patch.object(gemini, "delete_file", side_effect=delete_file) as delete:
+            self.assertEqual(gemini_files.collect_files(dry_run=True), (2, 2))
+            delete.assert_not_called()
+            self.assertEqual(gemini_files.collect_files(), (2, 1))
+        self.assertEqual(sorted(call.args[0] for call in delete.call_args_list), ["files/gone", "files/old"])
+        self.assertEqual(list(GeminiFile.objects.all()), [live])
+
+    def test_uploads_of_replaced_handles_are_deleted_too(self):
+        def upload(name):
+            uploaded = mock.Mock(uri=f"https://example.com/{name}", expiration_time=None)
+            uploaded.name = name
+            with mock.patch.object(gemini, "prep_image", return_value=uploaded):
+                return gemini_files.upload_file(b"png", "image/png")
+
+        first = upload("files/first")
+        second = upload("files/second")
+        self.assertEqual((second.pk, second.name), (first.pk, "files/second"))
+        self.assertEqual(list(RetiredGeminiFile.objects.values_list("name", flat=True)), ["files/first"])
+
+        with mock.patch.object(gemini, "delete_file") as delete:
+            self.assertEqual(gemini_files.collect_files(dry_run=True), (0, 1))
+            delete.assert_not_called()
+            self.assertEqual(gemini_files.collect_files(), (0, 1))
+        delete.assert_called_once_with("files/first")
+        self.assertFalse(RetiredGeminiFile.objects.exists())
+        self.assertEqual(list(GeminiFile.objects.values_list("name", flat=True)), ["files/second"])
+
+
+class OcrImageTests(SketchTestCase):
+    def decode(self, prepared):
+        image = Image.open(io.BytesIO(prepared.data))
+        self.assertEqual(image.size, (prepared.width, prepared.height))
+        return image.convert("RGB")
+
+    @override_settings(OCR_IMAGE_MAX_SIDE=200, OCR_IMAGE_MARGIN=10)
+    def test_strokes_are_cropped_scaled_and_flattened(self):
+        UserColor.objects.create(book=self.book, user=self.owner, color="#ff0000")
+        strokes = [segment(1000, 1000, 1800, 1400, color="#ff0000", width=8), segment(1000, 1400, 1800, 1000)]
+        stroke_store.append_strokes(self.sketch.id, strokes)
+        self.sketch.refresh_from_db()
+        prepared = ocr_image.prepare(self.sketch)
+        # 800 x 400 px of ink plus the margin, scaled to fit 200 px
+        self.assertEqual((prepared.width, prepared.height), (200, 104))
+        colors = {rgb for _, rgb in self.decode(prepared).getcolors()}
+        self.assertEqual(colors, {(255, 255, 255), (0, 0, 0), (255, 0, 0)})
+
+    @override_settings(OCR_IMAGE_MARGIN=5)
+    def test_uploaded_images_are_cropped_to_their_ink(self):
+        image = Image.new("RGBA", (400, 300), (0, 0, 0, 0))
+        ImageDraw.Draw(image).rectangle((100, 50, 149, 99), fill=(0, 0, 255, 255))
+        out = io.BytesIO()
+        image.save(out, format="PNG")
+        prepared = ocr_image.prepare(self.sketch, image_bytes=out.getvalue(), polylines=[])
+        self.assertEqual((prepared.width, prepared.height), (60, 60))
+        decoded = self.decode(prepared)
+        self.assertEqual(decoded.getpixel((0, 0)), (255, 255, 255))
+        self.assertEqual(decoded.getpixel((30, 30)), (0, 0, 255))
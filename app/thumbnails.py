@@ -0,0 +1,178 @@
+"""
+Thumbnails of sketch images for the dashboard and book pages.
+
+Every change to a sketch's strokes or image (saves, appends and erases,
+undos, clears, strokes drawn over the WebSocket) schedules a
+sketch_thumbnails job, so nothing is rendered on the request path. The job
+runs THUMBNAIL_DELAY seconds after the first change, and the changes made
+until then are covered by that same job (see jobs.enqueue_once): someone
+drawing gets their previews refreshed at most that often, not after every
+stroke batch. The job brings ``sketch.image`` up to date with the strokes
+(see sketch_render.ensure_sketch_image), hashes it, and makes a preview at
+each of THUMBNAIL_SIZES px (longer side), cropped to the ink, as lossy WebP
+(palette PNG when Pillow lacks WebP). Thumbnails are Thumbnail rows and
+files named ``thumbnails/<sha256>-<size>.<ext>``, keyed by the image's hash:
+an unchanged image is never processed twice, and sketches with identical
+images share them. The sketch points at its set through ``thumbnail_key``.
+
+Because the name contains the hash, media_files serves thumbnails with an
+immutable Cache-Control; a changed image gets a new name. collect deletes the
+thumbnails no sketch refers to any more (see the collect_thumbnails command).
+"""
+import hashlib
+import io
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+from PIL import Image, ImageOps, features
+
+from . import jobs
+from .models import Sketch, Thumbnail
+from .sketch_render import BACKGROUND, ensure_sketch_image
+
+
+def thumbnail_sizes():
+    return tuple(getattr(settings, "THUMBNAIL_SIZES", (160, 320)))
+
+
+def quality():
+    return getattr(settings, "THUMBNAIL_QUALITY", 75)
+
+
+def delay():
+    return getattr(settings, "THUMBNAIL_DELAY", 30)
+
+
+def image_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def schedule(sketch_id):
+    """
+    Queue a sketch_thumbnails job for the sketch, due in THUMBNAIL_DELAY
+    seconds, once the current transaction commits; a job still waiting
+    already covers this change.
+    """
+    transaction.on_commit(
+        lambda: jobs.enqueue_once("sketch_thumbnails", {"sketch_id": sketch_id}, delay=delay())
+    )
+
+
+def _flatten(image):
+    """``image`` as RGB on the background color, cropped to its ink."""
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, BACKGROUND)
+        image = Image.alpha_composite(background, image)
+    image = image.convert("RGB")
+    bbox = ImageOps.invert(image).getbbox()
+    if bbox is None:
+        return image
+    # Keep a little white around the ink, relative to its size
+    pad = max(bbox[2] - bbox[0], bbox[3] - bbox[1]) // 20
+    return image.crop((
+        max(0, bbox[0] - pad), max(0, bbox[1] - pad),
+        min(image.width, bbox[2] + pad), min(image.height, bbox[3] + pad),
+    ))
+
+
+def render(image, size):
+    """A flattened image scaled to fit ``size`` x ``size`` px, as (bytes, extension, (width, height))."""
+    image = image.copy()
+    image.thumbnail((size, size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    out = io.BytesIO()
+    if features.check("webp"):
+        image.save(out, format="WEBP", quality=quality(), method=4)
+        return out.getvalue(), "webp", image.size
+    image.quantize(64, dither=Image.Dither.NONE).save(out, format="PNG", optimize=True)
+    return out.getvalue(), "png", image.size
+
+
+def make_thumbnails(data):
+    """
+    Make the missing thumbnails of the image ``data`` and return its key.
+    The image is only decoded when a size is missing.
+    """
+    key = image_key(data)
+    have = set(Thumbnail.objects.filter(key=key).values_list("size", flat=True))
+    missing = [size for size in thumbnail_sizes() if size not in have]
+    if not missing:
+        return key
+
+    image = _flatten(Image.open(io.BytesIO(data)))
+    for size in missing:
+        content, ext, (width, height) = render(image, size)
+        thumbnail = Thumbnail(key=key, size=size, width=width, height=height, file_size=len(content))
+        thumbnail.file.save(f"{key}-{size}.{ext}", ContentFile(content), save=False)
+        try:
+            thumbnail.save()
+        except IntegrityError:
+            # Made concurrently for another sketch with the same image
+            thumbnail.file.delete(save=False)
+    return key
+
+
+def update_sketch(sketch):
+    """
+    Bring the thumbnails of ``sketch`` up to date with its strokes or
+    uploaded image; returns the new thumbnail_key ("" without an image).
+    """
+    image = ensure_sketch_image(sketch)
+    if image is None:
+        key = ""
+    else:
+        with image.open("rb") as f:
+            key = make_thumbnails(f.read())
+    if key != sketch.thumbnail_key:
+        sketch.thumbnail_key = key
+        Sketch.objects.filter(pk=sketch.pk).update(thumbnail_key=key)
+    return key
+
+
+def attach(sketches):
+    """
+    Set ``sketch.thumbnail`` on each of ``sketches`` to a dict with the
+    smallest thumbnail's url, width and height and a srcset of all sizes,
+    or None. Uses one query.
+    """
+    sketches = list(sketches)
+    keys = {sketch.thumbnail_key for sketch in sketches if sketch.thumbnail_key}
+    by_key = {}
+    for thumbnail in Thumbnail.objects.filter(key__in=keys).order_by("size"):
+        by_key.setdefault(thumbnail.key, []).append(thumbnail)
+
+    for sketch in sketches:
+        found = by_key.get(sketch.thumbnail_key)
+        if not found:
+            sketch.thumbnail = None
+            continue
+        smallest = found[0]
+        sketch.thumbnail = {
+            "url": smallest.file.url,
+            "width": smallest.width,
+            "height": smallest.height,
+            "srcset": ", ".join(f"{t.file.url} {t.size / smallest.size:g}x" for t in found),
+        }
+    return sketches
+
+
+def collect(grace=3600, dry_run=False):
+    """
+    Delete the thumbnails (rows and files) of images no sketch shows any
+    more, if older than ``grace`` seconds (a job may be about to point a
+    sketch at them). Returns (thumbnails, bytes) freed.
+    """
+    live = Sketch.objects.exclude(thumbnail_key="").values("thumbnail_key")
+    stale = Thumbnail.objects.exclude(key__in=live).filter(
+        created_at__lt=timezone.now() - timedelta(seconds=grace),
+    )
+    totals = stale.aggregate(n=Count("id"), size=Sum("file_size"))
+    if not dry_run:
+        for thumbnail in stale:
+            thumbnail.file.delete(save=False)
+            thumbnail.delete()
+    return totals["n"], totals["size"] or 0
@@ -1,4 +1,6 @@
-from django.urls import path
+import re
+
+from django.urls import path, re_path
 from . import views
 from django.contrib.auth import views as auth_views
 
@@ -12,17 +14,30 @@ urlpatterns = [
     path('login/', auth_views.LoginView.as_view(template_name='login.html'), name='login'),
     path('logout/', auth_views.LogoutView.as_view(next_page='login'), name='logout'),
     path('save-sketch/', views.save_sketch, name='save_sketch'),
+    path('sketch/<int:sketch_id>/strokes/append/', views.append_strokes, name='append_strokes'),
+    path('sketch/<int:sketch_id>/strokes/', views.sketch_strokes, name='sketch_strokes'),
+    path('sketch/<int:sketch_id>/strokes/state/', views.sketch_stroke_state, name='sketch_stroke_state'),
+    path('sketch/<int:sketch_id>/erase/', views.erase_region, name='erase_region'),
+    path('sketch/<int:sketch_id>/undo/', views.undo_strokes, name='undo_strokes'),
+    path('sketch/<int:sketch_id>/tiles/', views.sketch_tiles_info, name='sketch_tiles_info'),
+    path('sketch/<int:sketch_id>/tiles/<int:level>/<int:x>/<int:y>.png', views.sketch_tile, name='sketch_tile'),
     path('clear-sketch/<int:sketch_id>/', views.clear_sketch, name='clear_sketch'),
     path('upload-ocr/<int:sketch_id>/', views.upload_sketch_screenshot, name='upload_sketch_screenshot'),
+    path('jobs/<int:job_id>/', views.job_status, name='job_status'),
+    path('ocr-cache/stats/', views.ocr_cache_stats, name='ocr_cache_stats'),
     
     # New audio endpoints
     path('generate-audio/<int:sketch_id>/', views.generate_sketch_audio, name='generate_sketch_audio'),
+    path('generate-audio-multi/<int:sketch_id>/', views.generate_sketch_audio_multi, name='generate_sketch_audio_multi'),
+    path('stream-audio/<int:sketch_id>/', views.stream_sketch_audio, name='stream_sketch_audio'),
     path('get-audio/<int:sketch_id>/', views.get_sketch_audio, name='get_sketch_audio'),
     path('upload-and-audio/<int:sketch_id>/', views.upload_and_generate_audio, name='upload_and_generate_audio'),
+    path('audio-cache/stats/', views.audio_cache_stats, name='audio_cache_stats'),
     path('supported-languages/', views.get_supported_languages, name='get_supported_languages'),
 ]
 
 from django.conf import settings
-from django.conf.urls.static import static
 
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+urlpatterns += [
+    re_path(rf"^{re.escape(settings.MEDIA_URL.lstrip('/'))}(?P<path>.+)$", views.serve_media, name='serve_media'),
+]
\ No newline at end of file
@@ -1,19 +1,21 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponseForbidden
+from django.http import JsonResponse, HttpResponse, HttpResponseForbidden, HttpResponseNotModified, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.core.files.base import ContentFile
-from django.utils.safestring import mark_safe
 from django.utils import timezone  
-from .models import Book, Sketch, UserColor
+from django.db.models import Max, Subquery
+from .models import AudioBlob, Book, Job, Sketch, UserColor
+from . import access, audio_cache, gemini_files, jobs, media_files, sketch_tiles, speech_cache, stroke_broadcast, stroke_codec, stroke_index, stroke_log, stroke_state, stroke_store, tasks, thumbnails
+from .stroke_simplify import simplify_strokes
 import json, base64
 import random
 import os
 from django.conf import settings
 
 # Import your custom modules
-from .gemini import prep_image, extract_text_from_image
-from .audio_generator import generate_audio_summary, generate_audio_with_ssml
+from .ocr import cache_stats
+from .audio_generator import SUPPORTED_LANGUAGES
 
 
 # Generate a random hex color
@@ -23,7 +25,7 @@ def get_random_color():
 
 @login_required
 def dashboard(request):
-    my_books = Book.objects.all()
+    my_books = _attach_covers(list(Book.objects.all()))
     shared_books = request.user.collaborating_books.all()
     return render(request, "dashboard.html", {
         "my_books": my_books,
@@ -31,6 +33,24 @@ def dashboard(request):
     })
 
 
+def _attach_covers(books):
+    """Set ``book.cover`` on each of ``books`` to the thumbnail of its newest sketch that has one (or None)."""
+    # Only the newest sketch of each book, picked by the database
+    newest_ids = (
+        Sketch.objects.filter(book__in=books).exclude(thumbnail_key="")
+        .values("book_id").annotate(newest=Max("id")).values("newest")
+    )
+    newest = {
+        sketch.book_id: sketch
+        for sketch in Sketch.objects.filter(id__in=Subquery(newest_ids)).only("id", "book_id", "thumbnail_key")
+    }
+    thumbnails.attach(newest.values())
+    for book in books:
+        sketch = newest.get(book.id)
+        book.cover = sketch.thumbnail if sketch is not None else None
+    return books
+
+
 @login_required
 def create_book(request):
     if request.method == "POST":
@@ -43,35 +63,34 @@ def create_book(request):
 @login_required
 def book_detail(request, book_id):
     book = get_object_or_404(Book, id=book_id)
-    if request.user != book.created_by and request.user not in book.collaborators.all():
+    if not access.can_access(request.user, book.id, request):
         return JsonResponse({"error": "Unauthorized"}, status=403)
+    # Only what the list shows: the stroke blobs can be large
+    sketches = thumbnails.attach(book.sketches.only("id", "name", "thumbnail_key"))
     return render(request, "book_detail.html", {
         "book": book,
-        "sketches": book.sketches.all()
+        "sketches": sketches
     })
 
 
 @login_required
 def sketch_room(request, sketch_id):
-    sketch = get_object_or_404(Sketch, id=sketch_id)
-    book = sketch.book
+    # The page doesn't need the strokes (see sketch_stroke_state)
+    sketch = get_object_or_404(Sketch.objects.only("id", "name", "book_id"), id=sketch_id)
 
-    if request.user != book.created_by and request.user not in book.collaborators.all():
+    if not access.can_access(request.user, sketch.book_id, request):
         return JsonResponse({"error": "Unauthorized"}, status=403)
 
     # Assign or fetch color
     user_color_obj, created = UserColor.objects.get_or_create(
         user=request.user,
-        book=book,
+        book_id=sketch.book_id,
         defaults={"color": get_random_color()}
     )
 
-    strokes_json = mark_safe(json.dumps(sketch.strokes or []))
-
     return render(request, "sketch.html", {
         "sketch_id": sketch.id,
         "sketch_name": sketch.name,
-        "saved_strokes_json": strokes_json,
         "user_color": user_color_obj.color,
         "user_id": request.user.id,
     })
@@ -81,7 +100,7 @@ def sketch_room(request, sketch_id):
 def create_sketch(request, book_id):
     book = get_object_or_404(Book, id=book_id)
 
-    if request.user != book.created_by and request.user not in book.collaborators.all():
+    if not access.can_access(request.user, book.id, request):
         return HttpResponseForbidden("You don't have permission to add sketches to this book.")
 
     if request.method == "POST":
@@ -103,10 +122,11 @@ def save_sketch(request):
         sketch_id = data.get("id")
         new_name = data.get("name")
         image_data = data.get("image", "")
-        strokes = data.get("strokes", [])
 
         # Fetch the sketch
         sketch = Sketch.objects.get(id=sketch_id)
+        if not access.can_access(request.user, sketch.book_id, request):
+            return JsonResponse({"status": "error", "message": "Unauthorized"}, status=403)
 
         # Update name if provided
         if new_name:
@@ -124,10 +144,17 @@ def save_sketch(request):
             # Save new image with same name
             filename = f"sketches/{sketch.book}_sk_{sketch_id}.png"
             sketch.image.save(filename, ContentFile(decoded_image), save=False)
+            sketch.image_revision = None  # re-rendered from strokes before OCR
+
+        # Strokes are only written through stroke_store
+        sketch.save(update_fields=["name", "image", "image_revision"])
 
-        # Update strokes
-        sketch.strokes = strokes
-        sketch.save()
+        # Update strokes (clients using append_strokes only send name/image)
+        if "strokes" in data:
+            stroke_store.set_strokes(sketch.id, simplify_strokes(data.get("strokes") or []), request.user.id)
+
+        # Previews for the book pages, rendered by a background job
+        thumbnails.schedule(sketch.id)
 
         return JsonResponse({
             "status": "updated",
@@ -141,13 +168,228 @@ def save_sketch(request):
         return JsonResponse({"status": "error", "message": str(e)}, status=500)
 
 
+@csrf_exempt
+@login_required
+def append_strokes(request, sketch_id):
+    """
+    Append a batch of new strokes to a sketch.
+
+    Body: {"client_id": str, "seq": int, "strokes": [...]}. ``seq`` starts at 1
+    and increases by one per batch for each client_id. Re-sending an applied
+    batch is a no-op; skipping a seq returns 409 with the expected seq.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"status": "invalid_method"}, status=405)
+
+    sketch = get_object_or_404(Sketch, id=sketch_id)
+    if not access.can_access(request.user, sketch.book_id, request):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    try:
+        data = json.loads(request.body)
+        if not isinstance(data, dict):
+            raise TypeError("payload must be an object")
+        client_id = str(data.get("client_id") or "")[:64]
+        seq = int(data.get("seq"))
+        strokes = data.get("strokes") or []
+    except (ValueError, TypeError):
+        return JsonResponse({"status": "error", "message": "Invalid payload."}, status=400)
+
+    if not client_id or seq < 1 or not isinstance(strokes, list):
+        return JsonResponse({"status": "error", "message": "client_id, seq >= 1 and a strokes list are required."}, status=400)
+
+    # Strokes are attributed to whoever appends them
+    for stroke in strokes:
+        if isinstance(stroke, dict):
+            stroke["user"] = request.user.id
+    strokes = simplify_strokes(strokes)
+
+    try:
+        result = stroke_store.append_strokes(sketch.id, strokes, client_id=client_id, seq=seq)
+    except stroke_store.StrokeConflict as e:
+        return JsonResponse({"status": "error", "message": str(e)}, status=503)
+
+    if result.status == "appended":
+        thumbnails.schedule(sketch.id)
+    if result.status == "gap":
+        return JsonResponse({
+            "status": "gap",
+            "expected_seq": result.last_seq + 1,
+            "revision": result.revision,
+        }, status=409)
+
+    return JsonResponse({
+        "status": result.status,
+        "seq": result.last_seq,
+        "revision": result.revision,
+    })
+
+
+@login_required
+def sketch_strokes(request, sketch_id):
+    """
+    Stroke segments of a sketch, optionally limited to a viewport with
+    ?rect=left,top,right,bottom, or as of an earlier ?revision=.
+    """
+    sketch = get_object_or_404(Sketch, id=sketch_id)
+    if not access.can_access(request.user, sketch.book_id, request):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    if "revision" in request.GET:
+        # An earlier state, replayed from the stroke log
+        try:
+            revision = int(request.GET["revision"])
+            blob = stroke_log.load(sketch.id, revision)
+        except ValueError:
+            return JsonResponse({"error": "revision must be an integer"}, status=400)
+        except stroke_log.HistoryUnavailable as e:
+            return JsonResponse({"error": str(e)}, status=404)
+        return JsonResponse({"revision": revision, "strokes": stroke_codec.decode_strokes(blob)})
+
+    index = stroke_index.get_index(sketch)
+    if "rect" in request.GET:
+        try:
+            rect = stroke_index.parse_rect(request.GET["rect"])
+        except (TypeError, ValueError):
+            return JsonResponse({"error": "rect must be left,top,right,bottom"}, status=400)
+        strokes = index.segments(index.query(rect))
+    else:
+        strokes = index.segments()
+
+    return JsonResponse({"revision": sketch.stroke_revision, "strokes": strokes})
+
+
+@login_required
+def sketch_stroke_state(request, sketch_id):
+    """
+    All strokes of a sketch as a compressed NDJSON stream for the sketch page
+    (see stroke_state). Carries an ETag per stroke revision; clients
+    revalidate with If-None-Match and get 304 while the strokes are unchanged.
+    """
+    sketch = get_object_or_404(Sketch, id=sketch_id)
+    if not access.can_access(request.user, sketch.book_id, request):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    encoding = stroke_state.negotiate(request.headers.get("Accept-Encoding"))
+    etag = stroke_state.etag(sketch, encoding)
+    if etag in [t.strip() for t in request.headers.get("If-None-Match", "").split(",")]:
+        response = HttpResponseNotModified()
+    else:
+        body = stroke_state.cached_body(sketch) if encoding == "gzip" else None
+        if body is not None:
+            response = HttpResponse(body, content_type=stroke_state.CONTENT_TYPE)
+        else:
+            response = StreamingHttpResponse(stroke_state.stream(sketch, encoding), content_type=stroke_state.CONTENT_TYPE)
+        if encoding != "identity":
+            response["Content-Encoding"] = encoding
+    response["ETag"] = etag
+    response["Vary"] = "Accept-Encoding"
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@csrf_exempt
+@login_required
+def erase_region(request, sketch_id):
+    """
+    Erase every stroke segment crossing a rectangle. Body: {"rect": [l, t, r, b]}.
+    The erase is persisted and broadcast to the sketch room.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"status": "invalid_method"}, status=405)
+
+    sketch = get_object_or_404(Sketch, id=sketch_id)
+    if not access.can_access(request.user, sketch.book_id, request):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    try:
+        rect = stroke_index.parse_rect(json.loads(request.body).get("rect"))
+    except (TypeError, ValueError, AttributeError):
+        return JsonResponse({"status": "error", "message": "rect must be [left, top, right, bottom]."}, status=400)
+
+    try:
+        erased, revision = stroke_store.erase_region(sketch.id, rect, request.user.id)
+    except stroke_store.StrokeConflict as e:
+        return JsonResponse({"status": "error", "message": str(e)}, status=503)
+
+    if erased:
+        thumbnails.schedule(sketch.id)
+        stroke_broadcast.notify_room(sketch.id, {"type": "erase", "rect": list(rect)})
+    return JsonResponse({"status": "erased", "erased": erased, "revision": revision})
+
+
+@login_required
+def sketch_tiles_info(request, sketch_id):
+    """
+    Tile pyramid parameters and ink bounding box, so the client can request
+    only the tiles it needs.
+    """
+    sketch = get_object_or_404(Sketch, id=sketch_id)
+    if not access.can_access(request.user, sketch.book_id, request):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+    return JsonResponse(sketch_tiles.pyramid_info(sketch))
+
+
+@login_required
+def sketch_tile(request, sketch_id, level, x, y):
+    """
+    One PNG tile of a sketch; 404 outside the ink's bounding box. Tiles carry
+    a strong ETag; clients revalidate with If-None-Match and get 304 while
+    the tile is unchanged.
+    """
+    sketch = get_object_or_404(Sketch, id=sketch_id)
+    if not access.can_access(request.user, sketch.book_id, request):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+    if level >= sketch_tiles.tile_levels():
+        return JsonResponse({"error": "Unknown tile level"}, status=404)
+
+    tile = sketch_tiles.get_tile(sketch, level, x, y)
+    if tile is None:
+        return JsonResponse({"error": "No ink in this tile"}, status=404)
+    etag = f'"{tile.etag}"'
+    if etag in [t.strip() for t in request.headers.get("If-None-Match", "").split(",")]:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(bytes(tile.png), content_type="image/png")
+    response["ETag"] = etag
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@csrf_exempt
+@login_required
+def undo_strokes(request, sketch_id):
+    """
+    Undo the user's last path or erase on a sketch. Other clients are told to
+    reload the strokes.
+    """
+    if request.method != 'POST':
+        return JsonResponse({"status": "invalid_method"}, status=405)
+
+    sketch = get_object_or_404(Sketch, id=sketch_id)
+    if not access.can_access(request.user, sketch.book_id, request):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    try:
+        undone, revision = stroke_store.undo(sketch.id, request.user.id)
+    except stroke_store.StrokeConflict as e:
+        return JsonResponse({"status": "error", "message": str(e)}, status=503)
+
+    if undone:
+        thumbnails.schedule(sketch.id)
+        stroke_broadcast.notify_room(sketch.id, {"type": "resync", "revision": revision})
+    return JsonResponse({"status": "undone" if undone else "nothing_to_undo", "revision": revision})
+
+
 @csrf_exempt
 def clear_sketch(request, sketch_id):
     if request.method == 'POST':
+        if not access.can_access_sketch(request.user, sketch_id, request):
+            return JsonResponse({'success': False, 'error': 'Unauthorized'}, status=403)
         try:
-            sketch = Sketch.objects.get(id=sketch_id)
-            sketch.strokes = []  # Clear strokes only
-            sketch.save()
+            revision = stroke_store.clear_strokes(sketch_id, request.user.id)  # Clear strokes only
+            thumbnails.schedule(sketch_id)
+            stroke_broadcast.notify_room(sketch_id, {"type": "resync", "revision": revision})
             return JsonResponse({'success': True})
         except Sketch.DoesNotExist:
             return JsonResponse({'success': False, 'error': 'Sketch not found'}, status=404)
@@ -156,50 +398,61 @@ def clear_sketch(request, sketch_id):
     return JsonResponse({'success': False, 'error': 'Invalid method'}, status=405)
 
 
+def _wants_refresh(request):
+    """True when the client asks to bypass the OCR cache (?refresh=1 or {"refresh": true})."""
+    if request.GET.get("refresh") in ("1", "true"):
+        return True
+    try:
+        data = json.loads(request.body) if request.body else {}
+    except ValueError:
+        return False
+    return isinstance(data, dict) and bool(data.get("refresh"))
+
+
+def _request_data(request):
+    try:
+        data = json.loads(request.body) if request.body else {}
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _request_language(data):
+    language = data.get('language', 'en')
+    if language not in SUPPORTED_LANGUAGES:
+        language = 'en'
+    return language
+
+
+def _job_accepted(job):
+    return JsonResponse({
+        "status": "queued",
+        "job_id": job.id,
+        "status_url": f"/jobs/{job.id}/",
+    }, status=202)
+
+
 @csrf_exempt
 def upload_sketch_screenshot(request, sketch_id):
+    """
+    Queue OCR of the sketch; the result ({"text", "sketch_id", "cached"})
+    is read from the job (see job_status)
+    """
     if request.method == 'POST':
         sketch = get_object_or_404(Sketch, id=sketch_id)
-        print("enter upload function")
+        if not access.can_access(request.user, sketch.book_id, request):
+            return JsonResponse({"error": "Unauthorized"}, status=403)
 
-        if not sketch.image:
+        if not sketch.strokes_packed and not sketch.image:
             return JsonResponse({"error": "No image found."}, status=400)
 
-        # Step 1: Get the book
-        book = sketch.book
-
-        # Step 2: Get all collaborators and their colors
-        user_colors = UserColor.objects.filter(book=book)
-        color_info = [
-            f"{uc.user.username} used color {uc.color}" for uc in user_colors
-        ]
-        color_info_str = "\n".join(color_info)
-
-        # Step 3: Prepare image
-        local_image_path = sketch.image.path
-        sample_file = prep_image(local_image_path)
-
-        # Step 4: Create prompt with color info
-        prompt = (
-            "You're analyzing a sketch which contains handwritten math or science problems. "
-            "Try to interpret the equations and expressions drawn. "
-            "Here are the users and their assigned colors:\n\n"
-            f"{color_info_str}\n\n"
-            "Based on this, try to interpret what was written or solved in the sketch mention and correct each others mistake if there any."
+        job = jobs.enqueue(
+            "sketch_ocr",
+            {"sketch_id": sketch.id, "refresh": _wants_refresh(request)},
+            user=request.user if request.user.is_authenticated else None,
+            sketch=sketch,
         )
-
-        # Step 5: Extract text using prompt
-        text = extract_text_from_image(sample_file, prompt)
-        text_list = text.split("\n")
-        
-        # Step 6: Store the explanation for audio generation
-        sketch.ocr_explanation = text
-        sketch.save()
-
-        return JsonResponse({
-            "text": text_list,
-            "sketch_id": sketch_id
-        })
+        return _job_accepted(job)
 
     return JsonResponse({"error": "Only POST requests are allowed."}, status=405)
 
@@ -209,14 +462,14 @@ def upload_sketch_screenshot(request, sketch_id):
 @login_required
 def generate_sketch_audio(request, sketch_id):
     """
-    Generate audio summary from the OCR explanation in selected language
+    Queue generation of the audio summary from the OCR explanation in the
+    selected language
     """
     if request.method == 'POST':
         sketch = get_object_or_404(Sketch, id=sketch_id)
         
         # Check if user has access to this sketch
-        book = sketch.book
-        if request.user != book.created_by and request.user not in book.collaborators.all():
+        if not access.can_access(request.user, sketch.book_id, request):
             return JsonResponse({"error": "Unauthorized"}, status=403)
         
         # Check if explanation exists
@@ -225,61 +478,124 @@ def generate_sketch_audio(request, sketch_id):
                 "error": "No explanation found. Please run OCR first."
             }, status=400)
         
+        language = _request_language(_request_data(request))
+
+        # Same explanation already synthesized in this language: answer now
+        blob = audio_cache.lookup_audio(sketch.ocr_explanation, language)
+        if blob is not None:
+            try:
+                audio_cache.assign_audio(sketch, blob)
+            except AudioBlob.DoesNotExist:
+                pass
+            else:
+                language_name = SUPPORTED_LANGUAGES[language]['name']
+                return JsonResponse({
+                    "status": "success",
+                    "audio_url": blob.file.url,
+                    "audio_cached": True,
+                    "language": language,
+                    "language_name": language_name,
+                    "message": f"Audio generated successfully in {language_name}"
+                })
+
+        job = jobs.enqueue_once(
+            "sketch_audio",
+            {"sketch_id": sketch.id, "language": language},
+            user=request.user,
+            sketch=sketch,
+        )
+        return _job_accepted(job)
+    
+    return JsonResponse({"error": "Only POST requests are allowed."}, status=405)
+
+@login_required
+def stream_sketch_audio(request, sketch_id):
+    """
+    The audio summary in ?language= as an MP3 stream.
+
+    Cached audio is served as a file; otherwise it is generated sentence by
+    sentence and each one is sent as soon as it is ready (cached sentences
+    right away), so playback starts before the whole file exists. The
+    finished file becomes the sketch's audio_summary. Generating the whole
+    summary ahead of time is the generate-audio job's business.
+    """
+    sketch = get_object_or_404(Sketch, id=sketch_id)
+    
+    # Check if user has access to this sketch
+    if not access.can_access(request.user, sketch.book_id, request):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+    
+    if not sketch.ocr_explanation:
+        return JsonResponse({
+            "error": "No explanation found. Please run OCR first."
+        }, status=400)
+    
+    language = _request_language(request.GET)
+
+    blob = audio_cache.lookup_audio(sketch.ocr_explanation, language)
+    if blob is not None:
         try:
-            # Get language from request (default to English)
-            data = json.loads(request.body) if request.body else {}
-            language = data.get('language', 'en')
-            
-            # Validate language
-            from .audio_generator import SUPPORTED_LANGUAGES
-            if language not in SUPPORTED_LANGUAGES:
-                language = 'en'
-            
-            # Define output path with language suffix
-            audio_filename = f"audio_{sketch.book.id}_sk_{sketch_id}_{language}.mp3"
-            audio_path = os.path.join(settings.MEDIA_ROOT, "audio_summaries", audio_filename)
-            
-            # Create directory if it doesn't exist
-            os.makedirs(os.path.dirname(audio_path), exist_ok=True)
-            
-            # Get Gemini API key
-            gemini_api_key = getattr(settings, 'GEMINI_API_KEY', os.getenv('API_KEY'))
-            
-            # Generate audio in selected language
-            from .audio_generator import generate_audio_summary
-            generate_audio_summary(
-                text=sketch.ocr_explanation,
-                output_path=audio_path,
-                gemini_api_key=gemini_api_key,
-                language=language
-            )
-            
-            # Update sketch with audio file info (store latest generated)
-            sketch.audio_summary = f"audio_summaries/{audio_filename}"
-            sketch.audio_generated_at = timezone.now()
-            sketch.save()
-            
-            # Return audio URL
-            audio_url = os.path.join(settings.MEDIA_URL, "audio_summaries", audio_filename)
-            
-            return JsonResponse({
-                "status": "success",
-                "audio_url": audio_url,
-                "language": language,
-                "language_name": SUPPORTED_LANGUAGES[language]['name'],
-                "message": f"Audio generated successfully in {SUPPORTED_LANGUAGES[language]['name']}"
-            })
-            
-        except Exception as e:
-            print(f"Error generating audio: {e}")
-            import traceback
-            traceback.print_exc()
+            audio_cache.assign_audio(sketch, blob)
+        except AudioBlob.DoesNotExist:
+            pass
+        else:
+            # Same URL, different files over time: revalidate rather than cache
+            return media_files.serve(request, blob.file.name, content_type="audio/mpeg", immutable=False)
+
+    response = StreamingHttpResponse(
+        audio_cache.stream_audio(
+            sketch.ocr_explanation,
+            language,
+            on_stored=lambda blob: audio_cache.assign_audio(sketch, blob),
+        ),
+        content_type="audio/mpeg",
+    )
+    response["Cache-Control"] = "no-store"
+    return response
+
+@csrf_exempt
+@login_required
+def generate_sketch_audio_multi(request, sketch_id):
+    """
+    Generate the audio summary in several languages at once
+    ({"languages": [...]}, default: all supported languages)
+    """
+    if request.method == 'POST':
+        sketch = get_object_or_404(Sketch, id=sketch_id)
+        
+        # Check if user has access to this sketch
+        if not access.can_access(request.user, sketch.book_id, request):
+            return JsonResponse({"error": "Unauthorized"}, status=403)
+        
+        if not sketch.ocr_explanation:
             return JsonResponse({
-                "error": f"Failed to generate audio: {str(e)}"
-            }, status=500)
+                "error": "No explanation found. Please run OCR first."
+            }, status=400)
+        
+        languages = _request_data(request).get('languages') or list(SUPPORTED_LANGUAGES)
+        if not isinstance(languages, list):
+            return JsonResponse({"error": "languages must be a list"}, status=400)
+        unknown = [language for language in languages if language not in SUPPORTED_LANGUAGES]
+        if unknown:
+            return JsonResponse({"error": f"Unsupported languages: {', '.join(map(str, unknown))}"}, status=400)
+        languages = list(dict.fromkeys(languages))
+        
+        # Everything already synthesized: no need for a background job
+        keys = [audio_cache.cache_key(sketch.ocr_explanation, language) for language in languages]
+        if AudioBlob.objects.filter(key__in=keys).count() == len(keys):
+            return JsonResponse(tasks.sketch_audio_multi(sketch.id, languages))
+        
+        job = jobs.enqueue(
+            "sketch_audio_multi",
+            {"sketch_id": sketch.id, "languages": languages},
+            user=request.user,
+            sketch=sketch,
+        )
+        return _job_accepted(job)
     
     return JsonResponse({"error": "Only POST requests are allowed."}, status=405)
 
+
 @login_required
 def get_supported_languages(request):
     """
@@ -306,15 +622,20 @@ def get_sketch_audio(request, sketch_id):
     sketch = get_object_or_404(Sketch, id=sketch_id)
     
     # Check access
-    book = sketch.book
-    if request.user != book.created_by and request.user not in book.collaborators.all():
+    if not access.can_access(request.user, sketch.book_id, request):
         return JsonResponse({"error": "Unauthorized"}, status=403)
     
     if sketch.audio_summary:
         audio_url = sketch.audio_summary.url
+        languages = {
+            audio.language: audio.blob.file.url
+            for audio in sketch.audios.select_related("blob")
+        }
         return JsonResponse({
             "status": "exists",
             "audio_url": audio_url,
+            "language": sketch.audio_blob.language if sketch.audio_blob else None,
+            "languages": languages,
             "generated_at": sketch.audio_generated_at.isoformat() if sketch.audio_generated_at else None
         })
     else:
@@ -328,90 +649,90 @@ def get_sketch_audio(request, sketch_id):
 @login_required
 def upload_and_generate_audio(request, sketch_id):
     """
-    Combined endpoint: Run OCR and generate audio in selected language
+    Combined endpoint: queue OCR and audio generation in the selected language
     """
     if request.method == 'POST':
         sketch = get_object_or_404(Sketch, id=sketch_id)
         
-        if not sketch.image:
-            return JsonResponse({"error": "No image found."}, status=400)
-        
         # Check access
-        book = sketch.book
-        if request.user != book.created_by and request.user not in book.collaborators.all():
+        if not access.can_access(request.user, sketch.book_id, request):
             return JsonResponse({"error": "Unauthorized"}, status=403)
         
-        try:
-            # Get language from request
-            data = json.loads(request.body) if request.body else {}
-            language = data.get('language', 'en')
-            
-            # Validate language
-            from .audio_generator import SUPPORTED_LANGUAGES
-            if language not in SUPPORTED_LANGUAGES:
-                language = 'en'
-            
-            # Step 1: Run OCR
-            user_colors = UserColor.objects.filter(book=book)
-            color_info = [
-                f"{uc.user.username} used color {uc.color}" for uc in user_colors
-            ]
-            color_info_str = "\n".join(color_info)
-            
-            local_image_path = sketch.image.path
-            sample_file = prep_image(local_image_path)
-            
-            prompt = (
-                "You're analyzing a sketch which contains handwritten math or science problems. "
-                "Try to interpret the equations and expressions drawn. "
-                "Here are the users and their assigned colors:\n\n"
-                f"{color_info_str}\n\n"
-                "Based on this, try to interpret what was written or solved in the sketch mention and correct each others mistake if there any."
-            )
-            
-            text = extract_text_from_image(sample_file, prompt)
-            text_list = text.split("\n")
-            
-            # Store explanation
-            sketch.ocr_explanation = text
-            sketch.save()
-            
-            # Step 2: Generate audio in selected language
-            audio_filename = f"audio_{sketch.book.id}_sk_{sketch_id}_{language}.mp3"
-            audio_path = os.path.join(settings.MEDIA_ROOT, "audio_summaries", audio_filename)
-            os.makedirs(os.path.dirname(audio_path), exist_ok=True)
-            
-            gemini_api_key = getattr(settings, 'GEMINI_API_KEY', os.getenv('GEMINI_API_KEY'))
-            
-            from .audio_generator import generate_audio_summary
-            generate_audio_summary(
-                text=text,
-                output_path=audio_path,
-                gemini_api_key=gemini_api_key,
-                language=language
-            )
-            
-            sketch.audio_summary = f"audio_summaries/{audio_filename}"
-            sketch.audio_generated_at = timezone.now()
-            sketch.save()
-            
-            audio_url = os.path.join(settings.MEDIA_URL, "audio_summaries", audio_filename)
-            
-            return JsonResponse({
-                "status": "success",
-                "text": text_list,
-                "audio_url": audio_url,
-                "language": language,
-                "language_name": SUPPORTED_LANGUAGES[language]['name'],
-                "message": f"OCR and audio generation completed in {SUPPORTED_LANGUAGES[language]['name']}"
-            })
-            
-        except Exception as e:
-            print(f"Error: {e}")
-            import traceback
-            traceback.print_exc()
-            return JsonResponse({
-                "error": f"Failed to process: {str(e)}"
-            }, status=500)
+        if not sketch.strokes_packed and not sketch.image:
+            return JsonResponse({"error": "No image found."}, status=400)
+        
+        data = _request_data(request)
+        job = jobs.enqueue(
+            "sketch_ocr_audio",
+            {
+                "sketch_id": sketch.id,
+                "language": _request_language(data),
+                "refresh": bool(data.get('refresh')),
+            },
+            user=request.user,
+            sketch=sketch,
+        )
+        return _job_accepted(job)
     
-    return JsonResponse({"error": "Only POST requests are allowed."}, status=405)
\ No newline at end of file
+    return JsonResponse({"error": "Only POST requests are allowed."}, status=405)
+
+
+@login_required
+def job_status(request, job_id):
+    """
+    Status of a background job; ``result`` holds the response of the finished job
+    """
+    job = get_object_or_404(Job, id=job_id)
+    if job.created_by_id != request.user.id and not request.user.is_staff:
+        if not access.can_access_sketch(request.user, job.sketch_id, request):
+            return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    return JsonResponse({
+        "job_id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "result": job.result,
+        "error": job.error,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    })
+
+
+@login_required
+def ocr_cache_stats(request):
+    """
+    Hit/miss counters of the OCR result cache and of the uploaded image
+    handles (staff only)
+    """
+    if not request.user.is_staff:
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+    stats = cache_stats()
+    stats["files"] = gemini_files.cache_stats()
+    return JsonResponse(stats)
+
+
+@login_required
+def audio_cache_stats(request):
+    """
+    Hit/miss counters and size of the audio cache and of its sentence
+    cache (staff only)
+    """
+    if not request.user.is_staff:
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+    stats = audio_cache.cache_stats()
+    stats["sentences"] = speech_cache.cache_stats()
+    return JsonResponse(stats)
+
+
+def serve_media(request, path):
+    """
+    Uploaded and generated media, with Range, revalidation and offloading
+    (see media_files), to the users with access to a sketch using the file.
+    """
+    if request.method not in ("GET", "HEAD"):
+        return JsonResponse({"status": "invalid_method"}, status=405)
+    if not access.can_access_media(request.user, path, request):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+    return media_files.serve(request, path)
@@ -133,6 +133,89 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 # --- MEDIA FILES (Images) ---
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# Media are served by app/media_files.py. To let the front server send the
+# bytes, set MEDIA_ACCEL_REDIRECT to an nginx internal location aliased to
+# MEDIA_ROOT (e.g. "/protected-media/"), or MEDIA_X_SENDFILE=1 for X-Sendfile
+MEDIA_ACCEL_REDIRECT = os.getenv("MEDIA_ACCEL_REDIRECT", "")
+MEDIA_X_SENDFILE = os.getenv("MEDIA_X_SENDFILE") == "1"
+MEDIA_IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # seconds, for content-hashed files
+# Sketch previews (see app/thumbnails.py): longer sides in px and WebP quality
+THUMBNAIL_SIZES = (160, 320)
+THUMBNAIL_QUALITY = 75
+THUMBNAIL_DELAY = 30           # seconds a thumbnail job waits, gathering the changes made meanwhile
+
+
+# --- SKETCH STROKES ---
+# Strokes received over the WebSocket are written to the database in batches
+STROKE_FLUSH_SEGMENTS = int(os.getenv("STROKE_FLUSH_SEGMENTS", 500))
+STROKE_FLUSH_INTERVAL = float(os.getenv("STROKE_FLUSH_INTERVAL", 2.0))  # seconds
+# Segments for the same room are broadcast as one frame per tick (0 = no coalescing)
+STROKE_BROADCAST_TICK = float(os.getenv("STROKE_BROADCAST_TICK", 0.008))  # seconds
+# Ramer-Douglas-Peucker tolerance in px applied to incoming strokes (0 = keep every point)
+STROKE_SIMPLIFY_TOLERANCE = float(os.getenv("STROKE_SIMPLIFY_TOLERANCE", 0.5))
+# Cell size in px of the per-sketch spatial grid used for viewport queries and erasing
+STROKE_INDEX_CELL = 128
+# Sketches are drawn on a canvas of at most this many px per side (ink beyond is
+# not rendered), and images sized to the ink are scaled to at most this side
+SKETCH_CANVAS_MAX = 8192
+SKETCH_RENDER_MAX_SIDE = 4096
+# Tile pyramid: tile edge in px and number of zoom levels (0 = full size)
+SKETCH_TILE_SIZE = 256
+SKETCH_TILE_LEVELS = 4
+# Stroke log (see app/stroke_log.py): snapshot and compact every N revisions,
+# keeping this many snapshots (undo and history reach back to the oldest one)
+STROKE_SNAPSHOT_EVERY = int(os.getenv("STROKE_SNAPSHOT_EVERY", 500))
+STROKE_SNAPSHOTS_KEPT = 2
+# Seconds an append client's seq cursor is kept after its last batch
+STROKE_CLIENT_TTL = 7 * 24 * 3600
+# Strokes streamed to the sketch page: segments per NDJSON line and gzip level
+STROKE_STATE_CHUNK = 2000
+STROKE_STATE_GZIP_LEVEL = 6
+
+
+# --- ACCESS CONTROL (see app/access.py) ---
+# Book access answers are cached per process; collaborator changes made in
+# another process are seen after at most ACCESS_CACHE_TTL seconds
+ACCESS_CACHE_TTL = 60
+ACCESS_CACHE_SIZE = 10000
+
+
+# --- GEMINI CLIENT (see app/gemini.py) ---
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 4))  # requests in flight per process
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", 60))   # requests per minute allowed by the API quota
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", 10))  # requests that may be sent at once after an idle period
+GEMINI_RETRIES = 2             # retries of a request rejected with 429
+GEMINI_INLINE_MAX_BYTES = 1024 * 1024  # images up to this size are sent inline instead of uploaded first
+GEMINI_FILE_EXPIRY_MARGIN = 3600       # seconds before its expiry an uploaded file is no longer reused
+
+
+# --- OCR IMAGE (see app/ocr_image.py) ---
+OCR_IMAGE_MAX_SIDE = 1536      # px, longer side of the image uploaded for OCR
+OCR_IMAGE_MARGIN = 16          # px of background kept around the ink
+OCR_IMAGE_INK_COLORS = 16      # colors taken from an uploaded image for its palette
+OCR_REGION_CONTEXT = 150       # px of surrounding ink sent with each region added since the last OCR
+OCR_MAX_REGIONS = 4            # more separate regions than this are sent as one
+OCR_INCREMENTAL_MAX_FRACTION = 0.5  # regions covering more of the board than this re-read the whole board
+OCR_CONTEXT_CHARS = 1500       # tail of the explanation so far included in the incremental prompt
+
+# --- BACKGROUND JOBS (OCR / audio) ---
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))       # worker threads per process (0 = run_jobs command only)
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 5            # seconds, doubled on every retry
+JOB_POLL_INTERVAL = 2.0        # seconds between queue polls when idle
+JOB_HEARTBEAT_INTERVAL = 60    # seconds between locked_at refreshes of a running job
+JOB_STALE_AFTER = 600          # seconds without a heartbeat before a running job is considered abandoned
+JOB_RETENTION = 7 * 24 * 3600  # seconds finished jobs are kept
+JOB_CLEANUP_INTERVAL = 300     # seconds between cleanup passes
+
+
+# --- AUDIO CACHE ---
+AUDIO_BLOB_GRACE = 24 * 3600   # seconds an unreferenced audio blob is kept before collect_audio deletes it
+AUDIO_FANOUT_WORKERS = 3       # concurrent languages when generating audio in several languages
+AUDIO_TTS_WORKERS = 4          # concurrent gTTS requests (sentence chunks) per audio file
+AUDIO_CHUNK_CHARS = 300        # sentences are packed into TTS chunks of up to this many characters
+AUDIO_PREPARE_BATCH = 40       # sentences translated/refined per Gemini call
+AUDIO_SEGMENT_TTL = 30 * 24 * 3600  # seconds a cached sentence segment may go unused before collect_audio deletes it
 
 
 # Default primary key field type